@@ -0,0 +1,144 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Stand-ins for ProvisionerSchedd and ProvisionerCollector, used by the benchmarks
+#
+
+import random
+
+import lancium_provisioner.provisioner_records as provisioner_records
+import lancium_provisioner.provisioner_lancium_htcondor as provisioner_lancium_htcondor
+
+# (weight, RequestCPUs, RequestMemory, RequestDisk, RequestGPUs)
+FakeJobShapes = ((60, 1,  2048, 8000000, 0),
+                 (20, 4,  8192, 8000000, 0),
+                 (10, 8, 16384, 8000000, 0),
+                 ( 7, 1,  8192, 8000000, 1),
+                 ( 3, 4, 16384, 8000000, 1))
+
+class FakeSchedd:
+   """Produces synthetic idle jobs, in the same format as ProvisionerSchedd"""
+
+   def __init__(self, n_jobs, n_schedds, autocluster=False, seed=1234):
+      """
+      Arguments:
+         n_jobs: int
+             Total number of idle jobs, over all the schedds
+         n_schedds: int
+             Number of schedds to spread them over
+         autocluster: bool (Optional)
+             If True, return autocluster aggregates, like ProvisionerSchedd does in that mode
+      """
+      self.n_jobs = n_jobs
+      self.n_schedds = n_schedds
+      self.autocluster = autocluster
+      self.seed = seed
+      self.last_query_stats = {}
+
+   def query_idle(self, projection=[]):
+      return self.query(job_status=1, projection=projection)
+
+   def query(self, job_status, projection=[]):
+      rnd = random.Random(self.seed)
+      weights = [s[0] for s in FakeJobShapes]
+      total_weight = sum(weights)
+      jobs = []
+      # same records as ProvisionerSchedd._append_jobs
+      record_class = provisioner_records.get_record_class(['ScheddName','ClusterId','ProcId','JobStatus','JobCount',
+                                                           'RequestCPUs','RequestMemory','RequestDisk','RequestGPUs']+projection,
+                                                          provisioner_lancium_htcondor.ProvisionerScheddIntAttrs)
+      counts = {} # (schedd,shape) -> count, only used for autocluster
+      for i in range(self.n_jobs):
+         sname = "schedd%03i.fake"%(i%self.n_schedds)
+         r = rnd.uniform(0, total_weight)
+         for shape in FakeJobShapes:
+            r -= shape[0]
+            if r<=0:
+               break
+         if self.autocluster:
+            k = (sname,shape)
+            counts[k] = counts.get(k,0)+1
+         else:
+            jobs.append(self._new_job(record_class, sname, job_status, shape, {'ClusterId':i+1, 'ProcId':0}))
+
+      for (sname,shape) in counts:
+         jobs.append(self._new_job(record_class, sname, job_status, shape, {'JobCount':counts[(sname,shape)]}))
+      return jobs
+
+   # INTERNAL
+   def _new_job(self, record_class, sname, job_status, shape, extra_attrs):
+      job = record_class()
+      job['ScheddName'] = sname
+      job['JobStatus'] = job_status
+      job['RequestCPUs'] = shape[1]
+      job['RequestMemory'] = shape[2]
+      job['RequestDisk'] = shape[3]
+      if shape[4]>0:
+         job['RequestGPUs'] = shape[4]
+      for k in extra_attrs:
+         job[k] = extra_attrs[k]
+      return job
+
+class FakeCollector:
+   """Produces startd ads for the running fake Lancium jobs, in the same format as ProvisionerCollector"""
+
+   def __init__(self, lancium_state, claimed_fraction=0.8, app_name='lancium-wn', seed=1234):
+      """
+      Arguments:
+         lancium_state: object
+             FakeLanciumState object, used to find the running jobs
+         claimed_fraction: float (Optional)
+             Fraction of the running pods that have a claimed slot
+      """
+      self.lancium_state = lancium_state
+      self.claimed_fraction = claimed_fraction
+      self.app_name = app_name
+      self.seed = seed
+
+   def query(self, projection=[]):
+      rnd = random.Random(self.seed)
+      startds = []
+      for (jid,label_str,status) in self.lancium_state.list_jobs():
+         if status!='running':
+            continue
+         labels = {}
+         for el in label_str.split():
+            elarr = el.split(":",1)
+            if len(elarr)==2:
+               labels[elarr[0]] = elarr[1]
+         if ('lancium-job' not in labels) or (labels.get('lancium-app')!=self.app_name):
+            continue
+         job_name = labels['lancium-job']
+         cpus = int(labels.get('PodCPUs','1'))
+         memory = int(labels.get('PodMemory','2048'))
+         disk = int(labels.get('PodDisk','8000000'))
+         gpus = int(labels.get('PodGPUs','0'))
+         base = {'Machine': "%s.fake"%job_name,
+                 'AuthenticatedIdentity': 'lancium@fake',
+                 'Activity': 'Idle',
+                 'LanciumProvisionerType': 'PRPHTCondorProvisioner',
+                 'LanciumProvisionerName': self.app_name,
+                 'LanciumJobName': job_name}
+         if rnd.random()<self.claimed_fraction:
+            # partitionable slot with half the CPUs left, plus one claimed dynamic slot
+            pslot = dict(base, Name="slot1@%s.fake"%job_name, State='Unclaimed', SlotType='Partitionable',
+                         Cpus="%i"%int(cpus/2), Memory="%i"%int(memory/2), Disk="%i"%int(disk/2), GPUs="%i"%int(gpus/2))
+            dslot = dict(base, Name="slot1_1@%s.fake"%job_name, State='Claimed', Activity='Busy', SlotType='Dynamic',
+                         Cpus="%i"%(cpus-int(cpus/2)), Memory="%i"%(memory-int(memory/2)), Disk="%i"%(disk-int(disk/2)), GPUs="%i"%(gpus-int(gpus/2)))
+            startds += [pslot, dslot]
+         else:
+            startds.append(dict(base, Name="slot1@%s.fake"%job_name, State='Unclaimed', SlotType='Partitionable',
+                                Cpus="%i"%cpus, Memory="%i"%memory, Disk="%i"%disk, GPUs="%i"%gpus))
+
+      # same records as ProvisionerCollector.query
+      record_class = provisioner_records.get_record_class(list(provisioner_lancium_htcondor.ProvisionerStartdAttrs)+projection,
+                                                          provisioner_lancium_htcondor.ProvisionerStartdIntAttrs)
+      records = []
+      for ad in startds:
+         record = record_class()
+         for k in ad:
+            record[k] = ad[k]
+         records.append(record)
+      return records
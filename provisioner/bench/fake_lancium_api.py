@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Stand-in for the Lancium REST API, used by the benchmarks
+# Supports only the endpoints used by ProvisionerLanciumRESTBackend:
+#   GET    /api/v1/jobs
+#   POST   /api/v1/jobs
+#   POST   /api/v1/jobs/ID/submit
+#   DELETE /api/v1/jobs/ID
+#
+# Can also be run standalone, e.g.
+#   python3 fake_lancium_api.py --state /tmp/lancium_state.json --port 8080
+#
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import socketserver
+import http.server
+
+import fake_lancium_state
+
+class FakeLanciumAPIHandler(http.server.BaseHTTPRequestHandler):
+   # needed for keep-alive
+   protocol_version = 'HTTP/1.1'
+
+   def setup(self):
+      http.server.BaseHTTPRequestHandler.setup(self)
+      with self.server.stats_lock:
+         self.server.n_connections += 1
+
+   def log_message(self, format, *args):
+      pass # too noisy for benchmarks
+
+   def do_GET(self):
+      if self._start('/jobs')!='':
+         # includes None
+         return self._reply(404, {'error': 'Not found'})
+      jobs = [{'id': jid, 'name': name, 'status': status} for (jid,name,status) in self.server.state.list_jobs()]
+      self._reply(200, {'jobs': jobs})
+
+   def do_POST(self):
+      path = self._start('/jobs')
+      if path==None:
+         self._read_json()
+         return self._reply(404, {'error': 'Not found'})
+      if self._failed():
+         return
+      if path=='':
+         job = self._read_json()['job']
+         jid = self.server.state.add_job(job['name'])
+         return self._reply(201, {'job': {'id': jid, 'name': job['name'], 'status': 'created'}})
+      parts = path.split('/')
+      if (len(parts)==3) and (parts[2]=='submit'):
+         # jobs are queued as soon as they are created, nothing else to do
+         return self._reply(200, {})
+      self._reply(404, {'error': 'Not found'})
+
+   def do_DELETE(self):
+      path = self._start('/jobs/')
+      if path==None:
+         return self._reply(404, {'error': 'Not found'})
+      if self._failed():
+         return
+      if self.server.state.delete_job(path):
+         self._reply(200, {})
+      else:
+         self._reply(404, {'error': 'Job %s not found'%path})
+
+   # INTERNAL
+   def _start(self, prefix):
+      "Return the path after prefix, or None if it does not match"
+      with self.server.stats_lock:
+         self.server.n_requests += 1
+      if self.server.latency>0:
+         time.sleep(self.server.latency)
+      full_prefix = self.server.base_path+prefix
+      if not self.path.startswith(full_prefix):
+         return None
+      return self.path[len(full_prefix):]
+
+   def _failed(self):
+      if random.random()<self.server.failure_rate:
+         self._read_json() # drain it, to keep the connection usable
+         self._reply(500, {'error': 'Simulated failure'})
+         return True
+      return False
+
+   def _read_json(self):
+      length = int(self.headers.get('Content-Length','0'))
+      return json.loads(self.rfile.read(length).decode()) if length>0 else {}
+
+   def _reply(self, code, payload):
+      data = json.dumps(payload).encode()
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', "%i"%len(data))
+      self.end_headers()
+      self.wfile.write(data)
+
+class FakeLanciumAPIServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+   """Threaded HTTP server, backed by a FakeLanciumState"""
+   daemon_threads = True
+
+   def __init__(self, state, port=0, latency=0.0, failure_rate=0.0, base_path='/api/v1'):
+      """
+      Arguments:
+         state: object
+             FakeLanciumState object
+         port: int (Optional)
+             Port to listen on, on localhost, 0 picks a free one
+         latency: float (Optional)
+             Seconds to sleep in each request
+         failure_rate: float (Optional)
+             Probability of a create or delete failing
+      """
+      http.server.HTTPServer.__init__(self, ('127.0.0.1', port), FakeLanciumAPIHandler)
+      self.state = state
+      self.latency = latency
+      self.failure_rate = failure_rate
+      self.base_path = base_path
+      self.stats_lock = threading.Lock()
+      self.n_connections = 0
+      self.n_requests = 0
+      self.thread = None
+
+   def get_url(self):
+      return "http://127.0.0.1:%i%s"%(self.server_address[1], self.base_path)
+
+   def start(self):
+      "Serve in a background thread"
+      self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+
+def main(argv):
+   parser = argparse.ArgumentParser(description="Fake Lancium REST API")
+   parser.add_argument('--state', required=True, help="JSON state file, as used by the fake lcli")
+   parser.add_argument('--port', type=int, default=8080)
+   parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to each request")
+   parser.add_argument('--failure-rate', type=float, default=0.0)
+   args = parser.parse_args(argv)
+
+   server = FakeLanciumAPIServer(fake_lancium_state.FakeLanciumState(args.state), args.port, args.latency, args.failure_rate)
+   print("Serving on %s"%server.get_url())
+   server.serve_forever()
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
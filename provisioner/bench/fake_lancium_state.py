@@ -0,0 +1,96 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Shared state of the fake Lancium service used by the benchmarks
+#
+# The state is a JSON file, protected by flock, so that it can be
+# used by many concurrent fake lcli processes.
+#
+
+import os
+import json
+import time
+import fcntl
+
+def _status(job, now, queue_time, run_time):
+   if 'status' in job:
+      # fixed status, used for seeding
+      return job['status']
+   age = now-job['submit_time']
+   if age<queue_time:
+      return 'queued'
+   elif age<(queue_time+run_time):
+      return 'running'
+   else:
+      return 'finished'
+
+class FakeLanciumState:
+   """Fake Lancium job database, backed by a JSON file"""
+
+   def __init__(self, fname, queue_time=60.0, run_time=3600.0):
+      """
+      Arguments:
+         fname: string
+             Name of the JSON state file
+         queue_time: float (Optional)
+             Seconds a new job stays queued
+         run_time: float (Optional)
+             Seconds a job stays running, after which it is finished
+      """
+      self.fname = fname
+      self.queue_time = queue_time
+      self.run_time = run_time
+
+   def init(self, jobs=[]):
+      """Create a new state file
+         jobs is a list of (name,status) pairs, status can be None for time-based"""
+      state = {'next_id': 1000000, 'jobs': {}}
+      now = time.time()
+      for (name,status) in jobs:
+         job = {'name': name, 'submit_time': now}
+         if status!=None:
+            job['status'] = status
+         state['jobs']["%i"%state['next_id']] = job
+         state['next_id'] += 1
+      tmpname = self.fname+".tmp"
+      with open(tmpname,'w') as fd:
+         json.dump(state, fd)
+      os.rename(tmpname, self.fname)
+
+   def list_jobs(self):
+      "Returns a list of (id,name,status) triplets"
+      with open(self.fname,'r') as fd:
+         fcntl.flock(fd, fcntl.LOCK_SH)
+         state = json.load(fd)
+      now = time.time()
+      return [(jid, job['name'], _status(job, now, self.queue_time, self.run_time)) for (jid,job) in state['jobs'].items()]
+
+   def add_job(self, name):
+      "Returns the new job id"
+      with open(self.fname,'r+') as fd:
+         fcntl.flock(fd, fcntl.LOCK_EX)
+         state = json.load(fd)
+         jid = "%i"%state['next_id']
+         state['next_id'] += 1
+         state['jobs'][jid] = {'name': name, 'submit_time': time.time()}
+         self._write(fd, state)
+      return jid
+
+   def delete_job(self, jid):
+      "Returns True if the job existed"
+      with open(self.fname,'r+') as fd:
+         fcntl.flock(fd, fcntl.LOCK_EX)
+         state = json.load(fd)
+         if jid not in state['jobs']:
+            return False
+         del state['jobs'][jid]
+         self._write(fd, state)
+      return True
+
+   # INTERNAL
+   def _write(self, fd, state):
+      fd.seek(0)
+      json.dump(state, fd)
+      fd.truncate()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Replay the snapshots recorded by the provisioner (see snapshot_file),
+# and print the decisions the event loop would make, without calling out.
+#
+# The prp-htcondor-portal python directory must be in PYTHONPATH, e.g.
+#   PYTHONPATH=/opt/prp_provisioner/prp-htcondor-portal/provisioner/python \
+#     python3 replay_snapshots.py /var/log/provisioner/logs/snapshots.jsonl.gz --max-pods-per-cluster 60
+#
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import argparse
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(bench_dir), 'python'))
+
+import run_benchmark
+import lancium_provisioner.provisioner_snapshot as provisioner_snapshot
+import lancium_provisioner.provisioner_lancium_cleanup as provisioner_lancium_cleanup
+import lancium_provisioner.event_loop as event_loop
+
+def replay(args):
+   log_obj = run_benchmark.BenchLogging(args.verbose)
+   source = provisioner_snapshot.ProvisionerReplaySource()
+   lancium_obj = provisioner_snapshot.ProvisionerReplayLancium(args.app_name)
+   # no rate limit, we want the deletions to be done by the end of each iteration
+   cleanup_obj = provisioner_lancium_cleanup.ProvisionerLanciumCleanup(lancium_obj, 1, 0)
+   el = event_loop.ProvisionerEventLoop(log_obj, source, source, lancium_obj,
+                                        args.max_pods_per_cluster, args.max_submit_pods_per_cluster,
+                                        cleanup_obj=cleanup_obj, pod_planner=args.pod_planner)
+
+   total_submitted = 0
+   total_deleted = 0
+   i = 0
+   for (snapshot_time, schedd_jobs, startd_ads, lancium_pods) in provisioner_snapshot.ProvisionerSnapshotReader(args.snapshot_file):
+      source.set_snapshot(schedd_jobs, startd_ads)
+      lancium_obj.set_snapshot(lancium_pods)
+      el.one_iteration()
+      while cleanup_obj.count_pending()>0:
+         time.sleep(0.01)
+
+      (submissions, deletions) = lancium_obj.collect_decisions()
+      n_submitted = sum([n for (attrs,n) in submissions])
+      total_submitted += n_submitted
+      total_deleted += len(deletions)
+      print("Snapshot %i (%s): %i schedd ads, %i startd ads, %i pods, idle jobs %i, submit %i, delete %i"%
+            (i, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot_time)),
+             len(schedd_jobs), len(startd_ads), len(lancium_pods),
+             el.last_iteration_stats['n_jobs_idle'], n_submitted, len(deletions)))
+      for (attrs,n) in submissions:
+         print("   submit %i pods CPUs=%s GPUs=%s Memory=%s Disk=%s"%(n, attrs['CPUs'], attrs['GPUs'], attrs['Memory'], attrs['Disk']))
+      i += 1
+      if (args.max_snapshots>0) and (i>=args.max_snapshots):
+         break
+
+   print("Replayed %i snapshots, would have submitted %i pods and deleted %i"%(i, total_submitted, total_deleted))
+
+def main(argv):
+   parser = argparse.ArgumentParser(description="Replay recorded provisioner snapshots")
+   parser.add_argument('snapshot_file')
+   parser.add_argument('--app-name', default='lancium-wn')
+   parser.add_argument('--max-pods-per-cluster', type=int, default=40)
+   parser.add_argument('--max-submit-pods-per-cluster', type=int, default=600)
+   parser.add_argument('--pod-planner', default='binpack', choices=('binpack','heuristic'))
+   parser.add_argument('--max-snapshots', type=int, default=0, help="Stop after this many, 0 means all")
+   parser.add_argument('--profile', action='store_true', help="Print the hot spots")
+   parser.add_argument('--verbose', action='store_true')
+   args = parser.parse_args(argv)
+
+   if args.profile:
+      profiler = cProfile.Profile()
+      profiler.enable()
+      replay(args)
+      profiler.disable()
+      pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+   else:
+      replay(args)
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
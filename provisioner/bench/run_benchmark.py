@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Benchmark ProvisionerEventLoop.one_iteration against local stand-ins
+# for lcli (or the Lancium REST API), the schedds and the collector.
+#
+# The prp-htcondor-portal python directory must be in PYTHONPATH, e.g.
+#   PYTHONPATH=/opt/prp_provisioner/prp-htcondor-portal/provisioner/python \
+#     python3 run_benchmark.py --jobs 100000 --pods 5000 --schedds 50
+#
+# Use --json-output to save the results, and --baseline to compare
+# against a previous run (exits with 1 on regression).
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import resource
+import tempfile
+import tracemalloc
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(bench_dir), 'python'))
+
+import fake_lancium_state
+import fake_lancium_api
+import fake_htcondor
+import lancium_provisioner.provisioner_lancium as provisioner_lancium
+import lancium_provisioner.provisioner_throttle as provisioner_throttle
+import lancium_provisioner.provisioner_metrics as provisioner_metrics
+import lancium_provisioner.provisioner_snapshot as provisioner_snapshot
+import lancium_provisioner.event_loop as event_loop
+import lancium_provisioner.provisioner_pod_shapes as provisioner_pod_shapes
+import lancium_provisioner.provisioner_lancium_backends as provisioner_lancium_backends
+import lancium_provisioner.provisioner_supervisor as provisioner_supervisor
+
+# (PodCPUs, PodGPUs, PodMemory), must match the shapes ProvisionerEventLoop provisions
+BenchPodShapes = ((16,0,16*2048), (48,0,48*2048), (12,4,12*2048), (48,16,48*2048))
+# (fraction, status) of the seeded pods
+BenchPodStates = ((0.70,'running'), (0.10,'queued'), (0.15,'finished'), (0.05,'error'))
+BenchPhases = ('query_schedd', 'query_collector', 'query_lancium', 'clustering', 'provisioning', 'cleanup')
+
+class BenchLogging:
+   """Logging stand-in, discards debug messages"""
+
+   def __init__(self, verbose=False):
+      self.verbose = verbose
+
+   def log_debug(self, msg):
+      if self.verbose:
+         print("DEBUG %s"%msg)
+
+   def log_info(self, msg):
+      if self.verbose:
+         print("INFO %s"%msg)
+
+   def log_error(self, msg):
+      print("ERROR %s"%msg)
+
+   def sync(self):
+      sys.stdout.flush()
+
+def seed_pods(state, n_pods, app_name):
+   jobs = []
+   for i in range(n_pods):
+      (cpus,gpus,mem) = BenchPodShapes[i%len(BenchPodShapes)]
+      # spread the states evenly
+      frac = (i*0.618)%1.0
+      for (state_frac,status) in BenchPodStates:
+         if frac<state_frac:
+            break
+         frac -= state_frac
+      job_name = '%s-seed-%06x'%(app_name,i)
+      label_str = "lancium-app:%s lancium-job:%s prp-htcondor-portal:wn PodCPUs:%i PodGPUs:%i PodMemory:%i PodDisk:8000000"% \
+                  (app_name, job_name, cpus, gpus, mem)
+      jobs.append((label_str, status))
+   state.init(jobs)
+
+def create_supervisor(args, lconfig, log_obj, metrics_obj, schedd_obj, collector_obj, throttle_obj):
+   "One worker per pod shape, like provisioner_main with shard_by=shape"
+   shared_backend_obj = provisioner_lancium_backends.ProvisionerLanciumSharedBackend(provisioner_lancium.create_backend(lconfig, metrics_obj))
+   lancium_obj = provisioner_lancium.ProvisionerLancium(lconfig, metrics_obj, shared_backend_obj, throttle_obj)
+   workers = []
+   for shape in provisioner_pod_shapes.parse_pod_shapes(provisioner_pod_shapes.ProvisionerDefaultPodShapes):
+      worker_name = "%i:%i:%i:%i"%(shape.cpus, shape.gpus, shape.memory, shape.disk)
+      workers.append(event_loop.ProvisionerEventLoop(provisioner_supervisor.ProvisionerWorkerLogging(log_obj, worker_name),
+                                                     schedd_obj, collector_obj, lancium_obj,
+                                                     args.max_pods_per_cluster, args.max_submit_pods_per_cluster,
+                                                     metrics_obj=provisioner_metrics.ProvisionerLabeledMetrics(metrics_obj, {'worker':worker_name}),
+                                                     pod_shapes=[shape], pod_planner=args.pod_planner))
+   return provisioner_supervisor.ProvisionerSupervisor(log_obj, collector_obj, workers, args.concurrent_queries,
+                                                       metrics_obj, shared_backend_obj)
+
+def run(args):
+   workdir = tempfile.mkdtemp(prefix="lancium-bench-")
+   state_fname = os.path.join(workdir, "lancium_state.json")
+   os.environ['PATH'] = os.path.join(bench_dir, 'fake_lcli')+os.pathsep+os.environ['PATH']
+   os.environ['FAKE_LCLI_STATE'] = state_fname
+   os.environ['FAKE_LCLI_LATENCY'] = "%f"%args.lcli_latency
+   os.environ['FAKE_LCLI_FAILURE_RATE'] = "%f"%args.lcli_failure_rate
+
+   app_name = 'lancium-wn'
+   state = fake_lancium_state.FakeLanciumState(state_fname)
+   seed_pods(state, args.pods, app_name)
+
+   log_obj = BenchLogging(args.verbose)
+   metrics_obj = provisioner_metrics.ProvisionerMetrics()
+   schedd_obj = fake_htcondor.FakeSchedd(args.jobs, args.schedds, args.autocluster)
+   collector_obj = fake_htcondor.FakeCollector(state, app_name=app_name)
+   lconfig = provisioner_lancium.ProvisionerLanciumConfig(app_name=app_name, submit_threads=args.submit_threads,
+                                                          backend=args.backend)
+   api_server = None
+   if args.backend=='rest':
+      api_server = fake_lancium_api.FakeLanciumAPIServer(state, latency=args.lcli_latency, failure_rate=args.lcli_failure_rate)
+      api_server.start()
+      lconfig.api_url = api_server.get_url()
+      os.environ['LANCIUM_API_KEY'] = 'bench'
+   throttle_obj = provisioner_throttle.ProvisionerLanciumThrottle(args.lancium_max_rate, args.lancium_burst,
+                                                                 args.breaker_failures, metrics_obj=metrics_obj)
+   if args.shard_by=='shape':
+      el = create_supervisor(args, lconfig, log_obj, metrics_obj, schedd_obj, collector_obj, throttle_obj)
+   else:
+      lancium_obj = provisioner_lancium.ProvisionerLancium(lconfig, metrics_obj, throttle_obj=throttle_obj)
+      snapshot_obj = provisioner_snapshot.ProvisionerSnapshotRecorder(args.snapshot_file) if args.snapshot_file else None
+      el = event_loop.ProvisionerEventLoop(log_obj, schedd_obj, collector_obj, lancium_obj,
+                                           args.max_pods_per_cluster, args.max_submit_pods_per_cluster,
+                                           concurrent_queries=args.concurrent_queries, metrics_obj=metrics_obj,
+                                           snapshot_obj=snapshot_obj, pod_planner=args.pod_planner)
+
+   if args.trace_memory:
+      tracemalloc.start()
+
+   iterations = []
+   for i in range(args.iterations):
+      start_time = time.time()
+      el.one_iteration()
+      duration = time.time()-start_time
+      stats = el.last_iteration_stats
+      phases = {}
+      for phase in BenchPhases:
+         phases[phase] = metrics_obj.get_value('last_phase_seconds', {'phase':phase}) or 0.0
+      n_submitted = stats['n_pods_submitted']
+      iteration = {'duration': duration,
+                   'phases': phases,
+                   'ok': stats['ok'],
+                   'n_jobs_idle': stats['n_jobs_idle'],
+                   'n_pods_submitted': n_submitted,
+                   'n_pods_failed': stats['n_pods_failed'],
+                   'n_pods_shed': stats['n_pods_shed'],
+                   'submissions_per_sec': n_submitted/phases['provisioning'] if phases['provisioning']>0 else 0.0}
+      if args.trace_memory:
+         iteration['traced_peak_mb'] = tracemalloc.get_traced_memory()[1]/1e6
+         if hasattr(tracemalloc,'reset_peak'):
+            # only available in python 3.9+
+            tracemalloc.reset_peak()
+      iterations.append(iteration)
+      print_iteration(i, iteration)
+
+   results = {'params': vars(args),
+              'iterations': iterations,
+              'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+              'mean_duration': sum([it['duration'] for it in iterations])/len(iterations),
+              'mean_phases': {}}
+   for phase in BenchPhases:
+      results['mean_phases'][phase] = sum([it['phases'][phase] for it in iterations])/len(iterations)
+   print("Max RSS %.1f MB, mean iteration %.3fs"%(results['max_rss_mb'], results['mean_duration']))
+   if api_server!=None:
+      print("REST API: %i requests over %i connections"%(api_server.n_requests, api_server.n_connections))
+      api_server.stop()
+   shutil.rmtree(workdir, ignore_errors=True)
+   return results
+
+def print_iteration(i, iteration):
+   phases_str = " ".join(["%s=%.3f"%(phase,iteration['phases'][phase]) for phase in BenchPhases])
+   mem_str = " traced_peak=%.1fMB"%iteration['traced_peak_mb'] if 'traced_peak_mb' in iteration else ""
+   print("Iteration %i: %.3fs %s submitted=%i failed=%i shed=%i (%.1f/s) idle=%i%s"%
+         (i, iteration['duration'], phases_str, iteration['n_pods_submitted'], iteration['n_pods_failed'], iteration['n_pods_shed'],
+          iteration['submissions_per_sec'], iteration['n_jobs_idle'], mem_str))
+
+def compare(results, baseline, max_regression):
+   "Returns the list of regressions, as strings"
+   regressions = []
+   checks = [('mean_duration', results['mean_duration'], baseline['mean_duration'])]
+   for phase in BenchPhases:
+      checks.append(('phase %s'%phase, results['mean_phases'][phase], baseline['mean_phases'][phase]))
+   checks.append(('max_rss_mb', results['max_rss_mb'], baseline['max_rss_mb']))
+   for (name, val, base_val) in checks:
+      # ignore noise in very short phases
+      if (val>base_val*(1.0+max_regression)) and ((val-base_val)>0.01):
+         regressions.append("%s: %.3f vs baseline %.3f"%(name, val, base_val))
+   return regressions
+
+def main(argv):
+   parser = argparse.ArgumentParser(description="Benchmark the Lancium provisioner event loop")
+   parser.add_argument('--jobs', type=int, default=100000, help="Number of idle jobs")
+   parser.add_argument('--pods', type=int, default=5000, help="Number of existing Lancium pods")
+   parser.add_argument('--schedds', type=int, default=50, help="Number of schedds")
+   parser.add_argument('--iterations', type=int, default=3)
+   parser.add_argument('--autocluster', action='store_true', help="Use autocluster aggregates")
+   parser.add_argument('--concurrent-queries', action='store_true')
+   parser.add_argument('--backend', default='lcli', choices=('lcli','rest'), help="Use the fake lcli or the fake REST API")
+   parser.add_argument('--lcli-latency', type=float, default=0.05, help="Seconds added to each lcli call or API request")
+   parser.add_argument('--lcli-failure-rate', type=float, default=0.01)
+   parser.add_argument('--submit-threads', type=int, default=8)
+   parser.add_argument('--lancium-max-rate', type=float, default=0.0, help="Max Lancium operations per second, 0 means no limit")
+   parser.add_argument('--lancium-burst', type=int, default=20)
+   parser.add_argument('--breaker-failures', type=int, default=5, help="Consecutive failures before the circuit breaker opens, 0 disables it")
+   parser.add_argument('--max-pods-per-cluster', type=int, default=40)
+   parser.add_argument('--max-submit-pods-per-cluster', type=int, default=100000)
+   parser.add_argument('--pod-planner', default='binpack', choices=('binpack','heuristic'))
+   parser.add_argument('--shard-by', default='', choices=('','shape'), help="Run one worker per pod shape, under a supervisor")
+   parser.add_argument('--snapshot-file', help="Record the iteration inputs, for use with replay_snapshots.py")
+   parser.add_argument('--trace-memory', action='store_true', help="Use tracemalloc (slow)")
+   parser.add_argument('--json-output', help="Save the results in this file")
+   parser.add_argument('--baseline', help="Compare against the results in this file")
+   parser.add_argument('--max-regression', type=float, default=0.25, help="Allowed slowdown vs baseline, as a fraction")
+   parser.add_argument('--verbose', action='store_true')
+   args = parser.parse_args(argv)
+
+   results = run(args)
+   if args.json_output:
+      with open(args.json_output,'w') as fd:
+         json.dump(results, fd, indent=1)
+
+   if args.baseline:
+      with open(args.baseline,'r') as fd:
+         baseline = json.load(fd)
+      regressions = compare(results, baseline, args.max_regression)
+      for r in regressions:
+         print("REGRESSION %s"%r)
+      if len(regressions)>0:
+         return 1
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
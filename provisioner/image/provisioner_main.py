@@ -7,13 +7,133 @@
 #
 
 import sys
+import copy
 import time
 import configparser
 
 import lancium_provisioner.provisioner_lancium as provisioner_lancium
-import prp_provisioner.provisioner_logging as provisioner_logging
+import lancium_provisioner.provisioner_lancium_cleanup as provisioner_lancium_cleanup
+import lancium_provisioner.provisioner_throttle as provisioner_throttle
+import lancium_provisioner.provisioner_logging as provisioner_logging
 import lancium_provisioner.provisioner_lancium_htcondor as provisioner_htcondor
 import lancium_provisioner.event_loop as event_loop
+import lancium_provisioner.provisioner_cadence as provisioner_cadence
+import lancium_provisioner.provisioner_watchdog as provisioner_watchdog
+import lancium_provisioner.provisioner_metrics as provisioner_metrics
+import lancium_provisioner.provisioner_snapshot as provisioner_snapshot
+import lancium_provisioner.provisioner_pod_shapes as provisioner_pod_shapes
+import lancium_provisioner.provisioner_forecast as provisioner_forecast
+import lancium_provisioner.provisioner_checkpoint as provisioner_checkpoint
+import lancium_provisioner.provisioner_lancium_backends as provisioner_lancium_backends
+import lancium_provisioner.provisioner_supervisor as provisioner_supervisor
+
+def create_event_loop(fconfig, lfconfig, log_obj, metrics_obj, schedd_obj, collector_obj, lancium_obj, pod_shapes, worker_name=None):
+   """Create a ProvisionerEventLoop, configured from the lfconfig section
+      If worker_name is not None, it is used to tell apart the logs, metrics and checkpoints of the workers"""
+   max_pods_per_cluster = int(lfconfig.get('max_pods_per_cluster','20'))
+   max_submit_pods_per_cluster = int(lfconfig.get('max_submit_pods_per_cluster','400'))
+   # binpack or heuristic
+   pod_planner = lfconfig.get('pod_planner','binpack')
+   # 0 disables submitting ahead of the demand
+   forecast_alpha = float(lfconfig.get('forecast_alpha','0.3'))
+   forecast_default_latency = int(lfconfig.get('forecast_default_latency','300'))
+   # cancel surplus waiting pods after this many iterations, 0 disables
+   scale_down_delay = int(lfconfig.get('scale_down_delay','3'))
+   scale_down_margin = int(lfconfig.get('scale_down_margin','2'))
+   max_known_finished = int(lfconfig.get('max_known_finished','100000'))
+   delete_threads = int(lfconfig.get('delete_threads','4'))
+   # keep it within the lancium_max_rate*lancium_delete_share budget, if any
+   max_delete_rate = float(lfconfig.get('max_delete_rate','1.0'))
+   # empty means do not record
+   snapshot_file = fconfig['DEFAULT'].get('snapshot_file','')
+   # empty means start fresh after each restart
+   checkpoint_file = fconfig['DEFAULT'].get('checkpoint_file','')
+   checkpoint_interval = int(fconfig['DEFAULT'].get('checkpoint_interval','60'))
+   concurrent_queries = fconfig['DEFAULT'].getboolean('concurrent_queries',False)
+
+   snapshot_obj = None
+   if worker_name!=None:
+      log_obj = provisioner_supervisor.ProvisionerWorkerLogging(log_obj, worker_name)
+      metrics_obj = provisioner_metrics.ProvisionerLabeledMetrics(metrics_obj, {'worker':worker_name})
+      if checkpoint_file!='':
+         checkpoint_file = "%s.%s"%(checkpoint_file, worker_name.replace('/','_'))
+      # the workers do not query the system themselves, so there is nothing to record
+   elif snapshot_file!='':
+      snapshot_obj = provisioner_snapshot.ProvisionerSnapshotRecorder(snapshot_file)
+
+   cleanup_obj = provisioner_lancium_cleanup.ProvisionerLanciumCleanup(lancium_obj, delete_threads, max_delete_rate)
+   forecast_obj = provisioner_forecast.ProvisionerDemandForecast(forecast_alpha, forecast_default_latency)
+   checkpoint_obj = provisioner_checkpoint.ProvisionerCheckpoint(checkpoint_file, checkpoint_interval) if checkpoint_file!='' else None
+
+   return event_loop.ProvisionerEventLoop(log_obj, schedd_obj, collector_obj, lancium_obj, max_pods_per_cluster, max_submit_pods_per_cluster,
+                                          concurrent_queries=concurrent_queries, max_known_finished=max_known_finished,
+                                          cleanup_obj=cleanup_obj, metrics_obj=metrics_obj, snapshot_obj=snapshot_obj,
+                                          pod_shapes=pod_shapes, pod_planner=pod_planner, forecast_obj=forecast_obj,
+                                          scale_down_margin=scale_down_margin, scale_down_delay=scale_down_delay,
+                                          checkpoint_obj=checkpoint_obj)
+
+def get_lancium_sections(fconfig, shard_by):
+   """Returns the config sections with the Lancium settings, one per app
+      For app sharding, each [lancium.<name>] section, in addition to [lancium], is a separate app"""
+   sections = ['lancium'] if ('lancium' in fconfig) else ['DEFAULT']
+   if shard_by=='app':
+      sections += sorted([s for s in fconfig.sections() if s.startswith('lancium.')])
+   return sections
+
+def get_lancium_config(fconfig, section):
+   """Returns the settings of a Lancium section, as a dictionary
+      [lancium.<name>] sections inherit from [lancium], not just from [DEFAULT]"""
+   if (not section.startswith('lancium.')) or ('lancium' not in fconfig):
+      return dict(fconfig[section])
+   lfconfig = dict(fconfig['lancium'])
+   defaults = fconfig.defaults()
+   for k in fconfig[section]:
+      # the section proxy includes the defaults, keep the [lancium] value for those
+      if (k not in defaults) or (fconfig[section][k]!=defaults[k]):
+         lfconfig[k] = fconfig[section][k]
+   return lfconfig
+
+def create_supervisor(fconfig, shard_by, log_obj, metrics_obj, schedd_obj, collector_obj, throttle_obj, cconfig):
+   """Create a ProvisionerSupervisor, with the workers sharded by pod shape or by app
+      For app sharding, collector_obj must return the startds of all the apps,
+      and the apps with additional_requirements only get the jobs matching them, from their own schedd query.
+      The requirements of the apps should not overlap, each app provisions for all the jobs it gets."""
+   shared_backend_obj = None
+   backend_settings = None
+   workers = []
+   for section in get_lancium_sections(fconfig, shard_by):
+      lfconfig = get_lancium_config(fconfig, section)
+      lconfig = provisioner_lancium.ProvisionerLanciumConfig()
+      lconfig.parse(lfconfig)
+      if shared_backend_obj==None:
+         # all the apps use the same Lancium account, so one listing is enough for all
+         shared_backend_obj = provisioner_lancium_backends.ProvisionerLanciumSharedBackend(provisioner_lancium.create_backend(lconfig, metrics_obj))
+         backend_settings = (lconfig.backend, lconfig.api_url, lconfig.api_key_file)
+      elif (lconfig.backend, lconfig.api_url, lconfig.api_key_file)!=backend_settings:
+         log_obj.log_error("[Main] Section [%s] has different backend settings, ignored, all the apps use backend=%s api_url=%s api_key_file=%s"%
+                           ((section,)+backend_settings))
+      lancium_obj = provisioner_lancium.ProvisionerLancium(lconfig, metrics_obj, shared_backend_obj, throttle_obj)
+      app_schedd_obj = schedd_obj
+      if (shard_by=='app') and (lconfig.additional_requirements!=""):
+         # the same requirements the pods of this app will enforce
+         app_cconfig = copy.deepcopy(cconfig)
+         if app_cconfig.additional_requirements!="":
+            app_cconfig.additional_requirements = "(%s) && (%s)"%(app_cconfig.additional_requirements, lconfig.additional_requirements)
+         else:
+            app_cconfig.additional_requirements = lconfig.additional_requirements
+         app_schedd_obj = provisioner_htcondor.ProvisionerSchedd(log_obj, schedd_obj.trusted_schedds, app_cconfig,
+                                                                 provisioner_metrics.ProvisionerLabeledMetrics(metrics_obj, {'app':lconfig.app_name}))
+      pod_shapes = provisioner_pod_shapes.parse_pod_shapes(lfconfig.get('pod_shapes',provisioner_pod_shapes.ProvisionerDefaultPodShapes))
+      if shard_by=='shape':
+         for shape in pod_shapes:
+            worker_name = "%s/%i:%i:%i:%i"%(lconfig.app_name, shape.cpus, shape.gpus, shape.memory, shape.disk)
+            workers.append(create_event_loop(fconfig, lfconfig, log_obj, metrics_obj, app_schedd_obj, collector_obj, lancium_obj, [shape], worker_name))
+      else:
+         workers.append(create_event_loop(fconfig, lfconfig, log_obj, metrics_obj, app_schedd_obj, collector_obj, lancium_obj, pod_shapes, lconfig.app_name))
+
+   concurrent_queries = fconfig['DEFAULT'].getboolean('concurrent_queries',False)
+   return provisioner_supervisor.ProvisionerSupervisor(log_obj, collector_obj, workers, concurrent_queries,
+                                                       metrics_obj, shared_backend_obj)
 
 def main(log_fname):
    fconfig = configparser.ConfigParser()
@@ -26,24 +146,89 @@ def main(log_fname):
    hfconfig = fconfig['htcondor'] if ('htcondor' in fconfig) else fconfig['DEFAULT']
    cconfig.parse(hfconfig)
 
-   log_obj = provisioner_logging.ProvisionerFileLogging(log_fname, want_log_debug=True)
+   want_log_debug = fconfig['DEFAULT'].getboolean('log_debug',True)
+   # the log is written by a background thread, so it never slows down the iterations
+   log_flush_interval = float(fconfig['DEFAULT'].get('log_flush_interval','2.0'))
+   log_max_queued = int(fconfig['DEFAULT'].get('log_max_queued','100000'))
+   # 0 means never rotate
+   log_rotate_size = int(fconfig['DEFAULT'].get('log_rotate_size_mb','0'))*1024*1024
+   log_rotate_interval = int(fconfig['DEFAULT'].get('log_rotate_interval','0'))
+   log_rotate_count = int(fconfig['DEFAULT'].get('log_rotate_count','5'))
+   log_obj = provisioner_logging.ProvisionerAsyncFileLogging(log_fname, want_log_debug, log_max_queued, log_flush_interval,
+                                                             log_rotate_size, log_rotate_interval, log_rotate_count)
+   metrics_obj = provisioner_metrics.ProvisionerMetrics()
    # TBD: Strong security
    schedd_whitelist=hfconfig.get('schedd_whitelist_regexp','.*')
-   schedd_obj = provisioner_htcondor.ProvisionerSchedd(log_obj, {schedd_whitelist:'.*'}, cconfig)
-   collector_obj = provisioner_htcondor.ProvisionerCollector(log_obj, '.*', cconfig)
-   lancium_obj = provisioner_lancium.ProvisionerLancium(lconfig)
-
-   max_pods_per_cluster = int(lfconfig.get('max_pods_per_cluster','20'))
-   max_submit_pods_per_cluster = int(lfconfig.get('max_submit_pods_per_cluster','400'))
+   schedd_obj = provisioner_htcondor.ProvisionerSchedd(log_obj, {schedd_whitelist:'.*'}, cconfig, metrics_obj)
+   # empty means a single event loop, else shape or app, see create_supervisor
+   shard_by = fconfig['DEFAULT'].get('shard_by','')
+   app_names = None
+   if shard_by=='app':
+      # all the apps share one collector query
+      app_names = []
+      for section in get_lancium_sections(fconfig, shard_by):
+         app_lconfig = provisioner_lancium.ProvisionerLanciumConfig()
+         app_lconfig.parse(get_lancium_config(fconfig, section))
+         app_names.append(app_lconfig.app_name)
+   collector_obj = provisioner_htcondor.ProvisionerCollector(log_obj, '.*', cconfig, app_names)
+   # shared by all Lancium operations, 0 means no rate limit
+   lancium_max_rate = float(lfconfig.get('lancium_max_rate','0'))
+   lancium_burst = int(lfconfig.get('lancium_burst','20'))
+   # the part of lancium_max_rate reserved for deletions, so they cannot starve the submissions
+   lancium_delete_share = float(lfconfig.get('lancium_delete_share','0.2'))
+   # open the circuit breaker after this many consecutive failures, 0 disables it
+   breaker_failures = int(lfconfig.get('breaker_failures','5'))
+   breaker_backoff = int(lfconfig.get('breaker_backoff','30'))
+   breaker_max_backoff = int(lfconfig.get('breaker_max_backoff','900'))
+   throttle_obj = provisioner_throttle.ProvisionerLanciumThrottle(lancium_max_rate, lancium_burst,
+                                                                 breaker_failures, breaker_backoff, breaker_max_backoff,
+                                                                 metrics_obj=metrics_obj, delete_share=lancium_delete_share)
    sleep_time = int(fconfig['DEFAULT'].get('sleep_time','120'))
+   # sleep_time is the max, go faster when there is new demand
+   min_sleep_time = int(fconfig['DEFAULT'].get('min_sleep_time','30'))
+   max_sleep_time = int(fconfig['DEFAULT'].get('max_sleep_time',"%i"%sleep_time))
+   iteration_deadline = int(fconfig['DEFAULT'].get('iteration_deadline','1800'))
+   watchdog_abort = fconfig['DEFAULT'].getboolean('watchdog_abort',False)
+   # 0 means do not serve the metrics
+   metrics_port = int(fconfig['DEFAULT'].get('metrics_port','0'))
+   metrics_address = fconfig['DEFAULT'].get('metrics_address','')
 
-   el = event_loop.ProvisionerEventLoop(log_obj, schedd_obj, collector_obj, lancium_obj, max_pods_per_cluster, max_submit_pods_per_cluster)
+   if shard_by=='':
+      lancium_obj = provisioner_lancium.ProvisionerLancium(lconfig, metrics_obj, throttle_obj=throttle_obj)
+      pod_shapes = provisioner_pod_shapes.parse_pod_shapes(lfconfig.get('pod_shapes',provisioner_pod_shapes.ProvisionerDefaultPodShapes))
+      el = create_event_loop(fconfig, lfconfig, log_obj, metrics_obj, schedd_obj, collector_obj, lancium_obj, pod_shapes)
+   elif shard_by in ('shape','app'):
+      # same one_iteration, restore_checkpoint and last_iteration_stats interface as the event loop
+      el = create_supervisor(fconfig, shard_by, log_obj, metrics_obj, schedd_obj, collector_obj, throttle_obj, cconfig)
+      log_obj.log_info("[Main] Supervising %i workers, sharded by %s"%(len(el.workers), shard_by))
+   else:
+      raise ValueError("Unknown shard_by '%s'"%shard_by)
+   try:
+      # a no-op if there is no checkpoint_file
+      el.restore_checkpoint()
+   except:
+      log_obj.log_error("[Main] Failed to restore checkpoint, starting fresh")
+   cadence = provisioner_cadence.ProvisionerAdaptiveCadence(min_sleep_time, max_sleep_time)
+   watchdog = provisioner_watchdog.ProvisionerWatchdog(log_obj, iteration_deadline, watchdog_abort)
+   if metrics_port>0:
+      metrics_server = provisioner_metrics.ProvisionerMetricsServer(metrics_obj, metrics_port, metrics_address)
+      metrics_server.start()
+      log_obj.log_info("[Main] Serving metrics on port %i"%metrics_port)
    while True:
       log_obj.log_debug("[Main] Iteration started, schedd whitelist='%s'"%schedd_whitelist)
+      watchdog.start_iteration()
       try:
          el.one_iteration()
       except:
          log_obj.log_debug("[Main] Exception in one_iteration")
+      iteration_time = watchdog.end_iteration()
+      log_obj.log_debug("[Main] Iteration took %.1fs"%iteration_time)
+      metrics_obj.set_gauge('last_iteration_seconds', iteration_time, help="Duration of the last iteration")
+      metrics_obj.observe('iteration_seconds', iteration_time, help="Time spent in iterations")
+      metrics_obj.set_gauge('iteration_overruns', watchdog.n_overruns, help="Number of iterations past the deadline")
+      sleep_time = cadence.next_sleep(el.last_iteration_stats)
+      log_obj.log_debug("[Main] Sleeping %i seconds"%sleep_time)
+      metrics_obj.set_gauge('sleep_seconds', sleep_time, help="Current sleep time between iterations")
       log_obj.sync()
       time.sleep(sleep_time)
 
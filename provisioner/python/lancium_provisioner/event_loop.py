@@ -6,119 +6,433 @@
 # Implement the event loop
 #
 
+import time
+import bisect
+import concurrent.futures
+
 from . import provisioner_lancium_clustering
+from . import provisioner_lancium_finished
+from . import provisioner_lancium_cleanup
+from . import provisioner_metrics
+from . import provisioner_pod_shapes
+from . import provisioner_planner
+from . import provisioner_forecast
 import provisioner_clustering
 
 def cluster_val(x):
-   xarr=x.split(';')
-   xgpus=0 if len(xarr[4])==0 else int(xarr[4])
-   xcpus=int(xarr[0])
-   # by making GPUs more expensive than 1k cores, we guarantee that we never get a gpu job on a CPU-only node
-   return xgpus*1000+xcpus
+   return provisioner_lancium_clustering.ProvisionerResources.from_key(x).cost()
+
+def match_clusters(schedd_clusters, cluster_keys, cluster_costs, cluster_resources, log_obj=None):
+   """Assign each schedd cluster to the smallest pod shape it fits in, in a single pass
+      cluster_keys must be sorted from the cheapest, with cluster_costs their costs,
+      and cluster_resources a dictionary of key -> ProvisionerResources
+      If log_obj is not None, the schedd clusters that fit no pod shape are logged
+      Returns a dictionary of pod cluster key -> list of schedd clusters"""
+   matched = {}
+   n_shapes = len(cluster_keys)
+   for skey in schedd_clusters:
+      schedd_cluster = schedd_clusters[skey]
+      resources = schedd_cluster.resources
+      # anything cheaper cannot fit, so skip it
+      idx = bisect.bisect_left(cluster_costs, resources.cost())
+      while (idx<n_shapes) and (not resources.fits_in(cluster_resources[cluster_keys[idx]])):
+         idx += 1
+      if idx>=n_shapes:
+         # does not fit in any pod, ignore
+         if log_obj!=None:
+            log_obj.log_debug("[ProvisionerEventLoop] Cluster '%s' with %i idle jobs does not fit any pod shape"%
+                              (skey, schedd_cluster.count_idle()))
+         continue
+      ckey = cluster_keys[idx]
+      if ckey not in matched:
+         matched[ckey] = []
+      matched[ckey].append(schedd_cluster)
+   return matched
 
+# same order as ProvisionerLanciumCluster.count_states
+ProvisionerEventLoopPodStates = ('waiting','unmatched','claimed','failed','unknown')
 
 class ProvisionerEventLoop:
-   def __init__(self, log_obj, schedd_obj, collector_obj, lancium_obj, max_pods_per_cluster, max_submit_pods_per_cluster):
+   def __init__(self, log_obj, schedd_obj, collector_obj, lancium_obj, max_pods_per_cluster, max_submit_pods_per_cluster,
+                concurrent_queries=False, max_known_finished=100000, cleanup_obj=None, metrics_obj=None,
+                snapshot_obj=None, pod_shapes=None, pod_planner='binpack', forecast_obj=None,
+                scale_down_margin=2, scale_down_delay=3, checkpoint_obj=None):
+      """
+      Arguments:
+         concurrent_queries: bool (Optional)
+             If True, query the schedds, the collector and Lancium in parallel
+         max_known_finished: int (Optional)
+             Max number of finished Lancium jobs to keep track of
+         cleanup_obj: object (Optional)
+             ProvisionerLanciumCleanup object used to delete finished jobs in the background
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object to report timings and counts to
+         snapshot_obj: object (Optional)
+             ProvisionerSnapshotRecorder object, used to record the inputs of each iteration
+         pod_shapes: list of ProvisionerResources (Optional)
+             Pod shapes to provision, see provisioner_pod_shapes
+         pod_planner: string (Optional)
+             How to decide the number of pods to submit, one of
+             'binpack' (pack the idle jobs into the pods) or 'heuristic' (fixed ratio of the idle jobs)
+         forecast_obj: object (Optional)
+             ProvisionerDemandForecast object, used to submit ahead of the expected demand
+         scale_down_margin: int (Optional)
+             Number of surplus waiting pods to keep in each cluster
+         scale_down_delay: int (Optional)
+             Number of consecutive iterations with surplus pods before cancelling them, 0 disables scale-down
+         checkpoint_obj: object (Optional)
+             ProvisionerCheckpoint object, used to save the state at the end of each iteration
+      """
       self.log_obj = log_obj
       self.schedd = schedd_obj
       self.collector = collector_obj
       self.lancium_obj = lancium_obj
       self.max_pods_per_cluster = max_pods_per_cluster
       self.max_submit_pods_per_cluster = max_submit_pods_per_cluster
-      # Hardcode for now
+      self.concurrent_queries = concurrent_queries
+      if pod_shapes==None:
+         pod_shapes = provisioner_pod_shapes.parse_pod_shapes(provisioner_pod_shapes.ProvisionerDefaultPodShapes)
       self.available_clusters = {}
-      for c in [16,48]:
-        self.available_clusters['%i;%i;8000000;;0;;'%(c,c*2048)] = \
-           provisioner_lancium_clustering.ProvisionerLanciumCluster('%i;%i;8000000;;0;;'%(c,c*2048), \
-           ["%i"%c, "%i"%(c*2048), '8000000', '', '0', '', ''], \
-           {'PodCPUs': "%i"%c, 'PodMemory': "%i"%(c*2048), 'PodDisk': '8000000', 'PodDiskVolumes': '', 'PodGPUs': '0', 'PodGPUTypes': '', 'PodLabels': ''})
-      for c in [12,48]:
-        self.available_clusters['%i;%i;8000000;;%i;;'%(c,c*2048,c/3)] = \
-           provisioner_lancium_clustering.ProvisionerLanciumCluster('%i;%i;8000000;;%i;;'%(c,c*2048,c/3), \
-           ["%i"%c, "%i"%(c*2048), '8000000', '', "%i"%(c/3), '', ''], \
-           {'PodCPUs': "%i"%c, 'PodMemory': "%i"%(c*2048), 'PodDisk': '8000000', 'PodDiskVolumes': '', 'PodGPUs': "%i"%(c/3), 'PodGPUTypes': '', 'PodLabels': ''})
-      self.known_finished = {}
+      for shape in pod_shapes:
+         cluster = provisioner_pod_shapes.new_pod_cluster(shape)
+         self.available_clusters[cluster.key] = cluster
+      # pod shapes sorted from the cheapest, with their costs, for quick matching
+      self.available_cluster_keys=list(self.available_clusters.keys())
+      self.available_cluster_keys.sort(key=lambda k: self.available_clusters[k].resources.sort_key())
+      self.available_cluster_costs=[self.available_clusters[k].resources.cost() for k in self.available_cluster_keys]
+      # summary of the last one_iteration call, see _new_iteration_stats
+      self.last_iteration_stats = None
+      self.known_finished = provisioner_lancium_finished.ProvisionerLanciumFinishedTracker(max_known_finished)
+      if cleanup_obj!=None:
+         self.cleanup_obj = cleanup_obj
+      else:
+         self.cleanup_obj = provisioner_lancium_cleanup.ProvisionerLanciumCleanup(lancium_obj)
+      if metrics_obj!=None:
+         self.metrics = metrics_obj
+      else:
+         # nobody will look at it, but it keeps the code simpler
+         self.metrics = provisioner_metrics.ProvisionerMetrics()
+      self.snapshot_obj = snapshot_obj
+      if pod_planner=='binpack':
+         self.planner = provisioner_planner.ProvisionerBinPackPlanner()
+      elif pod_planner=='heuristic':
+         self.planner = None
+      else:
+         raise ValueError("Unknown pod_planner '%s'"%pod_planner)
+      if forecast_obj!=None:
+         self.forecast = forecast_obj
+      else:
+         self.forecast = provisioner_forecast.ProvisionerDemandForecast()
+      self.scale_down_margin = scale_down_margin
+      self.scale_down_delay = scale_down_delay
+      self.surplus_history = {} # cluster id -> surplus in the last iterations, all >0
+      self.checkpoint_obj = checkpoint_obj
+      self.shed_pods = {} # cluster id -> pods not submitted because of throttling, in the last iteration
 
    def query_system(self):
       schedd_attrs = provisioner_clustering.ProvisionerClusteringAttributes().get_schedd_attributes()
-      try:
-         schedd_jobs = self.schedd.query_idle(projection=schedd_attrs)
-         startd_pods = self.collector.query()
-      except:
-         self.log_obj.log_error("[ProvisionerEventQuery] Failed to query HTCondor")
-         self.log_obj.sync()
-         raise
+      if self.concurrent_queries:
+         (schedd_jobs, startd_pods, lancium_pods) = self._query_sources_concurrent(schedd_attrs)
+      else:
+         (schedd_jobs, startd_pods, lancium_pods) = self._query_sources_serial(schedd_attrs)
       del schedd_attrs
 
-      try:
-         lancium_pods = self.lancium_obj.query()
-      except:
-         self.log_obj.log_error("[ProvisionerEventQuery] Failed to query lancium")
-         self.log_obj.sync()
-         raise
+      if self.snapshot_obj!=None:
+         try:
+            self._timed_call('snapshot', self.snapshot_obj.record, schedd_jobs, startd_pods, lancium_pods)
+         except:
+            # not critical, just keep going
+            self.log_obj.log_error("[ProvisionerEventQuery] Failed to record snapshot")
 
+      start_time = time.time()
       clustering = provisioner_lancium_clustering.ProvisionerLanciumClustering()
       schedd_clusters = clustering.cluster_schedd_jobs(schedd_jobs)
       lancium_clusters = clustering.cluster_lancium_pods(lancium_pods, startd_pods)
+      self._record_phase('clustering', time.time()-start_time)
 
       return (schedd_clusters, lancium_clusters)
 
    def one_iteration(self):
+      self.last_iteration_stats = self._new_iteration_stats()
       try:
         (schedd_clusters, lancium_clusters) = self.query_system()
       except:
          self.log_obj.log_error("[ProvisionerEventLoop] Failed to query")
          self.log_obj.sync()
          return
+      self.provision(self._match_clusters(schedd_clusters), lancium_clusters)
+
+   def provision(self, matched_clusters, lancium_clusters):
+      """Submit, cancel and clean up pods, based on an already observed and matched system state
+         matched_clusters is a dictionary of pod cluster key -> list of schedd clusters
+         lancium_clusters is a dictionary of pod cluster key -> ProvisionerLanciumCluster
+         Used by one_iteration, and by ProvisionerSupervisor, which does the observation for many loops"""
+      stats = self._new_iteration_stats()
+      stats['ok'] = True
+      self.last_iteration_stats = stats
 
-      available_cluster_keys=list(self.available_clusters.keys())
-      available_cluster_keys.sort(key=cluster_val)
-      for ckey in available_cluster_keys:
+      start_time = time.time()
+      pods_wanted = {} # cluster id -> number of unclaimed pods we want, None if unknown
+      # the clusters that were throttled last time go first, so they get the submission budget
+      last_shed = self.shed_pods
+      self.shed_pods = {}
+      provision_order = [k for k in self.available_cluster_keys if k in last_shed] + \
+                        [k for k in self.available_cluster_keys if k not in last_shed]
+      for ckey in provision_order:
          lancium_cluster = lancium_clusters[ckey] if ckey in lancium_clusters else self.available_clusters[ckey]
          schedd_cluster = None
-         skeys=list(schedd_clusters.keys())
-         skeys.sort(key=cluster_val)
-         for skey in skeys:
-            if cluster_val(skey)<=cluster_val(ckey):
+         job_groups = []
+         if ckey in matched_clusters:
+            for el in matched_clusters[ckey]:
+               # the planner needs the requests of each group, before they get merged
+               job_groups.append((el.resources, el.count_idle()))
                if schedd_cluster==None:
-                 schedd_cluster=schedd_clusters[skey]
+                 schedd_cluster=el
                else:
-                 schedd_cluster.append_list(schedd_clusters[skey].elements)
-               # we already processed it, we are done
-               del schedd_clusters[skey]
-             # ignore all others
+                 schedd_cluster.append_list(el.elements)
          try:
+            # keep the history of all the clusters, including the ones with no demand right now
+            self.forecast.update(ckey, sum([n for (r,n) in job_groups]),
+                                 [pod['Name'] for pod in lancium_cluster.get_waiting_pods()],
+                                 [pod['Name'] for pod in lancium_cluster.get_started_pods()])
+            forecast = self.forecast.get_forecast(ckey)
+            if forecast['arrival_rate']>0:
+               self.log_obj.log_debug("[ProvisionerEventLoop] Cluster '%s' forecast arrival_rate %.4f/s start_latency %is (%i samples) predicted_jobs %i"%
+                                      (ckey, forecast['arrival_rate'], forecast['start_latency'], forecast['n_latency_samples'], forecast['predicted_jobs']))
+            del forecast
+            pods_wanted[ckey] = None
             if schedd_cluster!=None:
-               self._provision_cluster(ckey, schedd_cluster, lancium_cluster )
+               pods_wanted[ckey] = self._provision_cluster(ckey, schedd_cluster, lancium_cluster, job_groups)
+            else:
+               pods_wanted[ckey] = 0
          except:
             self.log_obj.log_debug("[ProvisionerEventLoop] Exception in cluster '%s'"%ckey)
 
+      # now cancel the pods we do not need anymore
+      # including the ones of shapes we do not provision anymore
+      self._withdraw_cancels(lancium_clusters)
+      for ckey in lancium_clusters:
+         try:
+            n_pods_wanted = pods_wanted[ckey] if ckey in pods_wanted else 0
+            if n_pods_wanted!=None:
+               self._scale_down_cluster(ckey, lancium_clusters[ckey], n_pods_wanted)
+         except:
+            self.log_obj.log_debug("[ProvisionerEventLoop] Exception in scale-down of cluster '%s'"%ckey)
+      # forget the clusters that went away
+      for ckey in [k for k in self.surplus_history.keys() if k not in lancium_clusters]:
+         del self.surplus_history[ckey]
+
       self.log_obj.sync()
+      self._record_phase('provisioning', time.time()-start_time)
 
       #now do some cleanup
+      start_time = time.time()
+      # the actual deletion happens in the background, just collect what was done since last time
+      (deleted_ids, n_delete_failed) = self.cleanup_obj.collect_results()
+      for lancium_job in deleted_ids:
+         self.known_finished.remove(lancium_job)
+      if (len(deleted_ids)+n_delete_failed)>0:
+         self.log_obj.log_info("[ProvisionerEventLoop] Deleted %i pods, failed %i, %i still pending"%
+                               (len(deleted_ids), n_delete_failed, self.cleanup_obj.count_pending()))
+      self.metrics.inc_counter('deleted_pods_total', len(deleted_ids), help="Number of Lancium jobs deleted")
+      self.metrics.inc_counter('failed_deletions_total', n_delete_failed, help="Number of failed Lancium job deletions")
+      del deleted_ids
+
+      # then forget about any jobs that are not reported as finished anymore
+      all_finished = []
+      for ckey in lancium_clusters:
+         all_finished += lancium_clusters[ckey].get_finished()
+      self.known_finished.retain(all_finished)
+      del all_finished
+
       for ckey in lancium_clusters:
          lancium_cluster = lancium_clusters[ckey]
          self._cleanup_cluster(ckey,lancium_cluster)
 
+      self.log_obj.log_debug("[ProvisionerEventLoop] Tracking %i finished pods (%i not tracked, max %i)"%
+                             (self.known_finished.get_size(), self.known_finished.n_rejected, self.known_finished.max_size))
+      self.log_obj.sync()
+      self._record_phase('cleanup', time.time()-start_time)
+      self._record_cluster_metrics(lancium_clusters)
+
+      if self.checkpoint_obj!=None:
+         try:
+            self._timed_call('checkpoint', self.checkpoint_obj.save, self.get_state())
+         except:
+            # not critical, we will try again next time
+            self.log_obj.log_error("[ProvisionerEventLoop] Failed to save checkpoint")
+            self.log_obj.sync()
+
+   def get_state(self):
+      "Returns the state worth keeping across restarts, as a JSON-friendly dictionary"
+      return {'known_finished': self.known_finished.get_counts(),
+              'pending_deletions': self.cleanup_obj.get_pending(),
+              'surplus_history': self.surplus_history,
+              'forecast': self.forecast.get_state(),
+              'lancium_naming': self.lancium_obj.get_naming_state()}
+
+   def restore_checkpoint(self):
+      """Reload the state saved in checkpoint_obj, after validating it against the current Lancium jobs
+         Returns True if a state was restored"""
+      if self.checkpoint_obj==None:
+         return False
+      (state, is_stale) = self.checkpoint_obj.load()
+      if state==None:
+         self.log_obj.log_info("[ProvisionerEventLoop] No checkpoint found, starting fresh")
+         return False
+
+      lancium_pods = self.lancium_obj.query()
+      pod_status = {}
+      for pod in lancium_pods:
+         pod_status[pod['lancium-id']] = "%s"%pod['Status']
+      pod_names = set([pod['Name'] for pod in lancium_pods])
+
+      # only the jobs that are still finished
+      known_finished = state['known_finished']
+      self.known_finished.set_counts(dict([(k, known_finished[k]) for k in known_finished
+                                           if pod_status.get(k) in ("finished","error")]))
+      # never delete a job that started running in the meantime
+      # and only cancel waiting ones if the decision is recent
+      deletable = ("finished","error") if is_stale else ("finished","error","submitted","queued")
+      n_requeued = 0
+      for lancium_id in state['pending_deletions']:
+         status = pod_status.get(lancium_id)
+         if status not in deletable:
+            continue
+         if status in ("submitted","queued"):
+            # withdrawn at the next iteration if it started in the meantime
+            queued = self.cleanup_obj.enqueue_cancel(lancium_id)
+         else:
+            queued = self.cleanup_obj.enqueue(lancium_id)
+         if queued:
+            n_requeued += 1
+      # the recent history is only useful if the checkpoint is recent
+      if not is_stale:
+         self.surplus_history = state['surplus_history']
+      self.forecast.set_state(state['forecast'], pod_names, keep_rates=(not is_stale))
+      self.lancium_obj.set_naming_state(state['lancium_naming'], pod_names)
+
+      self.log_obj.log_info("[ProvisionerEventLoop] Restored checkpoint%s: %i finished pods, %i pending deletions"%
+                            (" (stale)" if is_stale else "", self.known_finished.get_size(), n_requeued))
       self.log_obj.sync()
+      return True
 
 
    # INTERNAL
-   def _provision_cluster(self, cluster_id, schedd_cluster, lancium_cluster):
-      "Check if we have enough lancium clusters. Submit more if needed"
+   def _match_clusters(self, schedd_clusters):
+      """Assign each schedd cluster to the smallest pod shape it fits in
+         Returns a dictionary of pod cluster key -> list of schedd clusters"""
+      cluster_resources = dict([(k, self.available_clusters[k].resources) for k in self.available_cluster_keys])
+      return match_clusters(schedd_clusters, self.available_cluster_keys, self.available_cluster_costs, cluster_resources,
+                            self.log_obj)
+
+   # INTERNAL
+   def _record_phase(self, phase, duration):
+      self.metrics.set_gauge('last_phase_seconds', duration, {'phase':phase}, help="Duration of each phase in the last iteration")
+      self.metrics.observe('phase_seconds', duration, {'phase':phase}, help="Time spent in each phase")
+
+   # INTERNAL
+   def _timed_call(self, phase, func, *args, **kwargs):
+      "Call func and record how long it took, even if it fails"
+      start_time = time.time()
+      try:
+         return func(*args, **kwargs)
+      finally:
+         self._record_phase(phase, time.time()-start_time)
+
+   # INTERNAL
+   def _record_cluster_metrics(self, lancium_clusters):
+      pod_states = []
+      for ckey in lancium_clusters:
+         statearr = lancium_clusters[ckey].count_states()
+         for i in range(5):
+            pod_states.append(({'cluster':ckey, 'state':ProvisionerEventLoopPodStates[i]}, statearr[i]))
+      self.metrics.set_gauge_family('cluster_pods', pod_states, help="Number of Lancium pods per cluster and state")
+      self.metrics.set_gauge_family('cluster_idle_jobs', self.last_iteration_stats['cluster_jobs_idle'],
+                                    help="Number of idle jobs matched to each cluster")
+      forecasts = [(ckey, self.forecast.get_forecast(ckey)) for ckey in self.available_cluster_keys]
+      self.metrics.set_gauge_family('forecast_arrival_rate', [({'cluster':ckey}, f['arrival_rate']) for (ckey,f) in forecasts],
+                                    help="Smoothed idle job arrivals per second")
+      self.metrics.set_gauge_family('forecast_start_latency_seconds', [({'cluster':ckey}, f['start_latency']) for (ckey,f) in forecasts],
+                                    help="Smoothed time between pod submission and advertising")
+      self.metrics.set_gauge_family('forecast_jobs', [({'cluster':ckey}, f['predicted_jobs']) for (ckey,f) in forecasts],
+                                    help="Idle jobs expected to arrive while a new pod starts")
+      self.metrics.set_gauge('known_finished_pods', self.known_finished.get_size(), help="Number of finished pods being tracked")
+      self.metrics.set_gauge('pending_deletions', self.cleanup_obj.count_pending(), help="Number of pods waiting to be deleted")
+
+   # INTERNAL
+   def _new_iteration_stats(self):
+      return {'ok': False,           # False if the system could not be queried
+              'n_jobs_idle': 0,      # sum over all provisioned clusters
+              'n_pods_unclaimed': 0, # sum over all provisioned clusters
+              'n_pods_submitted': 0,
+              'n_pods_failed': 0,    # failed submissions
+              'n_pods_cancelled': 0, # surplus pods queued for deletion
+              'n_pods_shed': 0,      # not submitted because of throttling, retried at the next iteration
+              'n_jobs_predicted': 0, # sum over all provisioned clusters, see ProvisionerDemandForecast
+              'cluster_jobs_idle': []} # list of ({'cluster':cluster_id},n_jobs_idle)
+
+   # INTERNAL
+   def _query_sources_serial(self, schedd_attrs):
+      "Returns (schedd_jobs, startd_pods, lancium_pods)"
+      try:
+         schedd_jobs = self._timed_call('query_schedd', self.schedd.query_idle, projection=schedd_attrs)
+         startd_pods = self._timed_call('query_collector', self.collector.query)
+      except:
+         self.log_obj.log_error("[ProvisionerEventQuery] Failed to query HTCondor")
+         self.log_obj.sync()
+         raise
+
+      try:
+         lancium_pods = self._timed_call('query_lancium', self.lancium_obj.query)
+      except:
+         self.log_obj.log_error("[ProvisionerEventQuery] Failed to query lancium")
+         self.log_obj.sync()
+         raise
+
+      return (schedd_jobs, startd_pods, lancium_pods)
+
+   # INTERNAL
+   def _query_sources_concurrent(self, schedd_attrs):
+      """Returns (schedd_jobs, startd_pods, lancium_pods)
+         Same semantics as _query_sources_serial, but the three sources are queried in parallel"""
+      with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+         schedd_future = executor.submit(self._timed_call, 'query_schedd', self.schedd.query_idle, projection=schedd_attrs)
+         collector_future = executor.submit(self._timed_call, 'query_collector', self.collector.query)
+         lancium_future = executor.submit(self._timed_call, 'query_lancium', self.lancium_obj.query)
+
+         try:
+            schedd_jobs = schedd_future.result()
+            startd_pods = collector_future.result()
+         except:
+            self.log_obj.log_error("[ProvisionerEventQuery] Failed to query HTCondor")
+            self.log_obj.sync()
+            raise
+
+         try:
+            lancium_pods = lancium_future.result()
+         except:
+            self.log_obj.log_error("[ProvisionerEventQuery] Failed to query lancium")
+            self.log_obj.sync()
+            raise
+
+      return (schedd_jobs, startd_pods, lancium_pods)
+
+   # INTERNAL
+   def _provision_cluster(self, cluster_id, schedd_cluster, lancium_cluster, job_groups):
+      """Check if we have enough lancium clusters. Submit more if needed
+         job_groups is a list of (ProvisionerResources, n_jobs_idle), used by the planner
+         Returns the number of unclaimed pods we want"""
       n_jobs_idle = schedd_cluster.count_idle()
       if n_jobs_idle==0:
          self.log_obj.log_debug("[ProvisionerEventLoop] Cluster '%s' n_jobs_idle==0 found!"%cluster_id)
-         return # should never get in here, but just in case (nothing to do, we are done)
+         return 0 # should never get in here, but just in case (nothing to do, we are done)
 
-      # assume some latency and pod reuse
-      min_pods = 1 + int(n_jobs_idle/4)
-      if min_pods>20:
-         # when we have a lot of jobs, slow futher
-         min_pods = 20 + int((min_pods-20)/4)
-
-      if min_pods>self.max_pods_per_cluster:
-         min_pods = self.max_pods_per_cluster
+      # provision also for the jobs expected to arrive by the time the new pods start
+      n_jobs_predicted = self.forecast.predict_jobs(cluster_id)
+      if n_jobs_predicted>0:
+         # assume they will look like the current ones
+         job_groups = [(r, n+int(n*n_jobs_predicted/n_jobs_idle+0.5)) for (r,n) in job_groups]
 
       n_pods_statearr=lancium_cluster.count_states() if lancium_cluster!=None else (0,0,0,0,0)
       n_pods_waiting=n_pods_statearr[0]
@@ -127,49 +441,149 @@ class ProvisionerEventLoop:
       n_pods_unclaimed = n_pods_waiting+n_pods_unmatched
       n_pods_total = n_pods_unclaimed+n_pods_claimed
 
+      if self.planner!=None:
+         # the started pods can absorb part of the jobs, what does not fit needs waiting or new pods
+         n_pods_needed = self.planner.count_new_pods(lancium_cluster.resources, job_groups, lancium_cluster.get_free_capacity())
+         min_pods = n_pods_unmatched + n_pods_needed
+      else:
+         # assume some latency and pod reuse
+         min_pods = 1 + int((n_jobs_idle+n_jobs_predicted)/4)
+         if min_pods>20:
+            # when we have a lot of jobs, slow futher
+            min_pods = 20 + int((min_pods-20)/4)
+
+      if min_pods>self.max_pods_per_cluster:
+         min_pods = self.max_pods_per_cluster
+      n_pods_wanted = min_pods
+
       if n_pods_total>=self.max_submit_pods_per_cluster:
          min_pods = 0
 
-      self.log_obj.log_debug("[ProvisionerEventLoop] Cluster '%s' n_jobs_idle %i n_pods_unclaimed %i min_pods %i (pods wait %i unmatched %i claimed %i max %i)"%
-                             (cluster_id, n_jobs_idle, n_pods_unclaimed, min_pods, n_pods_waiting, n_pods_unmatched, n_pods_claimed, self.max_submit_pods_per_cluster))
+      stats = self.last_iteration_stats
+      stats['n_jobs_idle'] += n_jobs_idle
+      stats['n_pods_unclaimed'] += n_pods_unclaimed
+      stats['cluster_jobs_idle'].append(({'cluster':cluster_id}, n_jobs_idle))
+      stats['n_jobs_predicted'] += n_jobs_predicted
+
+      self.log_obj.log_debug("[ProvisionerEventLoop] Cluster '%s' n_jobs_idle %i n_jobs_predicted %i n_pods_unclaimed %i min_pods %i (pods wait %i unmatched %i claimed %i max %i)"%
+                             (cluster_id, n_jobs_idle, n_jobs_predicted, n_pods_unclaimed, min_pods, n_pods_waiting, n_pods_unmatched, n_pods_claimed, self.max_submit_pods_per_cluster))
       if n_pods_unclaimed>=min_pods:
          pass # we have enough pods, do nothing for now
          # we may want to do some sanity checks here, eventually
       else:
+         # never go over the total limit, even when submitting ahead
+         n_submit = min(min_pods-n_pods_unclaimed, self.max_submit_pods_per_cluster-n_pods_total)
          try:
             #unlike the PRP provisioner, we provision multi-job slots, so use slot attrs
-            job_name = self.lancium_obj.submit(lancium_cluster.get_attr_dict(), min_pods-n_pods_unclaimed)
-            self.log_obj.log_info("[ProvisionerEventLoop] Cluster '%s' Submitted %i pods, last job name is %s"% 
-                                  (cluster_id,min_pods-n_pods_unclaimed, job_name))
+            results = self.lancium_obj.submit(lancium_cluster.get_attr_dict(), n_submit)
          except:
             self.log_obj.log_error("[ProvisionerEventLoop] Cluster '%s' Failed to submit %i pods"%
-                                   (cluster_id,min_pods-n_pods_unclaimed))
+                                   (cluster_id,n_submit))
+            stats['n_pods_failed'] += n_submit
+            self.metrics.inc_counter('failed_submissions_total', n_submit, {'cluster':cluster_id},
+                                     help="Number of failed Lancium pod submissions")
+            return n_pods_wanted
+
+         stats['n_pods_submitted'] += results.count_submitted()
+         stats['n_pods_failed'] += results.count_failed()
+         stats['n_pods_shed'] += results.count_shed()
+         self.metrics.inc_counter('submitted_pods_total', results.count_submitted(), {'cluster':cluster_id},
+                                  help="Number of Lancium pods submitted")
+         self.metrics.inc_counter('failed_submissions_total', results.count_failed(), {'cluster':cluster_id},
+                                  help="Number of failed Lancium pod submissions")
 
-      return
+         if results.count_submitted()>0:
+            self.log_obj.log_info("[ProvisionerEventLoop] Cluster '%s' Submitted %i pods, last job name is %s"%
+                                  (cluster_id, results.count_submitted(), results.get_last_job_name()))
+         if results.count_failed()>0:
+            self.log_obj.log_error("[ProvisionerEventLoop] Cluster '%s' Failed to submit %i of %i pods, first error: %s"%
+                                   (cluster_id, results.count_failed(), n_submit, results.get_first_error()))
+         if results.count_shed()>0:
+            # the demand is re-evaluated at the next iteration, so they will be submitted then, if still needed
+            self.shed_pods[cluster_id] = results.count_shed()
+            self.metrics.inc_counter('shed_submissions_total', results.count_shed(), {'cluster':cluster_id},
+                                     help="Number of Lancium pod submissions deferred because of throttling")
+            self.log_obj.log_info("[ProvisionerEventLoop] Cluster '%s' Deferred %i of %i pods to the next iteration, Lancium is throttled"%
+                                  (cluster_id, results.count_shed(), n_submit))
+
+      return n_pods_wanted
+
+   # INTERNAL
+   def _withdraw_cancels(self, lancium_clusters):
+      "Never delete a pod that started running since it was queued for cancellation"
+      cancelable_ids = []
+      for ckey in lancium_clusters:
+         for pod in lancium_clusters[ckey].get_waiting_pods():
+            if "%s"%pod['Status'] in ("submitted","queued"):
+               cancelable_ids.append(pod['lancium-id'])
+      n_withdrawn = self.cleanup_obj.retain_cancels(cancelable_ids)
+      if n_withdrawn>0:
+         self.log_obj.log_info("[ProvisionerEventLoop] Withdrew %i cancellations of pods that are not waiting anymore"%n_withdrawn)
+         self.metrics.inc_counter('withdrawn_cancellations_total', n_withdrawn,
+                                  help="Number of pod cancellations withdrawn because the pod started")
+
+   # INTERNAL
+   def _scale_down_cluster(self, cluster_id, lancium_cluster, n_pods_wanted):
+      """Cancel the newest pods that did not start yet, if we had more than wanted
+         for scale_down_delay iterations in a row"""
+      if self.scale_down_delay<=0:
+         return # disabled
+
+      n_pods_statearr=lancium_cluster.count_states()
+      n_pods_unclaimed = n_pods_statearr[0]+n_pods_statearr[1]
+      # only the ones that are not running yet can be cancelled
+      cancelable = []
+      for pod in lancium_cluster.get_waiting_pods():
+         if self.cleanup_obj.is_pending(pod['lancium-id']):
+            # already being cancelled
+            n_pods_unclaimed -= 1
+         elif "%s"%pod['Status'] in ("submitted","queued"):
+            cancelable.append(pod)
+
+      n_surplus = min(n_pods_unclaimed-n_pods_wanted-self.scale_down_margin, len(cancelable))
+      if n_surplus<=0:
+         if cluster_id in self.surplus_history:
+            del self.surplus_history[cluster_id]
+         return
+
+      history = self.surplus_history[cluster_id] if cluster_id in self.surplus_history else []
+      history = (history+[n_surplus])[-self.scale_down_delay:]
+      if len(history)<self.scale_down_delay:
+         self.surplus_history[cluster_id] = history
+         return
+      # start over after each cancellation
+      del self.surplus_history[cluster_id]
+
+      # be conservative, only cancel what was surplus all the time
+      n_cancel = min(history)
+      # job names grow with submission time
+      cancelable.sort(key=lambda pod: pod['Name'], reverse=True)
+      count_queued = 0
+      for pod in cancelable[:n_cancel]:
+         if self.cleanup_obj.enqueue_cancel(pod['lancium-id']):
+            count_queued = count_queued + 1
+
+      self.last_iteration_stats['n_pods_cancelled'] += count_queued
+      self.metrics.inc_counter('cancelled_pods_total', count_queued, {'cluster':cluster_id},
+                               help="Number of surplus waiting pods queued for deletion")
+      if count_queued>0:
+         self.log_obj.log_info("[ProvisionerEventLoop] Cluster '%s' Cancelling %i surplus waiting pods (unclaimed %i wanted %i)"%
+                               (cluster_id, count_queued, n_pods_unclaimed, n_pods_wanted))
 
    # INTERNAL
    def _cleanup_cluster(self, cluster_id, lancium_cluster):
-      "Remove finished jobs"
-      count_deleted = 0
+      "Queue finished jobs for deletion"
+      count_queued = 0
       finished_jobs = lancium_cluster.get_finished()
       for lancium_job in finished_jobs:
-        if lancium_job in self.known_finished:
-           if self.known_finished[lancium_job]<10:
-              # still too new
-              self.known_finished[lancium_job] += 1
-           else:
-              # limit deletions, to not slow down the submissions too much
-              if count_deleted<=100:
-                try:
-                  if self.lancium_obj.delete_one(lancium_job):
-                    count_deleted = count_deleted + 1
-                except:
-                  pass
-                # ignore any that I could not delete, will retry at next iteration
-        else:
-           # do not delete immediately, but remember I saw it before
-           self.known_finished[lancium_job] = 1
-
-      if count_deleted>0:
-         self.log_obj.log_info("[ProvisionerEventLoop] Cluster '%s' Deleted %i finished pods"%(cluster_id,count_deleted))
+        # do not delete immediately, but remember I saw it before
+        if self.known_finished.increment(lancium_job)>10:
+           # any that fail to be deleted will be re-queued at next iteration
+           if self.cleanup_obj.enqueue(lancium_job):
+              count_queued = count_queued + 1
+
+      self.metrics.inc_counter('queued_deletions_total', count_queued, {'cluster':cluster_id},
+                               help="Number of finished pods queued for deletion")
+      if count_queued>0:
+         self.log_obj.log_debug("[ProvisionerEventLoop] Cluster '%s' Queued %i finished pods for deletion"%(cluster_id,count_queued))
 
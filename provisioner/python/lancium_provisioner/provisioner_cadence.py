@@ -0,0 +1,48 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Decide how long to wait between iterations
+#
+
+class ProvisionerAdaptiveCadence:
+   """Adaptive sleep time between event loop iterations.
+      Drop to the minimum when there is new demand, back off towards the maximum when steady."""
+
+   def __init__(self, min_sleep, max_sleep, backoff=1.5):
+      """
+      Arguments:
+         min_sleep: int
+             Shortest sleep time, in seconds
+         max_sleep: int
+             Longest sleep time, in seconds
+         backoff: float (Optional)
+             Sleep time multiplier applied after each steady iteration
+      """
+      self.min_sleep = min(min_sleep, max_sleep)
+      self.max_sleep = max_sleep
+      self.backoff = backoff
+      self.sleep_time = self.max_sleep
+      self.last_jobs_idle = 0
+
+   def next_sleep(self, stats):
+      """Return the number of seconds to sleep
+         stats is the ProvisionerEventLoop.last_iteration_stats dictionary"""
+      if (stats==None) or (not stats['ok']):
+         # something is wrong, do not make it worse by retrying too fast
+         self.sleep_time = self.max_sleep
+         return self.sleep_time
+
+      n_jobs_idle = stats['n_jobs_idle']
+      # still ramping up, or a new wave of jobs has arrived
+      # failed submissions alone do not count, retrying fast would make an overloaded Lancium worse
+      busy = (stats['n_pods_submitted']+stats['n_pods_shed'])>0 or \
+             n_jobs_idle>(self.last_jobs_idle*1.1+10)
+      self.last_jobs_idle = n_jobs_idle
+
+      if busy:
+         self.sleep_time = self.min_sleep
+      else:
+         self.sleep_time = min(self.max_sleep, int(self.sleep_time*self.backoff))
+      return self.sleep_time
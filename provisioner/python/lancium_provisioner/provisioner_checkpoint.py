@@ -0,0 +1,55 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Save the provisioner state, so it survives restarts
+#
+
+import os
+import json
+import time
+
+class ProvisionerCheckpoint:
+   """Keep the latest state in a JSON file.
+      The file is replaced atomically, so a crash never leaves a partial state behind."""
+
+   def __init__(self, fname, min_interval=60, max_age=3600):
+      """
+      Arguments:
+         fname: string
+             Name of the checkpoint file
+         min_interval: int (Optional)
+             Do not save more often than this, in seconds
+         max_age: int (Optional)
+             Older checkpoints are reported as stale, in seconds
+      """
+      self.fname = fname
+      self.min_interval = min_interval
+      self.max_age = max_age
+      self.last_save = 0
+
+   def save(self, state, force=False):
+      "Save the state dictionary, return False if skipped because of min_interval"
+      now = time.time()
+      if (not force) and ((now-self.last_save)<self.min_interval):
+         return False
+      tmp_fname = "%s.tmp"%self.fname
+      with open(tmp_fname, 'w') as fd:
+         json.dump({'time': now, 'state': state}, fd, separators=(',',':'))
+         fd.flush()
+         os.fsync(fd.fileno())
+      os.replace(tmp_fname, self.fname)
+      self.last_save = now
+      return True
+
+   def load(self):
+      """Returns (state, is_stale), or (None, True) if there is no valid checkpoint"""
+      try:
+         with open(self.fname, 'r') as fd:
+            checkpoint = json.load(fd)
+         state = checkpoint['state']
+         age = time.time()-checkpoint['time']
+      except:
+         return (None, True)
+      return (state, (age>self.max_age) or (age<0))
@@ -0,0 +1,130 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Forecast the demand, so we can submit pods ahead of it
+#
+
+import time
+
+class ProvisionerClusterForecast:
+   """Smoothed history of a single cluster"""
+
+   def __init__(self):
+      self.last_time = None
+      self.last_jobs_idle = 0
+      self.arrival_rate = 0.0    # new idle jobs per second
+      self.start_latency = None  # seconds from submission to advertising, None if never measured
+      self.n_latency_samples = 0
+      self.waiting_since = {}    # pod name -> first time seen waiting, None if unknown
+
+class ProvisionerDemandForecast:
+   """Exponential smoothing of the idle job arrivals and of the pod start latency, per cluster.
+      The jobs expected to arrive while a new pod starts are the ones worth submitting ahead for."""
+
+   def __init__(self, alpha=0.3, default_latency=300):
+      """
+      Arguments:
+         alpha: float (Optional)
+             Weight of the newest sample, between 0 and 1, 0 disables forecasting
+         default_latency: int (Optional)
+             Pod start latency to assume until one is measured, in seconds
+      """
+      self.alpha = alpha
+      self.default_latency = default_latency
+      self.clusters = {} # cluster id -> ProvisionerClusterForecast
+
+   def update(self, cluster_id, n_jobs_idle, waiting_pods, started_pods, now=None):
+      """Add the observations of this iteration
+         waiting_pods and started_pods are lists of pod names"""
+      if now==None:
+         now = time.time()
+      if cluster_id not in self.clusters:
+         self.clusters[cluster_id] = ProvisionerClusterForecast()
+      cf = self.clusters[cluster_id]
+      first_time = (cf.last_time==None)
+
+      if cf.last_time!=None:
+         dt = now-cf.last_time
+         if dt>0:
+            # we cannot see the jobs that started in the meantime, so this is a lower bound
+            arrivals = max(0, n_jobs_idle-cf.last_jobs_idle)
+            cf.arrival_rate = self.alpha*(arrivals/dt) + (1.0-self.alpha)*cf.arrival_rate
+      cf.last_time = now
+      cf.last_jobs_idle = n_jobs_idle
+
+      for name in started_pods:
+         if name in cf.waiting_since:
+            since = cf.waiting_since.pop(name)
+            if since!=None:
+               self._add_latency(cf, now-since)
+
+      waiting_since = {}
+      for name in waiting_pods:
+         if name in cf.waiting_since:
+            waiting_since[name] = cf.waiting_since[name]
+         else:
+            # pods already there when we started have an unknown submission time
+            waiting_since[name] = None if first_time else now
+      # this also forgets the pods that went away without ever starting
+      cf.waiting_since = waiting_since
+
+   def get_start_latency(self, cluster_id):
+      if (cluster_id not in self.clusters) or (self.clusters[cluster_id].start_latency==None):
+         return self.default_latency
+      return self.clusters[cluster_id].start_latency
+
+   def predict_jobs(self, cluster_id):
+      "Returns the number of idle jobs expected to arrive while a new pod starts"
+      if cluster_id not in self.clusters:
+         return 0
+      return int(self.clusters[cluster_id].arrival_rate*self.get_start_latency(cluster_id))
+
+   def get_forecast(self, cluster_id):
+      "Returns a dictionary with the current forecast, for inspection"
+      cf = self.clusters[cluster_id] if cluster_id in self.clusters else ProvisionerClusterForecast()
+      return {'arrival_rate': cf.arrival_rate,
+              'start_latency': self.get_start_latency(cluster_id),
+              'n_latency_samples': cf.n_latency_samples,
+              'n_pods_waiting': len(cf.waiting_since),
+              'predicted_jobs': self.predict_jobs(cluster_id)}
+
+   def get_state(self):
+      "Returns the history as a JSON-friendly dictionary, e.g. for checkpointing"
+      state = {}
+      for cluster_id in self.clusters:
+         cf = self.clusters[cluster_id]
+         state[cluster_id] = {'last_time': cf.last_time,
+                              'last_jobs_idle': cf.last_jobs_idle,
+                              'arrival_rate': cf.arrival_rate,
+                              'start_latency': cf.start_latency,
+                              'n_latency_samples': cf.n_latency_samples,
+                              'waiting_since': cf.waiting_since}
+      return state
+
+   def set_state(self, state, pod_names, keep_rates=True):
+      """Restore the history saved by get_state
+         Only the waiting pods in pod_names are kept.
+         If keep_rates is False, only the start latencies are restored."""
+      self.clusters = {}
+      for cluster_id in state:
+         cstate = state[cluster_id]
+         cf = ProvisionerClusterForecast()
+         cf.start_latency = cstate['start_latency']
+         cf.n_latency_samples = cstate['n_latency_samples']
+         if keep_rates:
+            cf.last_time = cstate['last_time']
+            cf.last_jobs_idle = cstate['last_jobs_idle']
+            cf.arrival_rate = cstate['arrival_rate']
+            waiting_since = cstate['waiting_since']
+            cf.waiting_since = dict([(name, waiting_since[name]) for name in waiting_since if name in pod_names])
+         self.clusters[cluster_id] = cf
+
+   # INTERNAL
+   def _add_latency(self, cf, latency):
+      if cf.start_latency==None:
+         cf.start_latency = latency
+      else:
+         cf.start_latency = self.alpha*latency + (1.0-self.alpha)*cf.start_latency
+      cf.n_latency_samples += 1
@@ -10,16 +10,26 @@
 import copy
 import re
 import time
-import subprocess
+import threading
+import concurrent.futures
 
 import provisioner_config_parser
+from . import provisioner_metrics
+from . import provisioner_lancium_backends
+from . import provisioner_throttle
+from . import provisioner_lancium_clustering
+# re-exported, for backwards compatibility
+from .provisioner_lancium_backends import ProvisionerLanciumError, ProvisionerLanciumTimeout
 
 ProvisionerLanciumConfigFields = ('condor_host',
                               'lancium_image',
                               'priority_class','priority_class_cpu','priority_class_gpu',
                               'labels_dict', 'envs_dict', 'pvc_volumes_dict',
                               'app_name','lancium_job_ttl',
-                              'additional_requirements')
+                              'additional_requirements',
+                              'submit_threads',
+                              'query_timeout','submit_timeout','delete_timeout',
+                              'backend','api_url','api_key_file','api_connections')
 
 class ProvisionerLanciumConfig:
    """Config fie for ProvisionerLancium"""
@@ -36,7 +46,15 @@ class ProvisionerLanciumConfig:
                 additional_volumes = {},
                 app_name = 'lancium-wn',
                 lancium_job_ttl = 24*3600, # clean after 1 day
-                additional_requirements = ""):
+                additional_requirements = "",
+                submit_threads = 8,
+                query_timeout = 300,
+                submit_timeout = 120,
+                delete_timeout = 60,
+                backend = 'lcli',
+                api_url = 'https://portal.lancium.com/api/v1',
+                api_key_file = '',
+                api_connections = 8):
       """
       Arguments:
          condor_host: string (Optional)
@@ -57,6 +75,18 @@ class ProvisionerLanciumConfig:
              Environment values to add to the container
          additional_volumes: dictionary of (volume,mount) pairs (Optional)
              Volumes to mount in the pod. Both volume and mount must be a dictionary.
+         submit_threads: int (Optional)
+             Max number of lcli job run processes to have in flight at any given time
+         query_timeout, submit_timeout, delete_timeout: int (Optional)
+             Max number of seconds an lcli show/run/delete can take before being killed
+         backend: string (Optional)
+             How to talk to Lancium, either lcli or rest
+         api_url: string (Optional)
+             Base URL of the Lancium REST API, only used by the rest backend
+         api_key_file: string (Optional)
+             File containing the Lancium API key, LANCIUM_API_KEY is used if empty
+         api_connections: int (Optional)
+             Max number of idle keep-alive connections to keep, only used by the rest backend
       """
       self.condor_host = copy.deepcopy(condor_host)
       self.lancium_image = copy.deepcopy(lancium_image)
@@ -70,6 +100,14 @@ class ProvisionerLanciumConfig:
       self.app_name = copy.deepcopy(app_name)
       self.lancium_job_ttl = lancium_job_ttl
       self.additional_requirements = copy.deepcopy(additional_requirements)
+      self.submit_threads = submit_threads
+      self.query_timeout = query_timeout
+      self.submit_timeout = submit_timeout
+      self.delete_timeout = delete_timeout
+      self.backend = copy.deepcopy(backend)
+      self.api_url = copy.deepcopy(api_url)
+      self.api_key_file = copy.deepcopy(api_key_file)
+      self.api_connections = api_connections
 
    def parse(self,
              dict,
@@ -86,13 +124,78 @@ class ProvisionerLanciumConfig:
       self.app_name = provisioner_config_parser.update_parse(self.app_name, 'app_name', 'str', fields, dict)
       self.lancium_job_ttl = provisioner_config_parser.update_parse(self.lancium_job_ttl, 'lancium_job_ttl', 'int', fields, dict)
       self.additional_requirements = provisioner_config_parser.update_parse(self.additional_requirements, 'additional_requirements', 'str', fields, dict)
+      self.submit_threads = provisioner_config_parser.update_parse(self.submit_threads, 'submit_threads', 'int', fields, dict)
+      self.query_timeout = provisioner_config_parser.update_parse(self.query_timeout, 'query_timeout', 'int', fields, dict)
+      self.submit_timeout = provisioner_config_parser.update_parse(self.submit_timeout, 'submit_timeout', 'int', fields, dict)
+      self.delete_timeout = provisioner_config_parser.update_parse(self.delete_timeout, 'delete_timeout', 'int', fields, dict)
+      self.backend = provisioner_config_parser.update_parse(self.backend, 'backend', 'str', fields, dict)
+      self.api_url = provisioner_config_parser.update_parse(self.api_url, 'api_url', 'str', fields, dict)
+      self.api_key_file = provisioner_config_parser.update_parse(self.api_key_file, 'api_key_file', 'str', fields, dict)
+      self.api_connections = provisioner_config_parser.update_parse(self.api_connections, 'api_connections', 'int', fields, dict)
+
+def create_backend(config, metrics_obj=None):
+   "Create the backend selected in the ProvisionerLanciumConfig object"
+   if config.backend=='lcli':
+      return provisioner_lancium_backends.ProvisionerLanciumLcliBackend(
+                config.query_timeout, config.submit_timeout, config.delete_timeout, metrics_obj)
+   elif config.backend=='rest':
+      api_key = provisioner_lancium_backends.read_api_key(config.api_key_file)
+      return provisioner_lancium_backends.ProvisionerLanciumRESTBackend(
+                config.api_url, api_key,
+                config.query_timeout, config.submit_timeout, config.delete_timeout,
+                max(config.api_connections, config.submit_threads), metrics_obj)
+   else:
+      raise ValueError("Unknown Lancium backend '%s'"%config.backend)
+
+# Lancium jobs in these states will never come back, so no need to track them
+ProvisionerLanciumGoneStates = ('delete pending', 'deleted')
+
+class ProvisionerLanciumThrottled(ProvisionerLanciumError):
+   """The operation was not attempted, because Lancium is being throttled"""
+   pass
+
+class ProvisionerLanciumSubmitResults:
+   """Per-pod results of a ProvisionerLancium.submit call"""
+
+   def __init__(self):
+      self.submitted = [] # job names, in submission order
+      self.failed = []    # (job_name, error string) pairs
+      self.n_shed = 0     # not attempted because of throttling
+
+   def count_submitted(self):
+      return len(self.submitted)
+
+   def count_failed(self):
+      return len(self.failed)
+
+   def get_last_job_name(self):
+      return self.submitted[-1] if len(self.submitted)>0 else "None"
+
+   def count_shed(self):
+      return self.n_shed
+
+   def get_first_error(self):
+      return self.failed[0][1] if len(self.failed)>0 else ""
 
 class ProvisionerLancium:
    """Kubernetes Query interface"""
 
-   def __init__(self, config):
+   def __init__(self, config, metrics_obj=None, backend_obj=None, throttle_obj=None):
+      """
+      Arguments:
+         config: object
+             ProvisionerLanciumConfig object
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object, used to report lcli or API call counts and latencies
+         backend_obj: object (Optional)
+             Backend object, see provisioner_lancium_backends, created from config if None
+         throttle_obj: object (Optional)
+             ProvisionerLanciumThrottle object, shared by all operations, no rate limit if None
+      """
       self.start_time = int(time.time())
       self.submitted = 0
+      # protects self.submitted, since submit uses multiple threads
+      self.submitted_lock = threading.Lock()
       # TODO: Put it into the config
       self.image_startup_script="/usr/local/sbin/supervisord_startup.sh"
       # use deepcopy to avoid surprising changes at runtime
@@ -108,61 +211,178 @@ class ProvisionerLancium:
       self.additional_envs = copy.deepcopy(config.additional_envs)
       self.additional_volumes = copy.deepcopy(config.additional_volumes)
       self.additional_requirements = copy.deepcopy(config.additional_requirements)
+      self.submit_threads = max(1, config.submit_threads)
+      self.query_timeout = config.query_timeout
+      self.submit_timeout = config.submit_timeout
+      self.delete_timeout = config.delete_timeout
+      # only jobs with this label prefix are mine
+      self.label_prefix = 'lancium-app:%s lancium-job:'%self.app_name
+      # incrementally updated by query
+      self.inventory = {}
+      self.metrics = metrics_obj if metrics_obj!=None else provisioner_metrics.ProvisionerMetrics()
+      self.backend = backend_obj if backend_obj!=None else create_backend(config, self.metrics)
+      if throttle_obj!=None:
+         self.throttle = throttle_obj
+      else:
+         # still protect Lancium with the circuit breaker
+         self.throttle = provisioner_throttle.ProvisionerLanciumThrottle(metrics_obj=self.metrics)
       return
 
    def query(self):
-      """Return the list of jobs"""
+      """Return the list of jobs
+         The returned dictionaries are cached between calls, so treat them as read-only."""
 
       pods=[]
-
-      process = subprocess.Popen(['lcli','job','show', '-f', 'csv'],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      stdout, stderr = process.communicate()
-      if process.returncode!=0:
-        raise OSError("Failed to query Lancium jobs")
-
-      idxs={}
-      isfirst=True
-      for rline in stdout.splitlines():
-        line=rline.decode()
-        larr=line.strip().split(",")
-        if len(larr)!=3:
-           continue # should never get in here, but just in case
-
-        if isfirst:
-          isfirst=False
-          for i in range(3):
-            idxs[larr[i]]=i
-          continue # just build the idxs
-
-        label_str=larr[idxs['name']]
-        if label_str.startswith('lancium-app:%s lancium-job:'%self.app_name):
-          larr=line.strip().split(",")
-          if len(larr)!=3:
-            continue # should never get in here, but just in case
-          pod_id=larr[idxs['id']]
-          pod_status=larr[idxs['status']]
-          label_list=label_str.split()
-          podattrs={'lancium-id':pod_id, 'Status':pod_status}
-          for el in label_list:
-             elarr=el.split(":",1)
-             if len(elarr)!=2:
-               continue #ignore malformed entries
-             podattrs[elarr[0]]=elarr[1]
-          podattrs['Name']=podattrs['lancium-job']
-          pods.append(podattrs)
-
+      # lancium-id -> ((name,status),podattrs) for my jobs, lancium-id -> None for jobs to ignore
+      inventory={}
+
+      if not self.throttle.acquire(self.query_timeout):
+         raise ProvisionerLanciumThrottled("Lancium job query throttled")
+      # the backend raises if the query fails, so we never get to use a partial inventory
+      for (pod_id, label_str, pod_status) in self._throttled_iter(self.backend.list_jobs()):
+         if pod_id in self.inventory:
+            cached=self.inventory[pod_id]
+            if cached==None:
+               # not mine or already gone, and that never changes
+               inventory[pod_id]=None
+               continue
+            if cached[0]==(label_str, pod_status):
+               # nothing changed, no need to re-parse
+               inventory[pod_id]=cached
+               pods.append(cached[1])
+               continue
+            del cached
+
+         podattrs=self._parse_job(pod_id, label_str, pod_status)
+         if podattrs==None:
+            inventory[pod_id]=None
+         else:
+            inventory[pod_id]=((label_str, pod_status),podattrs)
+            pods.append(podattrs)
+
+      # anything not reported anymore is implicitly dropped
+      self.inventory=inventory
       return pods
 
    def submit_one(self, attrs):
+      "Submit one Lancium job, return its job name"
+      job_name = self._new_job_name()
+      self._submit_named(attrs, job_name)
+      return job_name
+
+   def submit(self, attrs, n_pods=1):
+      """Submit n_pods Lancium jobs, using up to submit_threads concurrent backend calls.
+         Pods over the throttle limit are not submitted, and counted as shed.
+         Returns a ProvisionerLanciumSubmitResults object."""
+      results = ProvisionerLanciumSubmitResults()
+      if n_pods<=0:
+         return results
+      n_allowed = self.throttle.reserve(n_pods)
+      results.n_shed = n_pods-n_allowed
+      if n_allowed<=0:
+         return results
+
+      job_names = [self._new_job_name() for i in range(n_allowed)]
+      n_threads = min(n_allowed, self.submit_threads)
+      with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+         futures = [executor.submit(self._submit_throttled, attrs, job_name) for job_name in job_names]
+         for i in range(n_allowed):
+            try:
+               futures[i].result()
+               results.submitted.append(job_names[i])
+            except ProvisionerLanciumThrottled:
+               results.n_shed += 1
+            except Exception as e:
+               results.failed.append((job_names[i], ("%s"%e).strip()))
+      return results
+
+   def delete_one(self, lancium_id):
+      """Delete one Lancium job, return True if successful
+         Raises ProvisionerLanciumTimeout if the backend hangs
+         and ProvisionerLanciumThrottled if not attempted"""
+      if not self.throttle.acquire_delete(self.delete_timeout):
+         raise ProvisionerLanciumThrottled("Lancium job deletion throttled")
+      try:
+         ok = self.backend.delete_job(lancium_id)
+      except ProvisionerLanciumError:
+         self.throttle.record(False)
+         raise
+      if ok:
+         # a failed deletion is often just a job that is already gone, so it does not count against Lancium
+         self.throttle.record(True)
+      return ok
+
+   def get_naming_state(self):
+      "Returns the state used to generate unique job names, e.g. for checkpointing"
+      with self.submitted_lock:
+         return {'start_time': self.start_time, 'submitted': self.submitted}
+
+   def set_naming_state(self, state, job_names):
+      """Continue the job naming from a state returned by get_naming_state
+         job_names are the names of the existing jobs, used to make sure we never reuse one"""
+      prefix = '%s-%x-'%(self.app_name,state['start_time'])
+      submitted = state['submitted']
+      for job_name in job_names:
+         if job_name.startswith(prefix):
+            try:
+               submitted = max(submitted, int(job_name[len(prefix):],16)+1)
+            except ValueError:
+               pass # not one of ours
+      with self.submitted_lock:
+         self.start_time = state['start_time']
+         self.submitted = submitted
+
+   # INTERNAL
+   def _throttled_iter(self, jobs_iter):
+      "Pass through the backend results, reporting the outcome to the throttle"
+      try:
+         for el in jobs_iter:
+            yield el
+      except ProvisionerLanciumError:
+         self.throttle.record(False)
+         raise
+      self.throttle.record(True)
+
+   def _submit_throttled(self, attrs, job_name):
+      # stop early if too many of the previous submissions failed
+      if self.throttle.is_open():
+         raise ProvisionerLanciumThrottled("Lancium job submission throttled")
+      try:
+         self._submit_named(attrs, job_name)
+      except ProvisionerLanciumError:
+         self.throttle.record(False)
+         raise
+      self.throttle.record(True)
+
+   def _parse_job(self, pod_id, label_str, pod_status):
+      "Return the job attributes, or None if it is not one of my active jobs"
+      if not label_str.startswith(self.label_prefix):
+         return None
+      if pod_status in ProvisionerLanciumGoneStates:
+         return None # being deleted, nothing more to do with it
+      label_list=label_str.split()
+      podattrs={'lancium-id':pod_id, 'Status':pod_status}
+      for el in label_list:
+         elarr=el.split(":",1)
+         if len(elarr)!=2:
+           continue #ignore malformed entries
+         podattrs[elarr[0]]=elarr[1]
+      podattrs['Name']=podattrs['lancium-job']
+      return podattrs
+
+   def _new_job_name(self):
+      with self.submitted_lock:
+         job_name = '%s-%x-%06x'%(self.app_name,self.start_time,self.submitted)
+         self.submitted = self.submitted + 1
+      return job_name
+
+   def _submit_named(self, attrs, job_name):
+      "Launch a single Lancium job with the given name, raise ProvisionerLanciumError on failure"
       # first ensure that the basic int values are valid
       int_vals={}
       for k in ('CPUs','GPUs','Memory','Disk'):
          int_vals[k] = int(attrs[k])
 
-      job_name = '%s-%x-%06x'%(self.app_name,self.start_time,self.submitted)
-      self.submitted = self.submitted + 1
-
       labels = [
                  'lancium-app:%s'%self.app_name,
                  'lancium-job:%s'%job_name,
@@ -172,6 +392,10 @@ class ProvisionerLancium:
                  'PodMemory:%i'%int_vals['Memory'],
                  'PodDisk:%i'%int_vals['Disk']
                ]
+      gpu_type = attrs['GPUTypes'] if 'GPUTypes' in attrs else ''
+      if (int_vals['GPUs']>0) and (gpu_type!=''):
+         # so that the pod is clustered with the right shape
+         labels.append('PodGPUTypes:%s'%gpu_type)
       # TODO: Handle any optional labels
       #for k in self.additional_labels.keys():
       #   labels[k] = copy.copy(self.additional_labels[k])
@@ -185,7 +409,7 @@ class ProvisionerLancium:
             }
       if int(int_vals['GPUs'])>0:
          req['gpu-count'] = '%i'%int(int_vals['GPUs'])
-         req['gpu'] = 'k80'
+         req['gpu'] = gpu_type if gpu_type!='' else provisioner_lancium_clustering.ProvisionerLanciumDefaultGPUType
 
       #TODO: Request Ephemeral storage
       env_list = [ ('LANCIUM_PROVISIONER_TYPE', 'PRPHTCondorProvisioner'),
@@ -220,43 +444,13 @@ class ProvisionerLancium:
       priority_class = self._get_priority_class(attrs)
       # TODO: use priority_class
 
-      # create the cmdline string (as a list first)
-      sh_slist=["lcli", "job", "run",\
-                "--name", label_str,\
-                "--command", cmd_str,\
-                "--image", self.lancium_image]
-      for el in volumes_raw.values():
-        sh_slist.append("--input-file")
-        sh_slist.append(el)
-      for k in req.keys():
-        el=req[k]
-        sh_slist.append("--%s"%k)
-        sh_slist.append(el)
-
-      process = subprocess.Popen(sh_slist,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      stdout, stderr = process.communicate()
-      if process.returncode!=0:
-        raise OSError("Failed to launch Lancium job: %s"%stderr.decode())
-      # TODO: Better error handling
-
-      return job_name
-
-   def submit(self, attrs, n_pods=1):
-      job_name="None"
-      for i in range(n_pods):
-        job_name=self.submit_one(attrs)
-      return job_name
-
-   def delete_one(self, lancium_id):
-      "Delete one Lancium job, return True if successful"
-      # create the cmdline string (as a list first)
-      sh_slist=["lcli", "job", "delete", "%s"%lancium_id]
-
-      process = subprocess.Popen(sh_slist,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      stdout, stderr = process.communicate()
-      return process.returncode==0
-
-   # INTERNAL
+      spec = {'name': label_str,
+              'command': cmd_str,
+              'image': self.lancium_image,
+              'input_files': list(volumes_raw.values()),
+              'resources': req}
+      self.backend.run_job(spec)
+      return
 
    # These can be re-implemented by derivative classes
    def _get_lancium_image(self, attrs):
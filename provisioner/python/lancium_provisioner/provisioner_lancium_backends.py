@@ -0,0 +1,343 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Ways of talking to Lancium, used by ProvisionerLancium
+#
+# A backend implements:
+#   list_jobs()        yields (id, name, status) triplets, raises on failure
+#   run_job(spec)      launches a job, raises ProvisionerLanciumError on failure
+#   delete_job(id)     returns True if successful
+# where spec is a dictionary with
+#   name, command, image: strings
+#   input_files: list of strings
+#   resources: dictionary, lcli option name -> value (mem, cores, gpu-count, gpu)
+#
+
+import os
+import json
+import time
+import queue
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+from . import provisioner_metrics
+
+class ProvisionerLanciumError(OSError):
+   """A Lancium operation failed"""
+   pass
+
+class ProvisionerLanciumTimeout(ProvisionerLanciumError):
+   """A Lancium operation did not complete in time, and was killed"""
+   pass
+
+class ProvisionerLanciumLcliBackend:
+   """Fork the lcli command line tool for every operation"""
+
+   def __init__(self, query_timeout=300, submit_timeout=120, delete_timeout=60, metrics_obj=None):
+      """
+      Arguments:
+         query_timeout, submit_timeout, delete_timeout: int (Optional)
+             Max number of seconds an lcli show/run/delete can take before being killed
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object, used to report lcli call counts and latencies
+      """
+      self.query_timeout = query_timeout
+      self.submit_timeout = submit_timeout
+      self.delete_timeout = delete_timeout
+      self.metrics = metrics_obj if metrics_obj!=None else provisioner_metrics.ProvisionerMetrics()
+
+   def list_jobs(self):
+      start_time = time.time()
+      process = subprocess.Popen(['lcli','job','show', '-f', 'csv'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+      # we are streaming the output, so we need an explicit timer to kill a hung lcli
+      timed_out = threading.Event()
+      def kill_hung():
+         timed_out.set()
+         process.kill()
+      timer = threading.Timer(self.query_timeout, kill_hung)
+      timer.start()
+      try:
+         idxs={}
+         isfirst=True
+         # parse as it streams in, instead of buffering the whole output
+         for rline in process.stdout:
+           line=rline.decode().strip()
+           larr=line.split(",")
+           if len(larr)!=3:
+              continue # should never get in here, but just in case
+
+           if isfirst:
+             isfirst=False
+             for i in range(3):
+               idxs[larr[i]]=i
+             continue # just build the idxs
+
+           yield (larr[idxs['id']], larr[idxs['name']], larr[idxs['status']])
+      finally:
+         process.stdout.close()
+         process.wait()
+         timer.cancel()
+
+      if timed_out.is_set():
+        self._record_lcli('show', start_time, 'timeout')
+        raise ProvisionerLanciumTimeout("Lancium job query timed out after %is"%self.query_timeout)
+      if process.returncode!=0:
+        self._record_lcli('show', start_time, 'error')
+        raise ProvisionerLanciumError("Failed to query Lancium jobs")
+      self._record_lcli('show', start_time, 'ok')
+
+   def run_job(self, spec):
+      # create the cmdline string (as a list first)
+      sh_slist=["lcli", "job", "run",\
+                "--name", spec['name'],\
+                "--command", spec['command'],\
+                "--image", spec['image']]
+      for el in spec['input_files']:
+        sh_slist.append("--input-file")
+        sh_slist.append(el)
+      req = spec['resources']
+      for k in req.keys():
+        sh_slist.append("--%s"%k)
+        sh_slist.append(req[k])
+
+      (returncode, stdout, stderr) = self._run_lcli(sh_slist, self.submit_timeout)
+      if returncode!=0:
+        raise ProvisionerLanciumError("Failed to launch Lancium job: %s"%stderr.decode())
+      # TODO: Better error handling
+
+   def delete_job(self, lancium_id):
+      sh_slist=["lcli", "job", "delete", "%s"%lancium_id]
+      (returncode, stdout, stderr) = self._run_lcli(sh_slist, self.delete_timeout)
+      return returncode==0
+
+   # INTERNAL
+   def _run_lcli(self, sh_slist, timeout):
+      """Run lcli and wait for it to finish, return (returncode,stdout,stderr)
+         Kill it and raise ProvisionerLanciumTimeout if it takes more than timeout seconds"""
+      op = sh_slist[2]
+      start_time = time.time()
+      process = subprocess.Popen(sh_slist,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      try:
+         stdout, stderr = process.communicate(timeout=timeout)
+      except subprocess.TimeoutExpired:
+         process.kill()
+         process.communicate()
+         self._record_lcli(op, start_time, 'timeout')
+         raise ProvisionerLanciumTimeout("lcli job %s timed out after %is"%(op,timeout))
+      self._record_lcli(op, start_time, 'ok' if process.returncode==0 else 'error')
+      return (process.returncode, stdout, stderr)
+
+   def _record_lcli(self, op, start_time, result):
+      self.metrics.inc_counter('lcli_calls_total', 1, {'op':op, 'result':result}, help="Number of lcli invocations")
+      self.metrics.observe('lcli_call_seconds', time.time()-start_time, {'op':op}, help="Time spent in lcli invocations")
+
+class ProvisionerHTTPPool:
+   """Thread-safe pool of keep-alive HTTP(S) connections to a single server"""
+
+   def __init__(self, url, max_idle=8):
+      """
+      Arguments:
+         url: string
+             Base URL, e.g. https://portal.lancium.com/api/v1
+         max_idle: int (Optional)
+             Max number of idle connections to keep open
+      """
+      parsed = urllib.parse.urlsplit(url)
+      self.is_https = (parsed.scheme=='https')
+      self.host = parsed.hostname
+      self.port = parsed.port
+      self.base_path = parsed.path.rstrip('/')
+      self.idle = queue.LifoQueue(maxsize=max(1,max_idle))
+      self.n_created = 0 # for monitoring connection reuse
+
+   def request(self, method, path, body=None, headers={}, timeout=60):
+      """Returns (status, response body as bytes)
+         Retries once on a fresh connection if a reused one went stale"""
+      for attempt in range(2):
+         (conn, reused) = self._get_conn(timeout)
+         try:
+            conn.request(method, self.base_path+path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+         except (http.client.HTTPException, ConnectionError) as e:
+            conn.close()
+            if reused and (attempt==0):
+               continue # the server likely closed it while idle
+            raise ProvisionerLanciumError("%s %s failed: %s"%(method, path, e))
+         except:
+            conn.close()
+            raise
+         if response.will_close:
+            conn.close()
+         else:
+            self._put_conn(conn)
+         return (response.status, data)
+
+   def close(self):
+      while True:
+         try:
+            self.idle.get_nowait().close()
+         except queue.Empty:
+            break
+
+   # INTERNAL
+   def _get_conn(self, timeout):
+      try:
+         conn = self.idle.get_nowait()
+         conn.timeout = timeout
+         if conn.sock!=None:
+            conn.sock.settimeout(timeout)
+         return (conn, True)
+      except queue.Empty:
+         pass
+      self.n_created += 1
+      if self.is_https:
+         conn = http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+      else:
+         conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+      return (conn, False)
+
+   def _put_conn(self, conn):
+      try:
+         self.idle.put_nowait(conn)
+      except queue.Full:
+         conn.close()
+
+class ProvisionerLanciumRESTBackend:
+   """Talk to the Lancium REST API directly, reusing keep-alive connections"""
+
+   def __init__(self, api_url, api_key, query_timeout=300, submit_timeout=120, delete_timeout=60,
+                max_connections=8, metrics_obj=None):
+      """
+      Arguments:
+         api_url: string
+             Base URL of the Lancium API
+         api_key: string
+             Lancium API key
+         query_timeout, submit_timeout, delete_timeout: int (Optional)
+             Max number of seconds a list/run/delete request can take
+         max_connections: int (Optional)
+             Max number of idle connections to keep, should match the number of submit threads
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object, used to report API call counts and latencies
+      """
+      self.pool = ProvisionerHTTPPool(api_url, max_connections)
+      self.headers = {'Authorization': 'Bearer %s'%api_key,
+                      'Accept': 'application/json',
+                      'Content-Type': 'application/json'}
+      self.query_timeout = query_timeout
+      self.submit_timeout = submit_timeout
+      self.delete_timeout = delete_timeout
+      self.metrics = metrics_obj if metrics_obj!=None else provisioner_metrics.ProvisionerMetrics()
+
+   def list_jobs(self):
+      data = self._call('show', 'GET', '/jobs', None, self.query_timeout)
+      for job in data['jobs']:
+         yield ("%s"%job['id'], job['name'], job['status'])
+
+   def run_job(self, spec):
+      req = spec['resources']
+      resources = {'core_count': int(req['cores']), 'memory': int(req['mem'])}
+      if 'gpu-count' in req:
+         resources['gpu_count'] = int(req['gpu-count'])
+         resources['gpu'] = req['gpu']
+      job = {'name': spec['name'],
+             'image': spec['image'],
+             'command_line': spec['command'],
+             'resources': resources,
+             'input_files': [{'source': el} for el in spec['input_files']]}
+      # the API has no bulk create, so this is a create followed by a submit
+      data = self._call('create', 'POST', '/jobs', {'job': job}, self.submit_timeout)
+      self._call('run', 'POST', '/jobs/%s/submit'%data['job']['id'], None, self.submit_timeout)
+
+   def delete_job(self, lancium_id):
+      try:
+         self._call('delete', 'DELETE', '/jobs/%s'%lancium_id, None, self.delete_timeout)
+      except ProvisionerLanciumTimeout:
+         raise
+      except ProvisionerLanciumError:
+         return False
+      return True
+
+   # INTERNAL
+   def _call(self, op, method, path, payload, timeout):
+      """Returns the decoded JSON response, raises ProvisionerLanciumError on failure"""
+      start_time = time.time()
+      body = json.dumps(payload) if payload!=None else None
+      try:
+         (status, data) = self.pool.request(method, path, body, self.headers, timeout)
+      except OSError as e:
+         # includes socket.timeout
+         if isinstance(e, ProvisionerLanciumError):
+            result = 'error'
+         elif 'timed out' in ("%s"%e):
+            result = 'timeout'
+         else:
+            result = 'error'
+         self._record_call(op, start_time, result)
+         if result=='timeout':
+            raise ProvisionerLanciumTimeout("Lancium API %s timed out after %is"%(op,timeout))
+         raise ProvisionerLanciumError("Lancium API %s failed: %s"%(op,e))
+      if (status<200) or (status>=300):
+         self._record_call(op, start_time, 'error')
+         raise ProvisionerLanciumError("Lancium API %s failed: HTTP %i %s"%(op, status, data.decode(errors='replace').strip()))
+      self._record_call(op, start_time, 'ok')
+      return json.loads(data.decode()) if len(data)>0 else {}
+
+   def _record_call(self, op, start_time, result):
+      self.metrics.inc_counter('lancium_api_calls_total', 1, {'op':op, 'result':result}, help="Number of Lancium API requests")
+      self.metrics.observe('lancium_api_call_seconds', time.time()-start_time, {'op':op}, help="Time spent in Lancium API requests")
+
+class ProvisionerLanciumSharedBackend:
+   """Wrap a backend, so that many ProvisionerLancium objects can share one job listing.
+      The first list_jobs after new_snapshot queries the wrapped backend,
+      the others get the same result, including the same failure."""
+
+   def __init__(self, backend_obj):
+      """
+      Arguments:
+         backend_obj: object
+             The backend doing the actual work, e.g. ProvisionerLanciumLcliBackend
+      """
+      self.backend = backend_obj
+      self.lock = threading.Lock()
+      self.jobs = None  # list of (id, name, status), None if not queried yet
+      self.error = None # exception raised by the last query, if any
+
+   def new_snapshot(self):
+      "Forget the cached listing, the next list_jobs will query again"
+      with self.lock:
+         self.jobs = None
+         self.error = None
+
+   def list_jobs(self):
+      with self.lock:
+         # only one query at a time, the others wait for its result
+         if (self.jobs==None) and (self.error==None):
+            try:
+               self.jobs = list(self.backend.list_jobs())
+            except Exception as e:
+               self.error = e
+         jobs = self.jobs
+         error = self.error
+      if error!=None:
+         raise error
+      return iter(jobs)
+
+   def run_job(self, spec):
+      self.backend.run_job(spec)
+
+   def delete_job(self, lancium_id):
+      return self.backend.delete_job(lancium_id)
+
+def read_api_key(api_key_file):
+   "Read the API key from the file, or from LANCIUM_API_KEY if no file is given"
+   if api_key_file!='':
+      with open(api_key_file, 'r') as fd:
+         return fd.read().strip()
+   return os.environ.get('LANCIUM_API_KEY','')
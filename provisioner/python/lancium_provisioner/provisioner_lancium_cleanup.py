@@ -0,0 +1,150 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Delete finished Lancium jobs in the background
+#
+
+import time
+import queue
+import threading
+import itertools
+
+# cancellations go first, a waiting pod may start running any time
+ProvisionerCleanupCancelPriority = 0
+ProvisionerCleanupDeletePriority = 1
+
+class ProvisionerLanciumCleanup:
+   """Background deletion of Lancium jobs.
+      Ids are queued by the event loop and deleted by a pool of worker threads.
+      Cancellations of waiting pods are deleted before finished jobs,
+      and can be withdrawn until their deletion starts."""
+
+   def __init__(self, lancium_obj, n_threads=4, max_rate=1.0, max_queued=10000):
+      """
+      Arguments:
+         lancium_obj: object
+             ProvisionerLancium object used for the actual deletion
+         n_threads: int (Optional)
+             Max number of concurrent deletions
+         max_rate: float (Optional)
+             Max number of deletions per second, 0 means no limit
+         max_queued: int (Optional)
+             Max number of ids waiting to be deleted
+      """
+      self.lancium_obj = lancium_obj
+      self.n_threads = max(1, n_threads)
+      self.min_interval = 1.0/max_rate if max_rate>0 else 0.0
+      self.max_queued = max_queued
+      # (priority, seq, lancium_id)
+      self.queue = queue.PriorityQueue()
+      # protects all the variables below
+      self.lock = threading.Lock()
+      self.seq = itertools.count()
+      self.pending = {} # queued or being deleted, lancium_id -> seq of its queue entry
+      self.cancels = set() # queued cancellations, not started yet
+      self.next_start = 0.0 # used for rate limiting
+      self.deleted_ids = [] # deleted since the last collect_results
+      self.n_failed = 0 # failed since the last collect_results
+      self.threads = []
+
+   def enqueue(self, lancium_id):
+      "Queue a finished job for deletion, return False if already pending or the queue is full"
+      return self._enqueue(lancium_id, ProvisionerCleanupDeletePriority)
+
+   def enqueue_cancel(self, lancium_id):
+      """Queue a waiting pod for deletion, ahead of the finished jobs
+         Return False if already pending or the queue is full"""
+      if not self._enqueue(lancium_id, ProvisionerCleanupCancelPriority):
+         return False
+      with self.lock:
+         self.cancels.add(lancium_id)
+      return True
+
+   def retain_cancels(self, lancium_ids):
+      """Withdraw the queued cancellations not in lancium_ids, e.g. because the pod started running
+         The ones already being deleted cannot be withdrawn.
+         Returns the number of withdrawn cancellations"""
+      keep = set(lancium_ids)
+      with self.lock:
+         withdrawn = [k for k in self.cancels if k not in keep]
+         for lancium_id in withdrawn:
+            self.cancels.discard(lancium_id)
+            # the queue entry will be skipped by the workers
+            del self.pending[lancium_id]
+      return len(withdrawn)
+
+   def is_pending(self, lancium_id):
+      with self.lock:
+         return lancium_id in self.pending
+
+   def count_pending(self):
+      with self.lock:
+         return len(self.pending)
+
+   def get_pending(self):
+      "Returns the list of ids queued or being deleted"
+      with self.lock:
+         return list(self.pending.keys())
+
+   def collect_results(self):
+      "Returns (deleted_ids, n_failed) since the last call"
+      with self.lock:
+         deleted_ids = self.deleted_ids
+         n_failed = self.n_failed
+         self.deleted_ids = []
+         self.n_failed = 0
+      return (deleted_ids, n_failed)
+
+   # INTERNAL
+   def _enqueue(self, lancium_id, priority):
+      with self.lock:
+         if (lancium_id in self.pending) or (len(self.pending)>=self.max_queued):
+            return False
+         seq = next(self.seq)
+         self.pending[lancium_id] = seq
+         if len(self.threads)==0:
+            self._start_threads()
+      self.queue.put((priority, seq, lancium_id))
+      return True
+
+   def _start_threads(self):
+      "Must be called with the lock held"
+      for i in range(self.n_threads):
+         t = threading.Thread(target=self._worker, name="lancium-cleanup-%i"%i)
+         # do not prevent the process from exiting
+         t.daemon = True
+         t.start()
+         self.threads.append(t)
+
+   def _worker(self):
+      while True:
+         (priority, seq, lancium_id) = self.queue.get()
+         with self.lock:
+            if self.pending.get(lancium_id)!=seq:
+               continue # withdrawn
+            # too late to withdraw it now
+            self.cancels.discard(lancium_id)
+         self._wait_rate()
+         try:
+            ok = self.lancium_obj.delete_one(lancium_id)
+         except:
+            ok = False
+         with self.lock:
+            del self.pending[lancium_id]
+            if ok:
+               self.deleted_ids.append(lancium_id)
+            else:
+               # will be re-queued by the event loop at the next iteration
+               self.n_failed += 1
+
+   def _wait_rate(self):
+      if self.min_interval<=0.0:
+         return
+      with self.lock:
+         now = time.time()
+         start = max(now, self.next_start)
+         self.next_start = start + self.min_interval
+      if start>now:
+         time.sleep(start-now)
@@ -9,75 +9,222 @@
 
 from provisioner_clustering import ProvisionerCluster,ProvisionerClustering
 
+def _to_int(val, default=0):
+   "Convert a clustering attribute value to int, using default if undefined or invalid"
+   try:
+      return int(float(val))
+   except ValueError:
+      return default
+
+# the GPU type Lancium pods get when none is requested, see ProvisionerLancium._submit_named
+ProvisionerLanciumDefaultGPUType = 'k80'
+
+class ProvisionerResources:
+   """Numeric view of the resources in a cluster key, parsed only once"""
+   __slots__ = ('cpus','memory','disk','gpus','gpu_types')
+
+   def __init__(self, cpus, memory, disk, gpus, gpu_types):
+      self.cpus = cpus
+      self.memory = memory
+      self.disk = disk
+      self.gpus = gpus
+      self.gpu_types = gpu_types
+
+   @classmethod
+   def from_key(cls, key):
+      "Parse a ';'-joined cluster key (CPUs;Memory;Disk;DiskVolumes;GPUs;GPUTypes;Labels)"
+      xarr=key.split(';')
+      return cls(_to_int(xarr[0]), _to_int(xarr[1]), _to_int(xarr[2]),
+                 _to_int(xarr[4]), xarr[5])
+
+   def as_tuple(self):
+      return (self.cpus, self.gpus, self.memory, self.disk, self.gpu_types)
+
+   def cost(self):
+      # by making GPUs more expensive than 1k cores, we guarantee that we never get a gpu job on a CPU-only node
+      return self.gpus*1000+self.cpus
+
+   def sort_key(self):
+      "Cheapest first"
+      return (self.cost(), self.memory, self.disk)
+
+   def fits_in(self, pod):
+      "Returns True if a job with these resources can run in the pod"
+      if (self.cpus>pod.cpus) or (self.memory>pod.memory) or (self.disk>pod.disk) or (self.gpus>pod.gpus):
+         return False
+      if (self.gpus==0) and (pod.gpus>0):
+         # do not waste GPU pods on CPU-only jobs
+         return False
+      if (self.gpus>0) and (self.gpu_types!=''):
+         # the job lists the acceptable GPU types
+         pod_gpu_type = pod.gpu_types if pod.gpu_types!='' else ProvisionerLanciumDefaultGPUType
+         if pod_gpu_type not in [t.strip() for t in self.gpu_types.split(',')]:
+            return False
+      return True
+
+# indexes in the ProvisionerLanciumCluster.count_states tuple
+ProvisionerPodWaiting = 0
+ProvisionerPodUnmatched = 1
+ProvisionerPodClaimed = 2
+ProvisionerPodFailed = 3
+ProvisionerPodUnknown = 4
+
+def _pod_state(pod_el, startd_els):
+   "Returns the state index of the pod, or None if it can be ignored"
+   status="%s"%pod_el['Status']
+   if status=="running":
+      if startd_els==None:
+         # we will count all Running pods that are not yet claimed
+         return ProvisionerPodWaiting
+      for el in startd_els:
+         if "%s"%el['State']=="Claimed":
+            # a single claimed is good enough
+            return ProvisionerPodClaimed
+      return ProvisionerPodUnmatched
+   elif status in ("submitted","queued"):
+      # we can assume these are waiting at all times
+      return ProvisionerPodWaiting
+   elif status in ["finished","delete pending"]:
+      # we can safely ignore these
+      return None
+   elif status=="error":
+      return ProvisionerPodFailed
+   else:
+      # including "created"
+      return ProvisionerPodUnknown
+
 class ProvisionerLanciumCluster(ProvisionerCluster):
+   """Cluster of (pod, startd_ads) elements
+      The state counts are kept up to date as elements are appended, so reading them is cheap"""
+
    def __init__(self, key, attr_vals, pod_attrs):
       ProvisionerCluster.__init__(self, key, attr_vals)
       self.pod_attrs = pod_attrs
+      self.resources = ProvisionerResources.from_key(key)
+      self.state_counts = [0,0,0,0,0]
+      self.finished_ids = []
+      self.waiting_pods = []
+      self.started_els = []
+
+   def append(self, el):
+      ProvisionerCluster.append(self, el)
+      self._add_el(el)
+
+   def append_list(self, els):
+      ProvisionerCluster.append_list(self, els)
+      for el in els:
+         self._add_el(el)
 
    def count_states(self):
       "Returns (waiting,unmatched,claimed,failed,unknown) counts"
-      waiting_cnt = 0
-      unmatched_cnt = 0
-      claimed_cnt = 0
-      failed_cnt = 0
-      unknown_cnt = 0
-
-      for el in self.elements:
-         pod_el = el[0]
-         status="%s"%pod_el['Status']
-         if status=="running":
-            startd_els = el[1]
-            if startd_els!=None:
-              state = "Unclaimed"
-              for el in startd_els:
-                elstate = "%s"%el['State']
-                if elstate=="Claimed":
-                  # a single claimed is good enough
-                  state=elstate
-                  break
-            else:
-              state = "None"
-            # we will count all Running pods that are not yet claimed
-            if state=="None":
-              waiting_cnt+=1
-            elif state!="Claimed":
-              unmatched_cnt+=1
-            else:
-              claimed_cnt+=1
-         elif status in ("submitted","queued"):
-            # we can assume these are waiting at all times
-            waiting_cnt+=1
-         elif status in ["finished","delete pending"]:
-            # we can safely ignore these
-            pass
-         elif status=="error":
-            failed_cnt+=1
-         elif status=="created":
-            unknown_cnt+=1
-         else:
-            unknown_cnt+=1
-      return (waiting_cnt,unmatched_cnt,claimed_cnt,failed_cnt,unknown_cnt)
+      return tuple(self.state_counts)
 
    def count_unclaimed(self):
-      (waiting_cnt,unmatched_cnt,claimed_cnt,failed_cnt,unknown_cnt)=self.count_states()
       # "logically unclaimed" = waiting+"running unmatched"
-      return waiting_cnt+unmatched_cnt
+      return self.state_counts[ProvisionerPodWaiting]+self.state_counts[ProvisionerPodUnmatched]
+
+   def get_waiting_pods(self):
+      "Returns the attributes of the pods that are not advertising in the collector yet, do not modify"
+      return self.waiting_pods
+
+   def get_started_pods(self):
+      "Returns the attributes of the running pods that are advertising in the collector"
+      return [el[0] for el in self.started_els]
+
+   def get_free_capacity(self):
+      """Returns a list of [cpus,memory,disk,gpus], one per started pod that can still accept jobs
+         Uses the free resources of their partitionable slot, if reported.
+         Waiting pods are not included, see get_waiting_pods."""
+      pod = self.resources
+      full = [pod.cpus, pod.memory, pod.disk, pod.gpus]
+      capacities = []
+
+      for (pod_el, startd_els) in self.started_els:
+         pslot = None
+         claimed = False
+         for ad in startd_els:
+            if ('SlotType' in ad) and ("%s"%ad['SlotType']=="Partitionable"):
+               pslot = ad
+            elif "%s"%ad['State']=="Claimed":
+               claimed = True
+         if pslot!=None:
+            # missing attributes are assumed not to be the limiting factor
+            capacities.append([_to_int(pslot[k], full[i]) if k in pslot else full[i]
+                               for (i,k) in enumerate(('Cpus','Memory','Disk','GPUs'))])
+         elif not claimed:
+            capacities.append(list(full))
+         # else, no way to know how much is left, assume nothing
+      return capacities
 
    def get_finished(self):
-      "Returns ids of all the finished jobs"
-      els = []
+      "Returns ids of all the finished jobs, do not modify"
+      return self.finished_ids
+
+   # INTERNAL
+   def _add_el(self, el):
+      (pod_el, startd_els) = el
+      state = _pod_state(pod_el, startd_els)
+      if state!=None:
+         self.state_counts[state]+=1
+      if state==ProvisionerPodWaiting:
+         self.waiting_pods.append(pod_el)
+      elif state in (ProvisionerPodUnmatched, ProvisionerPodClaimed):
+         self.started_els.append(el)
+      status="%s"%pod_el['Status']
+      if status in ("finished","error"):
+         self.finished_ids.append(pod_el['lancium-id'])
+
+class ProvisionerLanciumScheddCluster(ProvisionerCluster):
+   """Cluster of schedd jobs.
+      Elements can be either individual jobs or autocluster aggregates."""
+
+   def __init__(self, key, attr_vals):
+      ProvisionerCluster.__init__(self, key, attr_vals)
+      self.resources = ProvisionerResources.from_key(key)
+      self.n_idle = 0
 
-      for el in self.elements:
-         pod_el = el[0]
-         status="%s"%pod_el['Status']
-         if status in ["finished","error"]:
-            els.append(pod_el['lancium-id'])
-      return els
+   def append(self, el):
+      ProvisionerCluster.append(self, el)
+      self.n_idle += self._count_idle(el)
+
+   def append_list(self, els):
+      ProvisionerCluster.append_list(self, els)
+      for el in els:
+         self.n_idle += self._count_idle(el)
+
+   def count_idle(self):
+      "Returns the number of idle jobs, aggregates count as JobCount jobs"
+      return self.n_idle
+
+   # INTERNAL
+   def _count_idle(self, el):
+      # get is the cheapest lookup for both dicts and ProvisionerRecord objects
+      if int(el.get('JobStatus',0))==1:
+         return int(el.get('JobCount',1))
+      return 0
 
 class ProvisionerLanciumClustering(ProvisionerClustering):
    def __init__(self):
       ProvisionerClustering.__init__(self)
 
+   def cluster_schedd_jobs(self, schedd_jobs):
+      """Same as ProvisionerClustering.cluster_schedd_jobs,
+         but understands autocluster aggregates"""
+      clusters={}
+      # (job attribute, default value), the same for all jobs
+      attr_defaults=[(self.attrs.expand_schedd_attr(k), self.attrs.attributes[k]) for k in self.attrs.attributes.keys()]
+      for job in schedd_jobs:
+         # works the same for both dicts and ProvisionerRecord objects
+         job_attrs=["%s"%job.get(jobk, default) for (jobk, default) in attr_defaults]
+         job_key=";".join(job_attrs)
+         if job_key not in clusters:
+            clusters[job_key] = ProvisionerLanciumScheddCluster(job_key, job_attrs)
+         clusters[job_key].append(job)
+         # cleanup to avoid accidental reuse
+         del job_attrs
+
+      return clusters
+
    def cluster_lancium_pods(self, lancium_pods, startd_ads):
       startd_dict={}
       # dict of lists, since we use partitionable slots
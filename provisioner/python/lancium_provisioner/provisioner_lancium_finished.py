@@ -0,0 +1,66 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Keep track of the finished Lancium jobs
+#
+
+class ProvisionerLanciumFinishedTracker:
+   """Remember how many times each finished Lancium job was seen.
+      Ids not reported by Lancium anymore are forgotten, and the size is capped."""
+
+   def __init__(self, max_size=100000):
+      """
+      Arguments:
+         max_size: int (Optional)
+             Max number of ids to track, new ids are ignored when full
+      """
+      self.max_size = max_size
+      self.counts = {} # lancium-id -> times seen
+      self.n_rejected = 0 # ids not tracked because we were full, in the last iteration
+
+   def __len__(self):
+      return len(self.counts)
+
+   def __contains__(self, lancium_id):
+      return lancium_id in self.counts
+
+   def get_size(self):
+      return len(self.counts)
+
+   def retain(self, lancium_ids):
+      "Forget all the ids not in lancium_ids, i.e. not reported as finished anymore"
+      keep = set(lancium_ids)
+      for lancium_id in [k for k in self.counts.keys() if k not in keep]:
+         del self.counts[lancium_id]
+      self.n_rejected = 0
+
+   def increment(self, lancium_id):
+      "Record one more sighting, return how many times the id was seen (0 if not tracked)"
+      if lancium_id in self.counts:
+         self.counts[lancium_id] += 1
+      elif len(self.counts)<self.max_size:
+         self.counts[lancium_id] = 1
+      else:
+         # when full, keep the old ones, they are the closest to being deleted
+         # the new one will be picked up once there is space again
+         self.n_rejected += 1
+         return 0
+      return self.counts[lancium_id]
+
+   def remove(self, lancium_id):
+      if lancium_id in self.counts:
+         del self.counts[lancium_id]
+
+   def get_counts(self):
+      "Returns a copy of the lancium-id -> times seen dictionary, e.g. for checkpointing"
+      return dict(self.counts)
+
+   def set_counts(self, counts):
+      "Replace the tracked ids, keeping at most max_size of them"
+      self.counts = {}
+      for lancium_id in counts:
+         if len(self.counts)>=self.max_size:
+            break
+         self.counts[lancium_id] = counts[lancium_id]
@@ -8,14 +8,31 @@
 
 import copy
 import re
+import time
+import threading
+import concurrent.futures
 import htcondor
 import classad
 
 import provisioner_config_parser
+from . import provisioner_metrics
+from . import provisioner_records
+
+# attributes kept as ints in the job and startd records, everything else is a string
+ProvisionerScheddIntAttrs = ('ClusterId','ProcId','JobStatus','JobCount',
+                             'RequestCPUs','RequestMemory','RequestDisk','RequestGPUs')
+ProvisionerStartdIntAttrs = ('Cpus','Memory','Disk','GPUs')
+# the slot resources are used to estimate how much space is left in each pod
+ProvisionerStartdAttrs = ('Machine','Name','AuthenticatedIdentity','State','Activity',
+                          'LanciumProvisionerType', 'LanciumProvisionerName', 'LanciumJobName',
+                          'SlotType','Cpus','Memory','Disk','GPUs')
 
 ProvisionerHTCConfigFields = ('condor_host',
                               'app_name',
-                              'additional_requirements')
+                              'additional_requirements',
+                              'schedd_query_threads','schedd_query_timeout',
+                              'schedd_query_autocluster',
+                              'schedd_discovery_ttl')
 
 class ProvisionerHTCConfig:
    """Config file for HTCOndor provisioning classes"""
@@ -23,10 +40,20 @@ class ProvisionerHTCConfig:
    def __init__(self, 
                 condor_host="cm-1.ospool.osg-htc.org",
                 app_name = 'lancium-wn',
-                additional_requirements = ""):
+                additional_requirements = "",
+                schedd_query_threads = 8,
+                schedd_query_timeout = 60,
+                schedd_query_autocluster = 0,
+                schedd_discovery_ttl = 300):
       self.condor_host = copy.deepcopy(condor_host)
       self.app_name = copy.deepcopy(app_name)
       self.additional_requirements = copy.deepcopy(additional_requirements)
+      self.schedd_query_threads = schedd_query_threads
+      self.schedd_query_timeout = schedd_query_timeout
+      # if non-zero, ask the schedds for autocluster aggregates instead of individual jobs
+      self.schedd_query_autocluster = schedd_query_autocluster
+      # how long to reuse the list of trusted schedds, in seconds, 0 means query every time
+      self.schedd_discovery_ttl = schedd_discovery_ttl
 
    def parse(self,
              dict,
@@ -35,21 +62,49 @@ class ProvisionerHTCConfig:
       self.condor_host = provisioner_config_parser.update_parse(self.condor_host, 'condor_host', 'str', fields, dict)
       self.app_name = provisioner_config_parser.update_parse(self.app_name, 'app_name', 'str', fields, dict)
       self.additional_requirements = provisioner_config_parser.update_parse(self.additional_requirements, 'additional_requirements', 'str', fields, dict)
+      self.schedd_query_threads = provisioner_config_parser.update_parse(self.schedd_query_threads, 'schedd_query_threads', 'int', fields, dict)
+      self.schedd_query_timeout = provisioner_config_parser.update_parse(self.schedd_query_timeout, 'schedd_query_timeout', 'int', fields, dict)
+      self.schedd_query_autocluster = provisioner_config_parser.update_parse(self.schedd_query_autocluster, 'schedd_query_autocluster', 'int', fields, dict)
+      self.schedd_discovery_ttl = provisioner_config_parser.update_parse(self.schedd_discovery_ttl, 'schedd_discovery_ttl', 'int', fields, dict)
 
 class ProvisionerSchedd:
    """HTCondor schedd interface"""
 
-   def __init__(self, log_obj, trusted_schedds, config):
+   def __init__(self, log_obj, trusted_schedds, config, metrics_obj=None):
       """
       Arguments:
          log_obj: object
              Logging object
          trusted_schedds: dictionary, NameRegexp:AuthenticatedIdentityRegexp
              Set of schedds to query. Both name and AuthenticatedIdentity are regexp.
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object, used to report per-schedd latencies and failures
       """
       self.log_obj = log_obj
       self.trusted_schedds = copy.deepcopy(trusted_schedds)
+      # compile once, they are used for every schedd at every discovery
+      self.trusted_patterns = [(re.compile(k), re.compile(self.trusted_schedds[k])) for k in self.trusted_schedds.keys()]
       self.additional_requirements = copy.deepcopy(config.additional_requirements)
+      self.query_threads = max(1, config.schedd_query_threads)
+      self.query_timeout = config.schedd_query_timeout
+      self.query_autocluster = (config.schedd_query_autocluster!=0)
+      self.discovery_ttl = config.schedd_discovery_ttl
+      # the discovered schedds are cached, and refreshed in the background once older than discovery_ttl
+      self.discovery_lock = threading.Lock()
+      self.collector_lock = threading.Lock()
+      self.collector = None # reused between queries, see _get_collector
+      self.sobjs = None
+      self.sobjs_time = 0
+      self.refresh_thread = None
+      self.refresh_error = None # set by the refresh thread, reported by the next _get_schedd_objs
+      # ScheddName -> {'latency':seconds, 'jobs':count, 'autocluster':bool, 'error':None or string}
+      # refreshed at every query
+      self.last_query_stats = {}
+      # persistent, so that hung queries do not leak a new pool at every query
+      self.query_executor = None
+      # ScheddName -> future of a query that timed out but did not return yet
+      self.hung_queries = {}
+      self.metrics = metrics_obj if metrics_obj!=None else provisioner_metrics.ProvisionerMetrics()
 
    def query_idle(self, projection=[]):
       """Return the list of idle jobs for my provisioner"""
@@ -57,7 +112,9 @@ class ProvisionerSchedd:
 
 
    def query(self, job_status, projection=[]):
-      """Return the list of jobs for my provisioner"""
+      """Return the list of jobs for my provisioner
+         If autocluster querying is enabled, each element is an aggregate
+         of identical jobs, with the number of jobs in JobCount"""
 
       full_projection=['ClusterId','ProcId','JobStatus']+projection
       query_str='(JobStatus=?=%i)'%job_status
@@ -65,50 +122,233 @@ class ProvisionerSchedd:
          query_str += ' && (%s)'%self.additional_requirements
 
       jobs=[]
+      stats={}
 
       sobjs=self._get_schedd_objs()
-      for sclassad in sobjs:
-         s=htcondor.Schedd(sclassad)
-         sname=sclassad['Name']
+      if len(sobjs)==0:
+         self.last_query_stats = stats
+         self._record_stats(stats)
+         return jobs
+
+      # one entry per schedd, either 'timeout', 'hung', 'busy' or a completed future
+      outcomes = self._run_queries(sobjs, query_str, full_projection)
+
+      # merge in the same order as the schedd list, for reproducibility
+      for i in range(len(sobjs)):
+         sname=sobjs[i]['Name']
+         f=outcomes[i]
+         if f=='timeout':
+            stats[sname]={'latency':self.query_timeout, 'jobs':0, 'autocluster':False, 'error':'timeout'}
+            self.log_obj.log_debug("[ProvisionerSchedd] Timeout querying HTCondor schedd '%s'"%sname)
+            continue
+         if f=='hung':
+            stats[sname]={'latency':None, 'jobs':0, 'autocluster':False, 'error':'previous query still running'}
+            self.log_obj.log_debug("[ProvisionerSchedd] Skipping HTCondor schedd '%s', previous query still running"%sname)
+            continue
+         if f=='busy':
+            stats[sname]={'latency':None, 'jobs':0, 'autocluster':False, 'error':'no free query thread'}
+            self.log_obj.log_debug("[ProvisionerSchedd] Skipping HTCondor schedd '%s', all query threads are hung"%sname)
+            continue
          try:
-            myjobs=s.xquery(query_str, full_projection)
-            self._append_jobs(sname, jobs, myjobs)
-         except:
+            (myjobs, latency, autocluster) = f.result()
+         except Exception as e:
+            stats[sname]={'latency':None, 'jobs':0, 'autocluster':False, 'error':"%s"%e}
             self.log_obj.log_debug("[ProvisionerSchedd] Failed to query HTCondor schedd '%s'"%sname)
+            continue
+         if latency>self.query_timeout:
+            # too slow, do not trust the results, they may be stale by now
+            stats[sname]={'latency':latency, 'jobs':0, 'autocluster':autocluster, 'error':'timeout'}
+            self.log_obj.log_debug("[ProvisionerSchedd] Timeout querying HTCondor schedd '%s' (%.1fs)"%(sname,latency))
+            continue
+         stats[sname]={'latency':latency, 'jobs':len(myjobs), 'autocluster':autocluster, 'error':None}
+         self.log_obj.log_debug("[ProvisionerSchedd] Schedd '%s' returned %i %s in %.2fs"%
+                                (sname, len(myjobs), "autoclusters" if autocluster else "jobs", latency))
+         jobs+=myjobs
 
+      self.last_query_stats = stats
+      self._record_stats(stats)
       return jobs
 
 
    # INTERNAL
-   def _append_jobs(self, schedd_name, jobs, myjobs):
-      """jobs is a list and will be updated in-place"""
+   def _run_queries(self, sobjs, query_str, full_projection):
+      """Query the schedds over the query threads, each with its own deadline, starting when its query starts
+         Returns a list, in sobjs order, of either the completed future, 'timeout', 'hung' or 'busy'"""
+      self._reap_hung()
+      outcomes = [None]*len(sobjs)
+      waiting = []
+      for i in range(len(sobjs)):
+         if sobjs[i]['Name'] in self.hung_queries:
+            # do not pile up threads stuck on the same schedd
+            outcomes[i] = 'hung'
+         else:
+            waiting.append(i)
+
+      executor = self._get_executor()
+      running = {} # future -> (index, deadline)
+      while True:
+         # only submit when a thread is free, so the deadline starts with the query
+         while (len(waiting)>0) and ((len(running)+len(self.hung_queries))<self.query_threads):
+            i = waiting.pop(0)
+            f = executor.submit(self._query_one, sobjs[i], query_str, full_projection)
+            running[f] = (i, time.time()+self.query_timeout)
+         if len(running)==0:
+            break # either all done, or all the threads are hung
+
+         next_deadline = min([deadline for (i, deadline) in running.values()])
+         (done, not_done) = concurrent.futures.wait(list(running.keys()), timeout=max(0.0, next_deadline-time.time()),
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+         for f in done:
+            (i, deadline) = running.pop(f)
+            outcomes[i] = f
+         now = time.time()
+         for f in list(running.keys()):
+            (i, deadline) = running[f]
+            if now>=deadline:
+               # keeps its thread until xquery returns, see _reap_hung
+               del running[f]
+               self.hung_queries[sobjs[i]['Name']] = f
+               outcomes[i] = 'timeout'
+         self._reap_hung()
+
+      for i in waiting:
+         outcomes[i] = 'busy'
+      self.metrics.set_gauge('schedd_queries_hung', len(self.hung_queries), help="Number of schedd queries still running past their timeout")
+      return outcomes
+
+   def _reap_hung(self):
+      "Forget about the timed out queries that eventually returned"
+      for sname in list(self.hung_queries.keys()):
+         if self.hung_queries[sname].done():
+            del self.hung_queries[sname]
+
+   def _get_executor(self):
+      "Return the query thread pool, reused between queries"
+      if self.query_executor==None:
+         self.query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.query_threads)
+      return self.query_executor
+
+   def _record_stats(self, stats):
+      latencies = []
+      for sname in stats:
+         sstats = stats[sname]
+         if sstats['latency']!=None:
+            latencies.append(({'schedd':sname}, sstats['latency']))
+         if sstats['error']!=None:
+            self.metrics.inc_counter('schedd_query_errors_total', 1, {'schedd':sname}, help="Number of failed schedd queries")
+      self.metrics.set_gauge_family('schedd_query_seconds', latencies, help="Duration of the last query of each schedd")
+
+   def _query_one(self, sclassad, query_str, full_projection):
+      """Query a single schedd, return (jobs,latency,autocluster)
+         Called from a worker thread, so it must not log"""
+      start_time = time.time()
+      s=htcondor.Schedd(sclassad)
+      myjobs=[]
+      if self.query_autocluster:
+         # the schedd groups by the projected attributes, so drop the per-job ones
+         ac_projection=[k for k in full_projection if k not in ('ClusterId','ProcId')]
+         try:
+            self._append_jobs(sclassad['Name'], myjobs, s.xquery(query_str, ac_projection, opts=htcondor.QueryOpts.AutoCluster),
+                              ac_projection+['JobCount'])
+            return (myjobs, time.time()-start_time, True)
+         except:
+            # older schedds may not support it, fall back to the per-job query
+            myjobs=[]
+      self._append_jobs(sclassad['Name'], myjobs, s.xquery(query_str, full_projection), full_projection)
+      return (myjobs, time.time()-start_time, False)
+
+   def _append_jobs(self, schedd_name, jobs, myjobs, projection):
+      """jobs is a list and will be updated in-place
+         Only the attributes in projection are kept"""
+      record_class = provisioner_records.get_record_class(['ScheddName']+projection, ProvisionerScheddIntAttrs)
+      field_map = record_class.field_map
       minvals={'RequestMemory':4096,'RequestDisk':8000000}
       for job in myjobs:
-         jobattrs={'ScheddName':schedd_name}
+         jobattrs=record_class()
+         jobattrs['ScheddName']=schedd_name
          for k in job.keys():
-            if k in minvals.keys():
+            # classad attribute names are case-insensitive, use the projected spelling
+            rk = field_map.get(k.lower())
+            if rk==None:
+               continue # not requested
+            if rk in minvals.keys():
                # the default RequestMemory and RequestDisk in condor is dynamic
                # and the initial value (after eval) is way too low
                # Treat very low values as undefines
                val = int(job.eval(k))
-               if val>=minvals[k]:
-                  jobattrs[k]="%s"%val
+               if val>=minvals[rk]:
+                  jobattrs[rk]=val
                #else pretend it is not there
             else:
-               # convert all values to strings, for easier management
-               # also expand all expresstions
-               jobattrs[k]="%s"%job.eval(k)
+               # the record converts to int or string, after expanding all expressions
+               jobattrs[rk]=job.eval(k)
          jobs.append(jobattrs)
       return
 
    def _get_schedd_objs(self):
-      sobjs=[]
-      c = htcondor.Collector()
+      """Return the list of trusted schedd ads
+         Uses the cached list if not older than discovery_ttl, else starts a background refresh.
+         Only blocks if there is no usable list."""
+      if self.discovery_ttl<=0:
+         return self._discover_schedds()
+
+      with self.discovery_lock:
+         sobjs = self.sobjs
+         age = time.time()-self.sobjs_time
+         refresh_error = self.refresh_error
+         self.refresh_error = None
+      if refresh_error!=None:
+         self.log_obj.log_debug("[ProvisionerSchedd] Failed to refresh HTCondor schedd list: %s"%refresh_error)
+
+      if (sobjs==None) or (age>3*self.discovery_ttl):
+         # nothing cached, or the refreshes have been failing for too long
+         sobjs = self._discover_schedds()
+         with self.discovery_lock:
+            self.sobjs = sobjs
+            self.sobjs_time = time.time()
+      elif age>self.discovery_ttl:
+         self._start_refresh()
+      return sobjs
+
+   def _start_refresh(self):
+      with self.discovery_lock:
+         if (self.refresh_thread!=None) and self.refresh_thread.is_alive():
+            return # already in progress
+         self.refresh_thread = threading.Thread(target=self._refresh_schedds, daemon=True)
+         self.refresh_thread.start()
+
+   def _refresh_schedds(self):
+      "Runs in a background thread, so it must not log"
       try:
-         slist=c.query(ad_type=htcondor.AdTypes.Schedd,projection=['Name','AuthenticatedIdentity','MyAddress','AddressV1','Machine'])
-      except:
-         self.log_obj.log_debug("[ProvisionerSchedd] Failed to retrieve HTCondor schedd list")
-         raise
+         sobjs = self._discover_schedds(log_errors=False)
+      except Exception as e:
+         with self.discovery_lock:
+            self.refresh_error = "%s"%e
+         return
+      with self.discovery_lock:
+         self.sobjs = sobjs
+         self.sobjs_time = time.time()
+
+   def _get_collector(self):
+      "Return the collector handle, creating it if needed"
+      if self.collector==None:
+         self.collector = htcondor.Collector()
+      return self.collector
+
+   def _discover_schedds(self, log_errors=True):
+      """Query the collector for the list of trusted schedds"""
+      sobjs=[]
+      start_time = time.time()
+      with self.collector_lock:
+         try:
+            c = self._get_collector()
+            slist=c.query(ad_type=htcondor.AdTypes.Schedd,projection=['Name','AuthenticatedIdentity','MyAddress','AddressV1','Machine'])
+         except:
+            # the handle may be bad, start fresh next time
+            self.collector = None
+            if log_errors:
+               self.log_obj.log_debug("[ProvisionerSchedd] Failed to retrieve HTCondor schedd list")
+            raise
 
       for s in slist:
          try:
@@ -125,15 +365,16 @@ class ProvisionerSchedd:
          del smachine
          del sname
          del sauthid
+      self.metrics.set_gauge('schedd_discovery_seconds', time.time()-start_time, help="Duration of the last schedd discovery")
+      self.metrics.set_gauge('trusted_schedds', len(sobjs), help="Number of trusted schedds found in the last discovery")
       return sobjs
 
    def _is_valid_schedd(self, schedd_name, schedd_authid):
       found = False
-      for nameregex in self.trusted_schedds.keys():
-         if re.fullmatch(nameregex,schedd_name):
+      for (nameregex,authregex) in self.trusted_patterns:
+         if nameregex.fullmatch(schedd_name):
             # found a valid schedd name
-            authregex=self.trusted_schedds[nameregex]
-            if re.fullmatch(authregex,schedd_authid):
+            if authregex.fullmatch(schedd_authid):
                #it also matches the identity
                found = True
                break # found, we are done
@@ -144,29 +385,39 @@ class ProvisionerSchedd:
 class ProvisionerCollector:
    """HTCondor Collector/startd interface"""
 
-   def __init__(self, log_obj, startd_identity, config):
+   def __init__(self, log_obj, startd_identity, config, app_names=None):
       """
       Arguments:
          log_obj: object
              Logging object
          startd_identity: string
              AuthenticatedIdentity Regexp used as a whitelist
+         app_names: list of strings (Optional)
+             Query the startds of all these apps at once, defaults to just config.app_name
       """
       self.log_obj = log_obj
       self.startd_identity = copy.deepcopy(startd_identity)
-      self.app_name = copy.deepcopy(config.app_name)
+      self.startd_identity_re = re.compile(self.startd_identity)
+      self.app_names = copy.deepcopy(app_names) if app_names!=None else [config.app_name]
+      self.collector = None # reused between queries
 
    def query(self,  projection=[]):
       """Return the list of startds for my provisioner"""
 
-      full_projection=['Machine','Name','AuthenticatedIdentity','State','Activity','LanciumProvisionerType', 'LanciumProvisionerName', 'LanciumJobName']+projection
+      full_projection=list(ProvisionerStartdAttrs)+projection
       startds=[]
+      record_class = provisioner_records.get_record_class(full_projection, ProvisionerStartdIntAttrs)
+      field_map = record_class.field_map
 
-      c = htcondor.Collector()
+      if self.collector==None:
+         self.collector = htcondor.Collector()
+      name_constraint = '||'.join(['(LanciumProvisionerName=?="%s")'%app_name for app_name in self.app_names])
       try:
-         slist=c.query(ad_type=htcondor.AdTypes.Startd,projection=full_projection,
-                       constraint='(LanciumProvisionerType=?="PRPHTCondorProvisioner")&&(LanciumProvisionerName=?="%s")'%self.app_name)
+         slist=self.collector.query(ad_type=htcondor.AdTypes.Startd,projection=full_projection,
+                                    constraint='(LanciumProvisionerType=?="PRPHTCondorProvisioner")&&(%s)'%name_constraint)
       except:
+         # the handle may be bad, start fresh next time
+         self.collector = None
          self.log_obj.log_debug("[ProvisionerCollector] Failed to retrieve HTCondor startd list")
          raise
 
@@ -178,14 +429,16 @@ class ProvisionerCollector:
          except:
             # if I cannot find all, it is invalid
             continue
-         if not re.fullmatch(self.startd_identity,sauthid):
+         if not self.startd_identity_re.fullmatch(sauthid):
             # not trusted, ignore
             continue
-         adattrs={}
+         adattrs=record_class()
          for k in s.keys():
-            # convert all values to strings, for easier management
-            # also eval any expressions
-            adattrs[k]="%s"%s.eval(k)
+            rk = field_map.get(k.lower())
+            if rk==None:
+               continue # not requested
+            # the record converts to int or string, after expanding all expressions
+            adattrs[rk]=s.eval(k)
          startds.append(adattrs)
          # cleaup to avoid accidental reuse
          del smachine
@@ -0,0 +1,167 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Log to file without blocking the caller
+#
+# Same interface as prp_provisioner.provisioner_logging.ProvisionerFileLogging,
+# i.e. log_debug, log_info, log_error and sync.
+#
+
+import os
+import time
+import queue
+import threading
+
+class ProvisionerAsyncFileLogging:
+   """File logging, with the actual writing done by a background thread.
+      Messages are queued with their timestamp, and written and flushed in batches.
+      If the queue is full, new messages are dropped and counted, instead of blocking the caller."""
+
+   def __init__(self, fname, want_log_debug=False, max_queued=100000, flush_interval=2.0,
+                rotate_size=0, rotate_interval=0, rotate_count=5):
+      """
+      Arguments:
+         fname: string
+             Name of the log file
+         want_log_debug: bool (Optional)
+             If False, log_debug messages are discarded
+         max_queued: int (Optional)
+             Max number of messages waiting to be written
+         flush_interval: float (Optional)
+             Max number of seconds a written message can stay in the file buffer
+         rotate_size: int (Optional)
+             Rotate the file when bigger than this many bytes, 0 means never
+         rotate_interval: int (Optional)
+             Rotate the file when older than this many seconds, 0 means never
+         rotate_count: int (Optional)
+             Number of rotated files to keep, named fname.1 (newest) to fname.<rotate_count>
+      """
+      self.fname = fname
+      self.want_log_debug = want_log_debug
+      self.flush_interval = flush_interval
+      self.rotate_size = rotate_size
+      self.rotate_interval = rotate_interval
+      self.rotate_count = max(1, rotate_count)
+      self.queue = queue.Queue(maxsize=max(1, max_queued))
+      self.sync_requested = threading.Event()
+      # protects n_dropped
+      self.lock = threading.Lock()
+      self.n_dropped = 0
+      # only used by the writer thread, after this
+      self.fd = None
+      self.open_time = 0.0
+      self._open()
+      self.thread = threading.Thread(target=self._writer, name="provisioner-logging")
+      # do not prevent the process from exiting
+      self.thread.daemon = True
+      self.thread.start()
+
+   def log_debug(self, msg):
+      if self.want_log_debug:
+         self._put((time.time(), 'DEBUG', msg))
+
+   def log_info(self, msg):
+      self._put((time.time(), 'INFO', msg))
+
+   def log_error(self, msg):
+      self._put((time.time(), 'ERROR', msg))
+
+   def sync(self):
+      "Ask for the queued messages to be written out soon, does not wait"
+      self.sync_requested.set()
+
+   def flush(self, timeout=5.0):
+      "Wait until all the messages queued so far are in the file, return False on timeout"
+      done = threading.Event()
+      try:
+         self.queue.put(done, timeout=timeout)
+      except queue.Full:
+         return False
+      return done.wait(timeout)
+
+   def close(self, timeout=5.0):
+      "Write out everything and stop the writer thread"
+      try:
+         self.queue.put(None, timeout=timeout)
+      except queue.Full:
+         return
+      self.thread.join(timeout)
+
+   # INTERNAL
+   def _put(self, record):
+      try:
+         self.queue.put_nowait(record)
+      except queue.Full:
+         with self.lock:
+            self.n_dropped += 1
+
+   def _open(self):
+      self.fd = open(self.fname, "a")
+      self.open_time = time.time()
+
+   def _writer(self):
+      last_flush = time.time()
+      while True:
+         records = []
+         try:
+            records.append(self.queue.get(timeout=self.flush_interval))
+            # take everything that is there, so it can be written in one go
+            while len(records)<1000:
+               records.append(self.queue.get_nowait())
+         except queue.Empty:
+            pass
+
+         lines = []
+         waiters = []
+         closing = False
+         for record in records:
+            if record==None:
+               closing = True
+            elif isinstance(record, threading.Event):
+               waiters.append(record)
+            else:
+               lines.append("%s %s %s\n"%(time.ctime(record[0]), record[1], record[2]))
+         with self.lock:
+            n_dropped = self.n_dropped
+            self.n_dropped = 0
+         if n_dropped>0:
+            lines.append("%s ERROR [ProvisionerAsyncFileLogging] Dropped %i messages, queue full\n"%(time.ctime(), n_dropped))
+
+         try:
+            if len(lines)>0:
+               self.fd.write("".join(lines))
+            now = time.time()
+            if closing or (len(waiters)>0) or self.sync_requested.is_set() or ((now-last_flush)>=self.flush_interval):
+               self.sync_requested.clear()
+               self.fd.flush()
+               last_flush = now
+            if closing:
+               self.fd.close()
+            else:
+               self._maybe_rotate(now)
+         except:
+            # nowhere to report it, just keep going
+            pass
+
+         for done in waiters:
+            done.set()
+         if closing:
+            return
+
+   def _maybe_rotate(self, now):
+      too_big = (self.rotate_size>0) and (self.fd.tell()>=self.rotate_size)
+      too_old = (self.rotate_interval>0) and ((now-self.open_time)>=self.rotate_interval)
+      if not (too_big or too_old):
+         return
+      self.fd.close()
+      try:
+         for i in range(self.rotate_count-1, 0, -1):
+            old_fname = "%s.%i"%(self.fname, i)
+            if os.path.exists(old_fname):
+               os.replace(old_fname, "%s.%i"%(self.fname, i+1))
+         os.replace(self.fname, "%s.1"%self.fname)
+      finally:
+         # keep logging, even if the rotation failed
+         self._open()
@@ -0,0 +1,199 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Prometheus-style metrics
+#
+
+import threading
+import socketserver
+import http.server
+
+class ProvisionerMetrics:
+   """Thread-safe registry of gauges, counters and summaries.
+      Rendered in the Prometheus text exposition format."""
+
+   def __init__(self, prefix="lancium_provisioner"):
+      self.prefix = prefix
+      self.lock = threading.Lock()
+      self.types = {}  # name -> (type, help)
+      self.values = {} # name -> {labels tuple: value}
+
+   def set_gauge(self, name, value, labels={}, help=""):
+      with self.lock:
+         self._get_family(name, 'gauge', help)[self._labels_key(labels)] = value
+
+   def set_gauge_family(self, name, values, help="", replace_labels={}):
+      """Replace all the series of a gauge at once, dropping the ones not in values
+         values is a list of (labels,value) pairs
+         If replace_labels is not empty, only the series that have those labels are dropped"""
+      family = {}
+      for (labels,value) in values:
+         family[self._labels_key(labels)] = value
+      with self.lock:
+         old_family = self._get_family(name, 'gauge', help)
+         if len(replace_labels)>0:
+            replace_set = set(replace_labels.items())
+            for key in old_family:
+               if (key not in family) and (not replace_set.issubset(key)):
+                  family[key] = old_family[key]
+         self.values[name] = family
+
+   def inc_counter(self, name, value=1, labels={}, help=""):
+      with self.lock:
+         family = self._get_family(name, 'counter', help)
+         key = self._labels_key(labels)
+         family[key] = family.get(key,0)+value
+
+   def observe(self, name, value, labels={}, help=""):
+      "Add a sample to a summary, i.e. update its _sum and _count"
+      with self.lock:
+         family = self._get_family(name, 'summary', help)
+         key = self._labels_key(labels)
+         (old_sum, old_count) = family.get(key,(0.0,0))
+         family[key] = (old_sum+value, old_count+1)
+
+   def get_value(self, name, labels={}):
+      "Returns the current value, or None if not defined"
+      with self.lock:
+         if name not in self.values:
+            return None
+         return self.values[name].get(self._labels_key(labels))
+
+   def render(self):
+      "Returns the metrics in the Prometheus text format"
+      lines = []
+      with self.lock:
+         for name in sorted(self.values.keys()):
+            (mtype, mhelp) = self.types[name]
+            fullname = "%s_%s"%(self.prefix, name)
+            if mhelp!="":
+               lines.append("# HELP %s %s"%(fullname, mhelp))
+            lines.append("# TYPE %s %s"%(fullname, mtype))
+            family = self.values[name]
+            for key in sorted(family.keys()):
+               labels_str = self._labels_str(key)
+               if mtype=='summary':
+                  (vsum, vcount) = family[key]
+                  lines.append("%s_sum%s %s"%(fullname, labels_str, self._value_str(vsum)))
+                  lines.append("%s_count%s %i"%(fullname, labels_str, vcount))
+               else:
+                  lines.append("%s%s %s"%(fullname, labels_str, self._value_str(family[key])))
+      lines.append("")
+      return "\n".join(lines)
+
+   # INTERNAL
+   def _get_family(self, name, mtype, help):
+      "Must be called with the lock held"
+      if name not in self.values:
+         self.types[name] = (mtype, help)
+         self.values[name] = {}
+      return self.values[name]
+
+   def _labels_key(self, labels):
+      return tuple(sorted(labels.items()))
+
+   def _labels_str(self, key):
+      if len(key)==0:
+         return ""
+      els = []
+      for (k,v) in key:
+         escaped = ("%s"%v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+         els.append('%s="%s"'%(k,escaped))
+      return "{%s}"%",".join(els)
+
+   def _value_str(self, value):
+      if isinstance(value, int):
+         return "%i"%value
+      return "%.6g"%value
+
+class ProvisionerLabeledMetrics:
+   """View of a ProvisionerMetrics object that adds the same labels to all the series,
+      so that many event loops can share one registry without overwriting each other"""
+
+   def __init__(self, metrics, labels):
+      """
+      Arguments:
+         metrics: object
+             ProvisionerMetrics object holding the values
+         labels: dictionary
+             Labels to add, e.g. {'worker':'gpu'}
+      """
+      self.metrics = metrics
+      self.labels = dict(labels)
+
+   def set_gauge(self, name, value, labels={}, help=""):
+      self.metrics.set_gauge(name, value, self._add_labels(labels), help)
+
+   def set_gauge_family(self, name, values, help=""):
+      self.metrics.set_gauge_family(name, [(self._add_labels(labels),value) for (labels,value) in values], help, self.labels)
+
+   def inc_counter(self, name, value=1, labels={}, help=""):
+      self.metrics.inc_counter(name, value, self._add_labels(labels), help)
+
+   def observe(self, name, value, labels={}, help=""):
+      self.metrics.observe(name, value, self._add_labels(labels), help)
+
+   def get_value(self, name, labels={}):
+      return self.metrics.get_value(name, self._add_labels(labels))
+
+   def render(self):
+      return self.metrics.render()
+
+   # INTERNAL
+   def _add_labels(self, labels):
+      all_labels = dict(self.labels)
+      all_labels.update(labels)
+      return all_labels
+
+class _ProvisionerMetricsHandler(http.server.BaseHTTPRequestHandler):
+   def do_GET(self):
+      if self.path.split('?')[0] not in ('/', '/metrics'):
+         self.send_error(404)
+         return
+      body = self.server.metrics.render().encode()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', "%i"%len(body))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      # do not spam stderr
+      return
+
+class _ProvisionerMetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+   daemon_threads = True
+
+class ProvisionerMetricsServer:
+   """Serve a ProvisionerMetrics object over HTTP, from a background thread"""
+
+   def __init__(self, metrics, port, address=""):
+      """
+      Arguments:
+         metrics: object
+             ProvisionerMetrics object to serve
+         port: int
+             TCP port to listen on
+         address: string (Optional)
+             Address to bind to, all interfaces by default
+      """
+      self.metrics = metrics
+      self.port = port
+      self.address = address
+      self.httpd = None
+      self.thread = None
+
+   def start(self):
+      self.httpd = _ProvisionerMetricsHTTPServer((self.address, self.port), _ProvisionerMetricsHandler)
+      self.httpd.metrics = self.metrics
+      self.thread = threading.Thread(target=self.httpd.serve_forever, name="provisioner-metrics")
+      self.thread.daemon = True
+      self.thread.start()
+
+   def stop(self):
+      if self.httpd!=None:
+         self.httpd.shutdown()
+         self.httpd.server_close()
+         self.httpd = None
@@ -0,0 +1,89 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Estimate how many pods are needed for the idle jobs
+#
+
+# Disk is not packed, only checked when matching the jobs to the pod shapes.
+# The schedd query treats any RequestDisk below the full disk of a pod as undefined
+# (see ProvisionerSchedd._append_jobs), so a known disk request would always mean one job per pod.
+def _request(resources):
+   return (resources.cpus, resources.memory, resources.gpus)
+
+def _capacity(capacity):
+   "Drop the disk from a [cpus, memory, disk, gpus] capacity"
+   return (capacity[0], capacity[1], capacity[3])
+
+def _n_fit(capacity, request):
+   "How many times request fits in capacity"
+   n = None
+   for i in range(3):
+      if request[i]>0:
+         k = int(capacity[i]/request[i])
+         n = k if (n==None) or (k<n) else n
+   # a request of nothing fits any number of times, but we never want more than one per core anyway
+   return n if n!=None else capacity[0]
+
+class ProvisionerBinPackPlanner:
+   """Bin-pack the idle jobs into the pods, to estimate how many new pods are needed.
+      Uses first-fit-decreasing, on groups of identical jobs and of identical free capacities.
+      Jobs are packed on CPUs, memory and GPUs only."""
+
+   def count_new_pods(self, pod, job_groups, free_capacities):
+      """
+      Arguments:
+         pod: ProvisionerResources
+             Shape of the pod
+         job_groups: list of (ProvisionerResources, n_jobs) pairs
+             Idle jobs to place
+         free_capacities: list of [cpus, memory, disk, gpus] lists
+             Capacity still available in the existing pods
+      Returns the number of additional pods needed to run all the jobs
+      """
+      # [capacity tuple, n_bins], existing pods first
+      bins = []
+      for capacity in free_capacities:
+         bins.append([_capacity(capacity), 1])
+      pod_capacity = _request(pod)
+      n_new = 0
+
+      # biggest first
+      groups = sorted(job_groups, key=lambda g: (g[0].cost(), g[0].memory), reverse=True)
+      for (resources, n_jobs) in groups:
+         request = _request(resources)
+         per_pod = _n_fit(pod_capacity, request)
+         if per_pod<=0:
+            continue # does not fit at all, should never get here
+
+         remaining = n_jobs
+         new_bins = []
+         for el in bins:
+            if remaining<=0:
+               break
+            (capacity, n_bins) = el
+            k = _n_fit(capacity, request)
+            if k<=0:
+               continue
+            n_take = min(k*n_bins, remaining)
+            remaining -= n_take
+            # split the group into full, partially filled and untouched bins
+            n_full = int(n_take/k)
+            n_partial = n_take-n_full*k
+            el[1] = n_bins-n_full-(1 if n_partial>0 else 0)
+            new_bins.append([tuple(capacity[i]-k*request[i] for i in range(3)), n_full])
+            if n_partial>0:
+               new_bins.append([tuple(capacity[i]-n_partial*request[i] for i in range(3)), 1])
+
+         if remaining>0:
+            n_pods = int((remaining+per_pod-1)/per_pod)
+            n_new += n_pods
+            n_full = int(remaining/per_pod)
+            n_partial = remaining-n_full*per_pod
+            new_bins.append([tuple(pod_capacity[i]-per_pod*request[i] for i in range(3)), n_full])
+            if n_partial>0:
+               new_bins.append([tuple(pod_capacity[i]-n_partial*request[i] for i in range(3)), 1])
+
+         bins = [el for el in bins+new_bins if el[1]>0]
+      return n_new
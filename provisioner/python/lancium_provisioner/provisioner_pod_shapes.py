@@ -0,0 +1,36 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Catalog of the pod shapes we can provision
+#
+
+from . import provisioner_lancium_clustering
+
+# CPUs:GPUs:Memory:Disk[:GPUType], comma separated
+ProvisionerDefaultPodShapes = "16:0:32768:8000000,48:0:98304:8000000,12:4:24576:8000000,48:16:98304:8000000"
+
+def parse_pod_shapes(shapes_str):
+   """Parse a pod shape catalog string, in the ProvisionerDefaultPodShapes format
+      Returns a list of ProvisionerResources objects"""
+   shapes = []
+   for el in shapes_str.split(','):
+      el = el.strip()
+      if len(el)==0:
+         continue
+      elarr = el.split(':')
+      if len(elarr) not in (4,5):
+         raise ValueError("Invalid pod shape '%s', expected CPUs:GPUs:Memory:Disk[:GPUType]"%el)
+      gpu_type = elarr[4].strip() if len(elarr)==5 else ''
+      shapes.append(provisioner_lancium_clustering.ProvisionerResources(int(elarr[0]), int(elarr[2]), int(elarr[3]),
+                                                                        int(elarr[1]), gpu_type))
+   return shapes
+
+def new_pod_cluster(shape):
+   "Create an empty ProvisionerLanciumCluster for the shape, with the same key Lancium pods of that shape get"
+   attr_vals = ["%i"%shape.cpus, "%i"%shape.memory, "%i"%shape.disk, '', "%i"%shape.gpus, shape.gpu_types, '']
+   key = ";".join(attr_vals)
+   pod_attrs = {'PodCPUs': attr_vals[0], 'PodMemory': attr_vals[1], 'PodDisk': attr_vals[2], 'PodDiskVolumes': '',
+                'PodGPUs': attr_vals[4], 'PodGPUTypes': attr_vals[5], 'PodLabels': ''}
+   return provisioner_lancium_clustering.ProvisionerLanciumCluster(key, attr_vals, pod_attrs)
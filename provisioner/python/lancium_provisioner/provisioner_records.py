@@ -0,0 +1,99 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Compact records for the schedd jobs and startd ads
+#
+
+import threading
+
+class ProvisionerRecord:
+   """Base class of the compact records, one slot per projected attribute.
+      Numeric attributes are kept as ints, everything else as strings.
+      Supports the read-only dict interface, so it can be used wherever a dict was.
+      Use get_record_class to get a class for a given projection."""
+   __slots__ = ()
+   fields = ()            # projected attribute names, in order
+   field_map = {}         # lowercase name -> projected name
+   field_set = frozenset()
+   int_fields = frozenset()
+
+   def __getitem__(self, k):
+      if k in self.field_set:
+         try:
+            return getattr(self, k)
+         except AttributeError:
+            pass # not set
+      raise KeyError(k)
+
+   def __setitem__(self, k, val):
+      "Convert and store the value, k must be one of the projected attributes"
+      if k not in self.int_fields:
+         setattr(self, k, "%s"%val)
+         return
+      try:
+         ival = int(val)
+         if (ival==val) or isinstance(val, str):
+            setattr(self, k, ival)
+            return
+      except (TypeError, ValueError):
+         pass
+      # not a number, e.g. undefined, keep it the way it was before
+      setattr(self, k, "%s"%val)
+
+   def __contains__(self, k):
+      return (k in self.field_set) and hasattr(self, k)
+
+   def __iter__(self):
+      return iter(self.keys())
+
+   def __len__(self):
+      return len(self.keys())
+
+   def get(self, k, default=None):
+      # the hot path in clustering, so keep it to a single lookup
+      return getattr(self, k, default) if k in self.field_set else default
+
+   def keys(self):
+      return [k for k in self.fields if hasattr(self, k)]
+
+   def values(self):
+      return [getattr(self, k) for k in self.keys()]
+
+   def items(self):
+      return [(k, getattr(self, k)) for k in self.keys()]
+
+   def to_dict(self):
+      return dict(self.items())
+
+   def __repr__(self):
+      return "%s(%s)"%(self.__class__.__name__, self.to_dict())
+
+_record_classes = {}
+_record_classes_lock = threading.Lock()
+
+def get_record_class(fields, int_fields=()):
+   """Return a ProvisionerRecord subclass with the given attributes
+      Classes are cached, so it is cheap to call for every query.
+      Attribute names are case-insensitive, like in classads, and int_fields may use any case."""
+   key = (tuple(fields), tuple(int_fields))
+   with _record_classes_lock:
+      if key in _record_classes:
+         return _record_classes[key]
+
+      field_map = {}
+      for k in fields:
+         if (not k.isidentifier()) or k.startswith('_') or hasattr(ProvisionerRecord, k):
+            raise ValueError("Invalid record attribute name '%s'"%k)
+         if k.lower() not in field_map:
+            field_map[k.lower()] = k
+      int_lower = set([k.lower() for k in int_fields])
+      attrs = {'__slots__': tuple(field_map.values()),
+               'fields': tuple(field_map.values()),
+               'field_map': field_map,
+               'field_set': frozenset(field_map.values()),
+               'int_fields': frozenset([k for k in field_map.values() if k.lower() in int_lower])}
+      record_class = type('ProvisionerRecord%i'%len(_record_classes), (ProvisionerRecord,), attrs)
+      _record_classes[key] = record_class
+   return record_class
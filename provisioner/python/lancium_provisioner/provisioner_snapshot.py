@@ -0,0 +1,140 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Record the inputs of the event loop, and replay them offline
+#
+
+import os
+import gzip
+import json
+import time
+import threading
+
+from . import provisioner_lancium
+
+def _pack(dicts):
+   """Compact a list of dictionaries, by grouping the ones with the same keys
+      Returns a list of {'k':keys,'v':list of value lists}"""
+   groups = {}
+   for d in dicts:
+      keys = tuple(d.keys())
+      if keys not in groups:
+         groups[keys] = []
+      groups[keys].append([d[k] for k in keys])
+   return [{'k':list(keys), 'v':groups[keys]} for keys in groups]
+
+def _unpack(groups):
+   dicts = []
+   for group in groups:
+      keys = group['k']
+      for vals in group['v']:
+         dicts.append(dict(zip(keys,vals)))
+   return dicts
+
+class ProvisionerSnapshotRecorder:
+   """Append the inputs of each iteration to a gzip-compressed JSON-lines file"""
+
+   def __init__(self, fname, max_bytes=1024*1024*1024):
+      """
+      Arguments:
+         fname: string
+             Name of the snapshot file
+         max_bytes: int (Optional)
+             When the file grows past this size, it is renamed to fname.1 and a new one started
+      """
+      self.fname = fname
+      self.max_bytes = max_bytes
+
+   def record(self, schedd_jobs, startd_ads, lancium_pods):
+      snapshot = {'time': time.time(),
+                  'schedd_jobs': _pack(schedd_jobs),
+                  'startd_ads': _pack(startd_ads),
+                  'lancium_pods': _pack(lancium_pods)}
+      line = json.dumps(snapshot, separators=(',',':'))
+      if os.path.exists(self.fname) and (os.path.getsize(self.fname)>self.max_bytes):
+         os.replace(self.fname, self.fname+".1")
+      # each call appends a new gzip member, gzip.open reads them back as a single stream
+      with gzip.open(self.fname, 'at') as fd:
+         fd.write(line+"\n")
+
+class ProvisionerSnapshotReader:
+   """Iterate over the snapshots in a file written by ProvisionerSnapshotRecorder"""
+
+   def __init__(self, fname):
+      self.fname = fname
+
+   def __iter__(self):
+      "Yields (time, schedd_jobs, startd_ads, lancium_pods) tuples"
+      with gzip.open(self.fname, 'rt') as fd:
+         for line in fd:
+            line = line.strip()
+            if len(line)==0:
+               continue
+            snapshot = json.loads(line)
+            yield (snapshot['time'],
+                   _unpack(snapshot['schedd_jobs']),
+                   _unpack(snapshot['startd_ads']),
+                   _unpack(snapshot['lancium_pods']))
+
+class ProvisionerReplaySource:
+   """Stand-in for the schedd and collector objects, returns the current snapshot"""
+
+   def __init__(self):
+      self.schedd_jobs = []
+      self.startd_ads = []
+
+   def set_snapshot(self, schedd_jobs, startd_ads):
+      self.schedd_jobs = schedd_jobs
+      self.startd_ads = startd_ads
+
+   # ProvisionerSchedd interface
+   def query_idle(self, projection=[]):
+      return self.schedd_jobs
+
+   # ProvisionerCollector interface
+   def query(self, projection=[]):
+      return self.startd_ads
+
+class ProvisionerReplayLancium:
+   """Stand-in for ProvisionerLancium, returns the current snapshot
+      and records what would have been submitted and deleted, without calling out"""
+
+   def __init__(self, app_name='lancium-wn'):
+      self.app_name = app_name
+      self.lancium_pods = []
+      self.submitted = 0
+      # protects the decisions, since deletions happen in background threads
+      self.lock = threading.Lock()
+      self.submissions = [] # (attrs, n_pods)
+      self.deletions = []   # lancium-id
+
+   def set_snapshot(self, lancium_pods):
+      self.lancium_pods = lancium_pods
+
+   def collect_decisions(self):
+      "Returns (submissions, deletions) since the last call"
+      with self.lock:
+         decisions = (self.submissions, self.deletions)
+         self.submissions = []
+         self.deletions = []
+      return decisions
+
+   # ProvisionerLancium interface
+   def query(self):
+      return self.lancium_pods
+
+   def submit(self, attrs, n_pods=1):
+      results = provisioner_lancium.ProvisionerLanciumSubmitResults()
+      with self.lock:
+         self.submissions.append((dict(attrs), n_pods))
+         for i in range(n_pods):
+            results.submitted.append('%s-replay-%06x'%(self.app_name, self.submitted))
+            self.submitted += 1
+      return results
+
+   def delete_one(self, lancium_id):
+      with self.lock:
+         self.deletions.append(lancium_id)
+      return True
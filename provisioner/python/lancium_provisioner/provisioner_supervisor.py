@@ -0,0 +1,222 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Drive many event loops from a single observation of the system
+#
+
+import time
+import concurrent.futures
+
+from . import provisioner_lancium_clustering
+from . import provisioner_metrics
+from . import event_loop
+import provisioner_clustering
+
+class ProvisionerWorkerLogging:
+   """Prefix all the messages with the worker name, so the workers can share one log"""
+
+   def __init__(self, log_obj, name):
+      self.log_obj = log_obj
+      self.prefix = "[Worker %s] "%name
+
+   def log_debug(self, msg):
+      self.log_obj.log_debug(self.prefix+msg)
+
+   def log_info(self, msg):
+      self.log_obj.log_info(self.prefix+msg)
+
+   def log_error(self, msg):
+      self.log_obj.log_error(self.prefix+msg)
+
+   def sync(self):
+      self.log_obj.sync()
+
+class ProvisionerSupervisor:
+   """Run many ProvisionerEventLoop workers in parallel, e.g. one per pod shape or per Lancium app.
+      The schedds, the collector and Lancium are queried once per iteration, for all the workers.
+      Each idle job is matched to the cheapest pod shape over all the workers sharing its schedd_obj,
+      so that no two workers provision for the same jobs."""
+
+   def __init__(self, log_obj, collector_obj, workers, concurrent_queries=False,
+                metrics_obj=None, shared_backend_obj=None):
+      """
+      Arguments:
+         workers: list of ProvisionerEventLoop objects
+             Each schedd_obj is queried once, and its jobs only go to the workers using it,
+             e.g. to give each app the jobs matching its own requirements.
+             If more than one worker with the same schedd_obj provisions the same pod shape,
+             the first one gets the jobs, and an error is logged.
+             Workers sharing a lancium_obj split its pods by shape,
+             the first one also takes care of the shapes nobody provisions anymore.
+         concurrent_queries: bool (Optional)
+             If True, query the schedds, the collector and Lancium in parallel
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object to report timings to
+         shared_backend_obj: object (Optional)
+             ProvisionerLanciumSharedBackend used by the workers' lancium_obj, if any
+      """
+      self.log_obj = log_obj
+      self.collector = collector_obj
+      self.workers = workers
+      self.concurrent_queries = concurrent_queries
+      self.metrics = metrics_obj if metrics_obj!=None else provisioner_metrics.ProvisionerMetrics()
+      self.shared_backend = shared_backend_obj
+      # distinct lancium objects, in worker order
+      self.lancium_objs = []
+      for worker in workers:
+         if worker.lancium_obj not in self.lancium_objs:
+            self.lancium_objs.append(worker.lancium_obj)
+      # distinct schedd objects, in worker order, each with the index used to match its jobs
+      self.schedd_objs = []
+      for worker in workers:
+         if worker.schedd not in self.schedd_objs:
+            self.schedd_objs.append(worker.schedd)
+      self.match_indexes = [self._new_match_index(schedd_obj) for schedd_obj in self.schedd_objs]
+      # same format as ProvisionerEventLoop.last_iteration_stats, summed over all the workers
+      self.last_iteration_stats = None
+
+   def restore_checkpoint(self):
+      "Restore the checkpoint of each worker, see ProvisionerEventLoop.restore_checkpoint"
+      for worker in self.workers:
+         try:
+            worker.restore_checkpoint()
+         except:
+            worker.log_obj.log_error("[ProvisionerSupervisor] Failed to restore checkpoint, starting fresh")
+
+   def one_iteration(self):
+      for worker in self.workers:
+         worker.last_iteration_stats = worker._new_iteration_stats()
+      self.last_iteration_stats = self.workers[0]._new_iteration_stats()
+      try:
+         (schedd_jobs, startd_pods, lancium_pods) = self._query_sources()
+      except:
+         self.log_obj.log_error("[ProvisionerSupervisor] Failed to query")
+         self.log_obj.sync()
+         return
+
+      start_time = time.time()
+      clustering = provisioner_lancium_clustering.ProvisionerLanciumClustering()
+      worker_lancium_clusters = [{} for worker in self.workers]
+      for j in range(len(self.lancium_objs)):
+         lancium_clusters = clustering.cluster_lancium_pods(lancium_pods[j], startd_pods)
+         self._split_lancium_clusters(self.lancium_objs[j], lancium_clusters, worker_lancium_clusters)
+      del lancium_pods
+      worker_matched_clusters = [{} for worker in self.workers]
+      for g in range(len(self.schedd_objs)):
+         schedd_clusters = clustering.cluster_schedd_jobs(schedd_jobs[g])
+         (cluster_keys, cluster_costs, cluster_resources) = self.match_indexes[g]
+         matched = event_loop.match_clusters(schedd_clusters, cluster_keys, cluster_costs, cluster_resources, self.log_obj)
+         for (i, ckey) in matched:
+            worker_matched_clusters[i][ckey] = matched[(i, ckey)]
+         del matched
+         del schedd_clusters
+      del schedd_jobs
+      self._record_phase('clustering', time.time()-start_time)
+
+      start_time = time.time()
+      with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
+         futures = [executor.submit(self.workers[i].provision, worker_matched_clusters[i], worker_lancium_clusters[i])
+                    for i in range(len(self.workers))]
+         for i in range(len(self.workers)):
+            try:
+               futures[i].result()
+            except:
+               self.workers[i].log_obj.log_error("[ProvisionerSupervisor] Exception in provisioning")
+      # includes the cleanup done by the workers
+      self._record_phase('provisioning', time.time()-start_time)
+      self._sum_stats()
+      self.log_obj.sync()
+
+   # INTERNAL
+   def _new_match_index(self, schedd_obj):
+      """Returns (cluster_keys, cluster_costs, cluster_resources) for the workers using schedd_obj
+         The keys are (worker index, pod cluster key), cheapest first"""
+      all_keys = []
+      owners = {} # pod cluster key -> first worker provisioning it
+      for i in range(len(self.workers)):
+         worker = self.workers[i]
+         if worker.schedd!=schedd_obj:
+            continue
+         for ckey in worker.available_cluster_keys:
+            if ckey in owners:
+               worker.log_obj.log_error("[ProvisionerSupervisor] Pod shape '%s' is also provisioned by worker %i for the same jobs, it will get none of them"%
+                                        (ckey, owners[ckey]))
+            else:
+               owners[ckey] = i
+            all_keys.append((worker.available_clusters[ckey].resources.sort_key(), i, ckey))
+      all_keys.sort()
+      cluster_keys = [(i, ckey) for (sort_key, i, ckey) in all_keys]
+      cluster_costs = [sort_key[0] for (sort_key, i, ckey) in all_keys]
+      cluster_resources = dict([((i, ckey), self.workers[i].available_clusters[ckey].resources) for (sort_key, i, ckey) in all_keys])
+      return (cluster_keys, cluster_costs, cluster_resources)
+
+   # INTERNAL
+   def _query_sources(self):
+      "Returns (schedd_jobs, startd_pods, lancium_pods), with schedd_jobs a list, one per schedd_obj, and lancium_pods one per lancium_obj"
+      if self.shared_backend!=None:
+         self.shared_backend.new_snapshot()
+      schedd_attrs = provisioner_clustering.ProvisionerClusteringAttributes().get_schedd_attributes()
+      if self.concurrent_queries:
+         with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            schedd_future = executor.submit(self._timed_call, 'query_schedd', self._query_schedds, schedd_attrs)
+            collector_future = executor.submit(self._timed_call, 'query_collector', self.collector.query)
+            lancium_future = executor.submit(self._timed_call, 'query_lancium', self._query_lancium)
+            return (schedd_future.result(), collector_future.result(), lancium_future.result())
+      else:
+         schedd_jobs = self._timed_call('query_schedd', self._query_schedds, schedd_attrs)
+         startd_pods = self._timed_call('query_collector', self.collector.query)
+         lancium_pods = self._timed_call('query_lancium', self._query_lancium)
+         return (schedd_jobs, startd_pods, lancium_pods)
+
+   # INTERNAL
+   def _query_schedds(self, schedd_attrs):
+      return [schedd_obj.query_idle(projection=schedd_attrs) for schedd_obj in self.schedd_objs]
+
+   # INTERNAL
+   def _query_lancium(self):
+      # with a shared backend, only the first one actually queries Lancium
+      return [lancium_obj.query() for lancium_obj in self.lancium_objs]
+
+   # INTERNAL
+   def _split_lancium_clusters(self, lancium_obj, lancium_clusters, worker_lancium_clusters):
+      "Give each pod cluster of lancium_obj to the first of its workers that provisions that shape"
+      first_worker = None
+      for i in range(len(self.workers)):
+         if self.workers[i].lancium_obj!=lancium_obj:
+            continue
+         if first_worker==None:
+            first_worker = i
+         for ckey in self.workers[i].available_cluster_keys:
+            if ckey in lancium_clusters:
+               worker_lancium_clusters[i][ckey] = lancium_clusters.pop(ckey)
+      # nobody provisions these anymore, but they still need scale-down and cleanup
+      for ckey in lancium_clusters:
+         worker_lancium_clusters[first_worker][ckey] = lancium_clusters[ckey]
+
+   # INTERNAL
+   def _sum_stats(self):
+      stats = self.last_iteration_stats
+      stats['ok'] = True
+      for worker in self.workers:
+         wstats = worker.last_iteration_stats
+         stats['ok'] = stats['ok'] and wstats['ok']
+         for k in wstats:
+            if k!='ok':
+               # cluster_jobs_idle is a list, so this concatenates
+               stats[k] += wstats[k]
+
+   # INTERNAL
+   def _record_phase(self, phase, duration):
+      self.metrics.set_gauge('last_phase_seconds', duration, {'phase':phase}, help="Duration of each phase in the last iteration")
+      self.metrics.observe('phase_seconds', duration, {'phase':phase}, help="Time spent in each phase")
+
+   # INTERNAL
+   def _timed_call(self, phase, func, *args, **kwargs):
+      "Call func and record how long it took, even if it fails"
+      start_time = time.time()
+      try:
+         return func(*args, **kwargs)
+      finally:
+         self._record_phase(phase, time.time()-start_time)
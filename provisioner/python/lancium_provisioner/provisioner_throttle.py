@@ -0,0 +1,238 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Protect Lancium from being overloaded by the provisioner
+#
+
+import time
+import threading
+
+from . import provisioner_metrics
+
+class ProvisionerTokenBucket:
+   """Thread-safe token bucket, refilled at rate tokens per second, up to burst"""
+
+   def __init__(self, rate, burst):
+      """
+      Arguments:
+         rate: float
+             Tokens added per second, 0 means no limit
+         burst: int
+             Max number of tokens that can accumulate
+      """
+      self.rate = rate
+      self.burst = max(1, burst)
+      self.lock = threading.Lock()
+      self.tokens = float(self.burst)
+      self.last_time = time.time()
+
+   def set_rate(self, rate):
+      with self.lock:
+         self._refill()
+         self.rate = rate
+
+   def try_take(self, n=1):
+      "Non-blocking, returns the number of tokens taken, between 0 and n"
+      with self.lock:
+         if self.rate<=0:
+            return n
+         self._refill()
+         taken = min(n, int(self.tokens))
+         self.tokens -= taken
+         return taken
+
+   def take(self, timeout):
+      "Wait for a token, return False if none became available within timeout seconds"
+      deadline = time.time()+timeout
+      while True:
+         with self.lock:
+            if self.rate<=0:
+               return True
+            self._refill()
+            if self.tokens>=1.0:
+               self.tokens -= 1.0
+               return True
+            wait_time = (1.0-self.tokens)/self.rate
+         now = time.time()
+         if now+wait_time>deadline:
+            return False
+         time.sleep(wait_time)
+
+   # INTERNAL
+   def _refill(self):
+      "Must be called with the lock held"
+      now = time.time()
+      if self.rate>0:
+         self.tokens = min(float(self.burst), self.tokens+(now-self.last_time)*self.rate)
+      self.last_time = now
+
+# ProvisionerCircuitBreaker states
+ProvisionerBreakerClosed = 'closed'       # all calls go through
+ProvisionerBreakerOpen = 'open'           # no calls until the backoff expires
+ProvisionerBreakerHalfOpen = 'half-open'  # a single probe call is in flight
+
+class ProvisionerCircuitBreaker:
+   """Stop calling a failing service, and probe it with exponential backoff"""
+
+   def __init__(self, failure_threshold=5, backoff=30, max_backoff=900):
+      """
+      Arguments:
+         failure_threshold: int (Optional)
+             Open after this many consecutive failures, 0 disables the breaker
+         backoff: float (Optional)
+             Seconds to wait before the first probe
+         max_backoff: float (Optional)
+             The wait doubles after every failed probe, up to this many seconds
+      """
+      self.failure_threshold = failure_threshold
+      self.min_backoff = backoff
+      self.max_backoff = max(backoff, max_backoff)
+      self.lock = threading.Lock()
+      self.state = ProvisionerBreakerClosed
+      self.n_failures = 0 # consecutive
+      self.backoff = backoff
+      self.open_until = 0.0
+
+   def allow(self):
+      """Returns (allowed, is_probe)
+         If is_probe, the caller must report the outcome with record_success or record_failure"""
+      with self.lock:
+         if self.state==ProvisionerBreakerClosed:
+            return (True, False)
+         now = time.time()
+         if now>=self.open_until:
+            # also covers a probe that never reported back
+            self.state = ProvisionerBreakerHalfOpen
+            self.open_until = now+self.backoff
+            return (True, True)
+         return (False, False)
+
+   def record_success(self):
+      with self.lock:
+         self.state = ProvisionerBreakerClosed
+         self.n_failures = 0
+         self.backoff = self.min_backoff
+
+   def record_failure(self):
+      with self.lock:
+         self.n_failures += 1
+         if self.state==ProvisionerBreakerHalfOpen:
+            # the probe failed, wait longer next time
+            self.backoff = min(self.backoff*2, self.max_backoff)
+            self._open()
+         elif (self.state==ProvisionerBreakerClosed) and (self.failure_threshold>0) and (self.n_failures>=self.failure_threshold):
+            self._open()
+
+   def get_state(self):
+      with self.lock:
+         return self.state
+
+   # INTERNAL
+   def _open(self):
+      "Must be called with the lock held"
+      self.state = ProvisionerBreakerOpen
+      self.open_until = time.time()+self.backoff
+
+class ProvisionerLanciumThrottle:
+   """Rate limiter and circuit breaker shared by all the Lancium operations.
+      Deletions have their own share of the rate, so that a deletion backlog cannot starve the submissions.
+      The rate is halved on every failure and slowly recovers on success,
+      so that throughput degrades gradually before the breaker opens."""
+
+   def __init__(self, max_rate=0.0, burst=20, failure_threshold=5, backoff=30, max_backoff=900,
+                min_rate_fraction=0.1, metrics_obj=None, delete_share=0.2):
+      """
+      Arguments:
+         max_rate: float (Optional)
+             Max number of Lancium operations per second, 0 means no limit
+         burst: int (Optional)
+             Max number of operations that can be started at once
+         failure_threshold, backoff, max_backoff: (Optional)
+             See ProvisionerCircuitBreaker
+         min_rate_fraction: float (Optional)
+             Never go below this fraction of max_rate, no matter how many failures
+         metrics_obj: object (Optional)
+             ProvisionerMetrics object, used to report the throttling state
+         delete_share: float (Optional)
+             Fraction of the rate reserved for deletions, the rest is for queries and submissions
+      """
+      self.max_rate = max_rate
+      self.min_rate = max_rate*min_rate_fraction
+      # neither can be 0, that would mean no limit
+      self.delete_share = min(max(delete_share, 0.05), 0.95)
+      self.bucket = ProvisionerTokenBucket(max_rate*(1.0-self.delete_share), int(burst*(1.0-self.delete_share)))
+      self.delete_bucket = ProvisionerTokenBucket(max_rate*self.delete_share, int(burst*self.delete_share))
+      self.breaker = ProvisionerCircuitBreaker(failure_threshold, backoff, max_backoff)
+      self.metrics = metrics_obj if metrics_obj!=None else provisioner_metrics.ProvisionerMetrics()
+      self.rate_lock = threading.Lock()
+      self.rate = max_rate
+      self._update_metrics()
+
+   def reserve(self, n):
+      """Non-blocking, returns how many of the n operations can be started now
+         Only one is allowed while probing a failed service."""
+      if n<=0:
+         return 0
+      (allowed, is_probe) = self.breaker.allow()
+      if not allowed:
+         granted = 0
+      elif is_probe:
+         granted = 1
+      else:
+         granted = self.bucket.try_take(n)
+      self._count_throttled(n-granted)
+      return granted
+
+   def acquire(self, timeout):
+      "Wait for permission to start one query or submission, return False if not granted within timeout seconds"
+      return self._acquire(self.bucket, timeout)
+
+   def acquire_delete(self, timeout):
+      "Wait for permission to start one deletion, return False if not granted within timeout seconds"
+      return self._acquire(self.delete_bucket, timeout)
+
+   def is_open(self):
+      "Returns True if the breaker tripped and is waiting before the next probe"
+      return self.breaker.get_state()==ProvisionerBreakerOpen
+
+   def record(self, ok):
+      "Report the outcome of an operation"
+      if ok:
+         self.breaker.record_success()
+      else:
+         self.breaker.record_failure()
+      if self.max_rate>0:
+         with self.rate_lock:
+            if ok:
+               # additive increase
+               rate = min(self.max_rate, self.rate+0.05*self.max_rate)
+            else:
+               # multiplicative decrease
+               rate = max(self.min_rate, self.rate/2)
+            changed = (rate!=self.rate)
+            self.rate = rate
+         if changed:
+            self.bucket.set_rate(rate*(1.0-self.delete_share))
+            self.delete_bucket.set_rate(rate*self.delete_share)
+      self._update_metrics()
+
+   # INTERNAL
+   def _acquire(self, bucket, timeout):
+      (allowed, is_probe) = self.breaker.allow()
+      if is_probe:
+         return True
+      if allowed and bucket.take(timeout):
+         return True
+      self._count_throttled(1)
+      return False
+
+   def _count_throttled(self, n):
+      if n>0:
+         self.metrics.inc_counter('lancium_throttled_total', n, help="Number of Lancium operations refused by the rate limiter or circuit breaker")
+
+   def _update_metrics(self):
+      self.metrics.set_gauge('lancium_breaker_open', 0 if self.breaker.get_state()==ProvisionerBreakerClosed else 1,
+                             help="1 if the Lancium circuit breaker is refusing operations")
+      self.metrics.set_gauge('lancium_rate_limit', self.rate, help="Current max number of Lancium operations per second, 0 means no limit")
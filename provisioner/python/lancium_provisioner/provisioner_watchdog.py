@@ -0,0 +1,88 @@
+#
+# lancium-htcondor-portal/provisioner
+#
+# BSD license, copyright Igor Sfiligoi 2022
+#
+# Watch over the event loop iterations
+#
+
+import os
+import time
+import threading
+import collections
+
+class ProvisionerWatchdog:
+   """Record the duration of the event loop iterations, and flag the ones past the deadline.
+      Can optionally terminate the process on a stall, so that Kubernetes restarts it."""
+
+   def __init__(self, log_obj, deadline, abort=False, history_len=100):
+      """
+      Arguments:
+         log_obj: object
+             Logging object
+         deadline: int
+             Max number of seconds an iteration is expected to take
+         abort: bool (Optional)
+             If True, exit the process when an iteration runs past the deadline
+         history_len: int (Optional)
+             Number of iteration durations to remember
+      """
+      self.log_obj = log_obj
+      self.deadline = deadline
+      self.abort = abort
+      self.durations = collections.deque(maxlen=history_len)
+      self.n_overruns = 0
+      # protects the variables below
+      self.lock = threading.Lock()
+      self.iteration_start = None # None if not in an iteration
+      self.flagged = False # already reported the current iteration
+      self.thread = None
+
+   def start_iteration(self):
+      with self.lock:
+         self.iteration_start = time.time()
+         self.flagged = False
+         if self.thread==None:
+            self.thread = threading.Thread(target=self._monitor, name="provisioner-watchdog")
+            self.thread.daemon = True
+            self.thread.start()
+
+   def end_iteration(self):
+      "Returns the duration of the iteration, in seconds"
+      with self.lock:
+         duration = time.time()-self.iteration_start
+         self.iteration_start = None
+      self.durations.append(duration)
+      if duration>self.deadline:
+         self.n_overruns += 1
+         self.log_obj.log_error("[ProvisionerWatchdog] Iteration took %is, deadline is %is"%(duration,self.deadline))
+      return duration
+
+   def get_stats(self):
+      "Returns (last,max,avg) of the recorded durations"
+      if len(self.durations)==0:
+         return (0.0, 0.0, 0.0)
+      durations = list(self.durations)
+      return (durations[-1], max(durations), sum(durations)/len(durations))
+
+   # INTERNAL
+   def _monitor(self):
+      while True:
+         time.sleep(max(1.0, min(10.0, self.deadline/10.0)))
+         with self.lock:
+            if (self.iteration_start==None) or self.flagged:
+               continue
+            elapsed = time.time()-self.iteration_start
+            if elapsed<=self.deadline:
+               continue
+            self.flagged = True
+         self.log_obj.log_error("[ProvisionerWatchdog] Iteration stalled, running for %is, deadline is %is"%(elapsed,self.deadline))
+         self.log_obj.sync()
+         if self.abort:
+            # the main thread may be stuck in a C call, so there is no clean way to interrupt it
+            self.log_obj.log_error("[ProvisionerWatchdog] Aborting")
+            self.log_obj.sync()
+            if hasattr(self.log_obj, 'flush'):
+               # the log may be written in the background, make sure it gets there before exiting
+               self.log_obj.flush()
+            os._exit(2)